@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+Compares CPU per second of audio for rx_demodulator's front end, one
+decimating frequency translating filter, against the chain it replaced:
+a full rate complex band-pass, a full rate translating low-pass and a
+decimating resampler. Both feed the same GFSK demodulator, and the frames
+each decodes show they select the same signal
+
+    python -m bench.channelizer [-snr 15] [-packets 200]
+'''
+
+from argparse import ArgumentParser
+from time import clock
+
+import numpy
+from gnuradio import blocks, digital, filter, gr
+from gnuradio.digital import packet_utils
+from gnuradio.filter import firdes
+
+from voiz.framing import SAMPLE_RATE, ACCESS_CODE_THRESHOLD
+from voiz.rx import channel_taps
+from bench.modem import MODEM, random_pkts, add_noise, np_modulate
+
+class chain_front_end(gr.hier_block2):
+    # rx_demodulator's front end before the channelizer
+
+    def __init__(self, carrier, sideband, transition, sps, interpolation):
+        gr.hier_block2.__init__(
+            self,
+            "Chained front end",
+            gr.io_signature(1, 1, gr.sizeof_float),
+            gr.io_signature(1, 1, gr.sizeof_gr_complex)
+        )
+        self.float_to_complex = blocks.float_to_complex(1)
+        self.band_pass = filter.fft_filter_ccc(1, (firdes.complex_band_pass_2(1.0,SAMPLE_RATE,carrier-sideband,carrier+sideband,transition,100,firdes.WIN_HAMMING,6.76)), 1)
+        self.band_pass.declare_sample_delay(0)
+        self.xlating = filter.freq_xlating_fir_filter_ccc(1, (firdes.low_pass(1,SAMPLE_RATE,sideband,transition)), carrier, SAMPLE_RATE)
+        self.resampler = filter.rational_resampler_ccc(
+                interpolation=1,
+                decimation=interpolation,
+                taps=None,
+                fractional_bw=None,
+        )
+        self.connect(self, self.float_to_complex, self.band_pass, self.xlating, self.resampler, self)
+
+def channelizer_front_end(carrier, sideband, transition, sps, interpolation):
+    return filter.freq_xlating_fir_filter_fcf(
+        interpolation,
+        channel_taps(sideband, transition, interpolation),
+        carrier,
+        SAMPLE_RATE
+    )
+
+def gfsk_demod(sps):
+    # as rx_demodulator configures it
+    return digital.gfsk_demod(
+        samples_per_symbol=sps,
+        sensitivity=1.0,
+        gain_mu=0.175,
+        mu=0.5,
+        omega_relative_limit=0.005,
+        freq_error=0.0,
+        verbose=False,
+        log=False,
+    )
+
+def front_end_cpu(make_front_end, samples):
+    tb = gr.top_block()
+    tb.connect(blocks.vector_source_f(samples, False), make_front_end(*MODEM), blocks.null_sink(gr.sizeof_gr_complex))
+    c0 = clock()
+    tb.run()
+    return clock() - c0
+
+def decode(make_front_end, samples):
+    tb = gr.top_block()
+    queue = gr.msg_queue()
+    tb.connect(
+        blocks.vector_source_f(samples, False),
+        make_front_end(*MODEM),
+        gfsk_demod(MODEM[3]),
+        digital.correlate_access_code_bb(packet_utils.default_access_code, ACCESS_CODE_THRESHOLD),
+        digital.framer_sink_1(queue)
+    )
+    tb.run()
+    frames = []
+    while queue.count() > 0:
+        msg = queue.delete_head()
+        frames.append(packet_utils.unmake_packet(msg.to_string(), int(msg.arg1())))
+    return frames
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the receive channelizer against the chained front end')
+    parser.add_argument('-snr', type=float, default=None, help='add white noise for this SNR in dB')
+    parser.add_argument('-packets', type=int, default=200)
+    args = parser.parse_args()
+
+    pkts = random_pkts(args.packets)
+    audio = np_modulate(pkts)[0]
+    samples = add_noise(audio, args.snr).astype(numpy.float32).tolist()
+    seconds = len(samples) / float(SAMPLE_RATE)
+    sent = set(pkts)
+
+    print 'carrier %d, sideband %d, transition %d, sps %d, interpolation %d, %.1fs of audio' % (MODEM + (seconds,))
+    print '%-12s %8s %12s' % ('front end', 'cpu', 'frames ok')
+    for name, make_front_end in (('chain', chain_front_end), ('channelizer', channelizer_front_end)):
+        cpu = front_end_cpu(make_front_end, samples)
+        ok = sum(1 for crc_ok, payload in decode(make_front_end, samples) if crc_ok and payload in sent)
+        print '%-12s %7.2f%% %8d/%d' % (name, 100.0 * cpu / seconds, ok, len(pkts))
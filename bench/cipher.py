@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+Compares voice packet decryption throughput between the keystream window
+and rebuilding the AES-CTR cipher whenever the counter is out of sync
+
+    python -m bench.cipher
+'''
+
+from random import Random
+from time import time as now
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from voiz.crypto import VoiZMAC
+
+PACKETS = 20000
+PAYLOAD_LEN = 64
+LOSS = 0.2
+
+class RebuildingCipher():
+    # the decryption path as it was before the keystream window
+
+    def __init__(self, key, counter_suffix):
+        self.key = key
+        self.counter_suffix = counter_suffix
+        self.decctr = None
+
+    def decrypt(self, payload, ctr):
+        if ctr != self.decctr:
+            decctro = Counter.new(64, suffix=self.counter_suffix, initial_value=ctr)
+            self.cipher = AES.new(self.key, AES.MODE_CTR, counter=decctro)
+            self.decctr = ctr
+        self.decctr += len(payload) / 16
+        return self.cipher.decrypt(payload)
+
+def inOrder(ctrs):
+    return ctrs
+
+def lossy(ctrs):
+    rand = Random(1)
+    return [ctr for ctr in ctrs if rand.random() >= LOSS]
+
+def reordered(ctrs):
+    # swap every other pair of neighbouring packets
+    ctrs = list(ctrs)
+    for i in xrange(0, len(ctrs) - 1, 4):
+        ctrs[i], ctrs[i + 1] = ctrs[i + 1], ctrs[i]
+    return ctrs
+
+def packetsPerSecond(decrypt, pkts):
+    t0 = now()
+    for ctr, payload in pkts:
+        decrypt(payload, ctr)
+    return len(pkts) / (now() - t0)
+
+if __name__ == '__main__':
+    mac = VoiZMAC()
+    mac.s0 = 's' * 32
+    mac.setCounterSuffix('s' * 8)
+    mac.startEncryption('Initiator')
+    sent = []
+    for i in xrange(PACKETS):
+        ctr = mac.encctr
+        sent.append((ctr, mac.encrypt('\x00' * PAYLOAD_LEN)))
+
+    print '%-12s %14s %14s' % ('delivery', 'rebuild pkt/s', 'window pkt/s')
+    for order in (inOrder, lossy, reordered):
+        pkts = order(sent)
+        rebuilding = RebuildingCipher(mac.deckey, mac.counter_suffix)
+        mac.startEncryption('Initiator')
+        print '%-12s %14d %14d' % (
+            order.__name__,
+            packetsPerSecond(rebuilding.decrypt, pkts),
+            packetsPerSecond(mac.decrypt, pkts)
+        )
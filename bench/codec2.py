@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+Compares per-frame codec2 latency and CPU between libcodec2 and the
+c2enc/c2dec pipes
+
+    python -m bench.codec2 [mode]
+'''
+
+import sys
+from math import sin, pi
+from resource import getrusage, RUSAGE_CHILDREN
+from struct import pack
+from subprocess import Popen, PIPE
+from time import clock, time as now
+
+from voiz.c2 import Codec2, CODEC2_MODE, CODEC2ENC_PATH, CODEC2DEC_PATH
+
+FRAMES = 500
+
+def speech(samples):
+    # two tones stand in for a voiced signal
+    return ''.join(
+        pack('<h', int(6000 * sin(2 * pi * 200 * n / 8000.0) + 3000 * sin(2 * pi * 700 * n / 8000.0)))
+        for n in xrange(samples)
+    )
+
+def split(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+def childCPU():
+    usage = getrusage(RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def benchLib(fn, frames):
+    c0, t0 = clock(), now()
+    out = [fn(frame) for frame in frames]
+    return out, (now() - t0) / len(frames), (clock() - c0) / len(frames)
+
+def benchPipe(path, mode, frames, out_bytes):
+    c0, t0 = clock(), now()
+    proc = Popen((path, str(mode), '-', '-'), stdin=PIPE, stdout=PIPE)
+    child0 = childCPU()
+    out = []
+    for frame in frames:
+        # one frame in, one frame out, as the relay would see it
+        proc.stdin.write(frame)
+        proc.stdin.flush()
+        out.append(proc.stdout.read(out_bytes))
+    proc.stdin.close()
+    proc.wait()
+    cpu = clock() - c0 + childCPU() - child0
+    return out, (now() - t0) / len(frames), cpu / len(frames)
+
+def report(name, latency, cpu):
+    print '%-16s %8.3fms %8.3fms' % (name, latency * 1000, cpu * 1000)
+
+if __name__ == '__main__':
+    mode = int(sys.argv[1]) if len(sys.argv) > 1 else CODEC2_MODE
+    if not Codec2.available():
+        sys.exit('libcodec2 not found')
+    codec = Codec2(mode)
+    pcm_frames = split(speech(codec.samples_per_frame * FRAMES), codec.pcm_bytes)
+
+    print 'codec2 %d, %d frames' % (mode, FRAMES)
+    print '%-16s %10s %10s' % ('per frame', 'latency', 'cpu')
+    bits, latency, cpu = benchLib(codec.encode, pcm_frames)
+    report('libcodec2 enc', latency, cpu)
+    out, latency, cpu = benchLib(codec.decode, bits)
+    report('libcodec2 dec', latency, cpu)
+    codec.close()
+    out, latency, cpu = benchPipe(CODEC2ENC_PATH, mode, pcm_frames, codec.frame_bytes)
+    report('c2enc pipe', latency, cpu)
+    out, latency, cpu = benchPipe(CODEC2DEC_PATH, mode, bits, codec.pcm_bytes)
+    report('c2dec pipe', latency, cpu)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+'''
+Times DH keypair generation and shared secret computation
+
+    python -m bench.dh
+'''
+
+from time import sleep, time as now
+
+from voiz.crypto import VoiZKeyPool, VoiZMAC, newDHKeypair, DH_EXPONENT_BITS
+
+LEGACY_EXPONENT_BITS = 2047 * 8
+ROUNDS = 5
+
+def timeit(fn, rounds=ROUNDS):
+    t0 = now()
+    for i in range(rounds):
+        fn()
+    return (now() - t0) / rounds * 1000
+
+def timeSecret(exponent_bits):
+    mac = VoiZMAC(exponent_bits=exponent_bits)
+    mac.setPartnerPublicKey(VoiZMAC(exponent_bits=exponent_bits).packedPublicKey())
+    mac.setPackets('')
+    return timeit(lambda: mac.computeSecret('i' * 12, 'r' * 12))
+
+def timePooledStartup(exponent_bits):
+    pool = VoiZKeyPool(exponent_bits)
+    pool.start()
+    # stand-in for flowgraph construction while the pool fills
+    while len(pool.keypairs) < pool.size:
+        sleep(0.01)
+    t0 = now()
+    VoiZMAC(pool, exponent_bits).packedPublicKey()
+    elapsed = (now() - t0) * 1000
+    pool.stop()
+    pool.join()
+    return elapsed
+
+if __name__ == '__main__':
+    print '%-28s %10s %10s' % ('', 'keypair', 's0')
+    for exponent_bits in (LEGACY_EXPONENT_BITS, 512, DH_EXPONENT_BITS):
+        print '%-28s %8.1fms %8.1fms' % (
+            '%d bit exponent' % exponent_bits,
+            timeit(lambda: newDHKeypair(exponent_bits)),
+            timeSecret(exponent_bits)
+        )
+    print '%-28s %8.1fms' % (
+        'pooled, %d bit exponent' % DH_EXPONENT_BITS,
+        timePooledStartup(DH_EXPONENT_BITS)
+    )
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+'''
+Measures what the FEC codes do to voice goodput and handshake completion
+time across channel SNRs, through the simulated GFSK channel
+
+    python -m bench.fec [-modem numpy] [--ber]
+
+With -modem numpy the packets go through the NumPy modem with white noise
+added, which runs without GNU Radio. With --ber the frames go through a
+channel that flips independent bits at fixed rates instead, which
+measures the codes without a modem
+'''
+
+from argparse import ArgumentParser
+from math import log
+from random import Random
+
+from voiz.fec import VoiZFEC, FEC_CODES, UncorrectableFECException
+from voiz.framing import SAMPLE_RATE, FRAME_OVERHEAD, ACCESS_CODE, ACCESS_CODE_THRESHOLD, \
+    FRAME_HEADER, FRAME_CRC, MODEMS
+from voiz.protocol import PKT_CODEC2, PKT_HELLO, CODEC2_LEN, HELLO_LEN, COMMIT_LEN, \
+    CONFIRM_LAYOUT, DHPART_FRAGMENT_LENS
+from bench.modem import MODEM, random_pkts, add_noise, np_modulate, np_demodulate
+
+SNRS = range(2, 22, 2)
+BERS = (1e-2, 5e-3, 2e-3, 1e-3, 5e-4, 2e-4, 1e-4)
+PACKETS = 200
+RETRANSMIT_DELAY = 0.2     # VoiZApp's DELAY
+
+# (packets sent, packets replied) for each round trip of the handshake
+HANDSHAKE = (
+    ((HELLO_LEN,), (HELLO_LEN,)),
+    ((COMMIT_LEN,), DHPART_FRAGMENT_LENS),
+    (DHPART_FRAGMENT_LENS, (CONFIRM_LAYOUT.size,)),
+    ((CONFIRM_LAYOUT.size,), ()),
+)
+
+def bit_errors(rand, ber, nbits):
+    # geometric gaps between errors, rather than a draw per bit
+    if not ber:
+        return
+    log_keep = log(1.0 - ber)
+    pos = -1
+    while True:
+        pos += 1 + int(log(1.0 - rand.random()) / log_keep)
+        if pos >= nbits:
+            return
+        yield pos
+
+class BitErrorChannel():
+    '''
+    Flips independent bits at a fixed rate over each frame. A frame is lost
+    when its access code is past the correlator's threshold or its length
+    header is hit, and fails its CRC when its payload or CRC is
+    '''
+
+    def run(self, pkts, ber, seed=0, fec=None):
+        rand = Random(seed)
+        sent = set(pkts)
+        if fec:
+            pkts = [fec.encode(pkt) for pkt in pkts]
+        ok = 0
+        for pkt in pkts:
+            payload = bytearray(pkt)
+            code_errors = header_errors = crc_errors = 0
+            # the preamble only trains the demodulator
+            start = 8 * (len(ACCESS_CODE) + FRAME_HEADER.size)
+            nbits = start + 8 * (len(payload) + FRAME_CRC.size)
+            for pos in bit_errors(rand, ber, nbits):
+                if pos < 8 * len(ACCESS_CODE):
+                    code_errors += 1
+                elif pos < start:
+                    header_errors += 1
+                elif pos < start + 8 * len(payload):
+                    payload[(pos - start) / 8] ^= 1 << (pos % 8)
+                else:
+                    crc_errors += 1
+            if code_errors > ACCESS_CODE_THRESHOLD or header_errors:
+                continue
+            crc_ok = not crc_errors and payload == pkt
+            if fec:
+                try:
+                    ok += fec.decode(str(payload), crc_ok) in sent
+                except UncorrectableFECException:
+                    pass
+            else:
+                ok += crc_ok
+        return {
+            'ok':       ok,
+            'per':      1.0 - ok / float(len(pkts)),
+            'airtime':  sum(airtime(len(pkt), None, None) for pkt in pkts),
+        }
+
+class NumpyChannelSim():
+    # VoiZChannelSim.run() over the NumPy modem, white noise only
+
+    def run(self, pkts, snr_db=None, seed=0, fec=None):
+        sent = set(pkts)
+        if fec:
+            pkts = [fec.encode(pkt) for pkt in pkts]
+        audio = np_modulate(pkts)[0]
+        frames = np_demodulate(add_noise(audio, snr_db, seed))[0]
+        if fec:
+            decoded = []
+            for crc_ok, payload in frames:
+                try:
+                    decoded.append((True, fec.decode(payload, crc_ok)))
+                except UncorrectableFECException:
+                    continue
+            frames = decoded
+        ok = sum(1 for crc_ok, payload in frames if crc_ok and payload in sent)
+        return {
+            'ok':       ok,
+            'per':      1.0 - ok / float(len(pkts)),
+            'airtime':  len(audio) / float(SAMPLE_RATE),
+        }
+
+def with_id(pkts, pkt_id):
+    return [chr(pkt_id) + pkt[1:] for pkt in pkts]
+
+def airtime(length, fec, pkt_id):
+    sps, interpolation = MODEM[3], MODEM[4]
+    if fec:
+        length = fec.encoded_len(length, pkt_id)
+    return (length + FRAME_OVERHEAD) * 8.0 * sps * interpolation / SAMPLE_RATE
+
+def handshake_time(per, fec):
+    # every packet of a round has to get through, otherwise the round is
+    # repeated after the retransmit delay
+    total = 0.0
+    for sent, replied in HANDSHAKE:
+        lens = sent + replied
+        success = (1.0 - per) ** len(lens)
+        if success == 0:
+            return float('inf')
+        round_trip = sum(airtime(length, fec, PKT_HELLO) for length in lens) + RETRANSMIT_DELAY
+        total += round_trip / success
+    return total
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the FEC codes across channel SNRs')
+    parser.add_argument('-modem', choices=MODEMS, default='gnuradio', help='GFSK modem to simulate (default: gnuradio)')
+    parser.add_argument('--ber', help='flip bits at fixed rates instead of simulating the modem', action='store_true')
+    args = parser.parse_args()
+    if args.ber:
+        sim = BitErrorChannel()
+        points = [('%6.0e' % ber, {'ber': ber}) for ber in BERS]
+    else:
+        if args.modem == 'numpy':
+            sim = NumpyChannelSim()
+        else:
+            from voiz.sim import VoiZChannelSim
+            sim = VoiZChannelSim(*MODEM)
+        points = [('%4ddB' % snr_db, {'snr_db': snr_db}) for snr_db in SNRS]
+    voice_pkts = with_id(random_pkts(PACKETS, CODEC2_LEN), PKT_CODEC2)
+    # handshake packets are about as long as a DH-part fragment
+    handshake_pkts = with_id(random_pkts(PACKETS, max(DHPART_FRAGMENT_LENS)), PKT_HELLO)
+
+    print '%6s %5s %10s %8s %10s %8s %10s' % (
+        'BER' if args.ber else 'SNR', 'code', 'parity', 'voice PER', 'goodput', 'hs PER', 'handshake'
+    )
+    for label, channel in points:
+        for code in range(len(FEC_CODES)):
+            fec = VoiZFEC(code, code) if code else None
+            nsym, depth = FEC_CODES[code]
+            voice = sim.run(voice_pkts, fec=fec, **channel)
+            handshake = sim.run(handshake_pkts, fec=fec, **channel)
+            print '%6s %5d %5dx%-4d %8.3f %8.1fB/s %8.3f %9.2fs' % (
+                label,
+                code,
+                nsym,
+                depth,
+                voice['per'],
+                voice['ok'] * CODEC2_LEN / voice['airtime'],
+                handshake['per'],
+                handshake_time(handshake['per'], fec)
+            )
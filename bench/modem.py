@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''
+Compares the NumPy modem with the GNU Radio flowgraphs: startup time, and
+CPU per second of audio modulating and demodulating the same frames. Each
+receiver also demodulates the other's audio, to show they interoperate
+
+    python -m bench.modem [-snr 15] [-packets 200] [-gnuradio]
+
+Without -gnuradio only the NumPy modem is measured
+'''
+
+import subprocess
+import sys
+from argparse import ArgumentParser
+from random import Random
+from time import clock
+
+import numpy
+
+from voiz.framing import SAMPLE_RATE, PAYLOAD_LEN, make_packet
+from voiz.npmodem import gfsk_modulator, gfsk_demodulator, PERIOD
+
+MODEM = (2400, 2300, 240, 2, 8)
+GAP_BYTES = 8               # idle bytes between frames, keeping the modem busy
+STARTUP_RUNS = 3
+
+STARTUP = {
+    'numpy': '''
+from voiz.npmodem import gfsk_modulator, gfsk_demodulator
+gfsk_modulator(*%(modem)r)
+gfsk_demodulator(*%(modem)r)
+''',
+    'gnuradio': '''
+from voiz.tx import tx_modulator
+from voiz.rx import rx_demodulator
+tx_modulator(*%(modem)r)
+rx_demodulator(*%(modem)r)
+''',
+}
+
+def random_pkts(count, length=PAYLOAD_LEN, seed=0):
+    # as voiz.sim makes them, without importing GNU Radio
+    rand = Random(seed)
+    return [''.join(chr(rand.randint(0, 255)) for i in xrange(length)) for n in xrange(count)]
+
+def startup_time(backend):
+    # a fresh interpreter each time, imports included
+    code = 'from time import time; t0 = time()\n%s\nprint time() - t0' % (STARTUP[backend] % {'modem': MODEM})
+    return min(
+        float(subprocess.check_output((sys.executable, '-c', code)))
+        for i in xrange(STARTUP_RUNS)
+    )
+
+def framed(pkts):
+    return [make_packet(pkt) + '\x00' * GAP_BYTES for pkt in pkts]
+
+def add_noise(audio, snr_db, seed=0):
+    if snr_db is None:
+        return audio
+    power = (audio ** 2).mean()
+    noise = numpy.random.RandomState(seed).randn(len(audio)) * numpy.sqrt(power / 10 ** (snr_db / 10.0))
+    return audio + noise
+
+def np_modulate(pkts):
+    modulator = gfsk_modulator(*MODEM)
+    c0 = clock()
+    # a frame at a time, as the transmit thread does it
+    audio = numpy.concatenate([modulator.modulate(frame) for frame in framed(pkts)])
+    return audio, clock() - c0
+
+def np_demodulate(audio):
+    demodulator = gfsk_demodulator(*MODEM)
+    frames = []
+    c0 = clock()
+    # a period at a time, as the capture thread hands it over
+    for i in xrange(0, len(audio), PERIOD):
+        frames.extend(demodulator.demodulate(audio[i:i + PERIOD]))
+    return frames, clock() - c0
+
+def gr_modulate(pkts):
+    from gnuradio import blocks, gr
+    from voiz.tx import tx_modulator
+    tb = gr.top_block()
+    source = blocks.vector_source_b(map(ord, ''.join(framed(pkts))), False)
+    sink = blocks.vector_sink_f()
+    tb.connect(source, tx_modulator(*MODEM), sink)
+    c0 = clock()
+    tb.run()
+    cpu = clock() - c0
+    return numpy.array(sink.data()), cpu
+
+def gr_demodulate(audio):
+    from gnuradio import blocks, digital, gr
+    from gnuradio.digital import packet_utils
+    from voiz.framing import ACCESS_CODE_THRESHOLD
+    from voiz.rx import rx_demodulator
+    tb = gr.top_block()
+    queue = gr.msg_queue()
+    source = blocks.vector_source_f(audio.astype(numpy.float32).tolist(), False)
+    correlator = digital.correlate_access_code_bb(packet_utils.default_access_code, ACCESS_CODE_THRESHOLD)
+    tb.connect(source, rx_demodulator(*MODEM), correlator, digital.framer_sink_1(queue))
+    c0 = clock()
+    tb.run()
+    cpu = clock() - c0
+    frames = []
+    while queue.count() > 0:
+        msg = queue.delete_head()
+        frames.append(packet_utils.unmake_packet(msg.to_string(), int(msg.arg1())))
+    return frames, cpu
+
+def report(name, audio, cpu, frames=None, pkts=None):
+    line = '%-24s %8.1fs audio %7.1f%% cpu' % (name, len(audio) / float(SAMPLE_RATE), 100.0 * cpu * SAMPLE_RATE / len(audio))
+    if frames is not None:
+        sent = set(pkts)
+        ok = sum(1 for crc_ok, payload in frames if crc_ok and payload in sent)
+        line += ' %5d/%d frames ok' % (ok, len(pkts))
+    print line
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the NumPy modem against the GNU Radio flowgraphs')
+    parser.add_argument('-snr', type=float, default=None, help='add white noise for this SNR in dB')
+    parser.add_argument('-packets', type=int, default=200)
+    parser.add_argument('-gnuradio', action='store_true', help='also measure the GNU Radio flowgraphs')
+    args = parser.parse_args()
+    backends = ('numpy', 'gnuradio') if args.gnuradio else ('numpy',)
+
+    print 'carrier %d, sideband %d, transition %d, sps %d, interpolation %d' % MODEM
+    for backend in backends:
+        print '%-24s %8.3fs startup' % (backend, startup_time(backend))
+
+    pkts = random_pkts(args.packets)
+    np_audio, cpu = np_modulate(pkts)
+    report('numpy tx', np_audio, cpu)
+    np_audio = add_noise(np_audio, args.snr)
+    frames, cpu = np_demodulate(np_audio)
+    report('numpy tx -> numpy rx', np_audio, cpu, frames, pkts)
+    if args.gnuradio:
+        gr_audio, cpu = gr_modulate(pkts)
+        report('gnuradio tx', gr_audio, cpu)
+        gr_audio = add_noise(gr_audio, args.snr)
+        frames, cpu = gr_demodulate(gr_audio)
+        report('gnuradio tx -> gnuradio rx', gr_audio, cpu, frames, pkts)
+        frames, cpu = gr_demodulate(np_audio)
+        report('numpy tx -> gnuradio rx', np_audio, cpu, frames, pkts)
+        frames, cpu = np_demodulate(gr_audio)
+        report('gnuradio tx -> numpy rx', gr_audio, cpu, frames, pkts)
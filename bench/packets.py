@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+'''
+Compares codec2 packet assembly and dissection throughput between the
+Struct layout packet factory and string concatenation and fixed offsets,
+and codec2 frame accumulation by shifting against slicing the capture
+
+    python -m bench.packets
+'''
+
+from struct import Struct
+from time import time as now
+
+from voiz.crypto import VoiZMAC, InvalidHMACException
+from voiz.protocol import VoiZPacketFactory, PKT_CODEC2, CODEC2_PAYLOAD_LEN
+
+PACKETS = 20000
+PAYLOAD_LEN = 81
+CAPTURE_CHUNKS = (8, 1024)
+REPEATS = 5
+
+ULONG_PACK = Struct('!Q').pack
+ULONG_UNPACK = Struct('!Q').unpack
+PKT_CODEC2_CHR = chr(PKT_CODEC2)
+
+class ConcatenatingFactory():
+    # codec2 packets as they were built before the Struct layouts
+
+    def __init__(self, cache, mac):
+        self.mac = mac
+
+    def gen_pkt_codec2(self, payload):
+        packed_encctr = ULONG_PACK(self.mac.encctr)
+        pkt = PKT_CODEC2_CHR + packed_encctr + self.mac.encrypt(PKT_CODEC2_CHR + payload)
+        return (pkt + self.mac.packetMAC(pkt)[:8]).ljust(PAYLOAD_LEN, '\x00')
+
+    def dct_pkt_codec2(self, pkt):
+        packed_ctr = pkt[1:9]
+        if not self.mac.verifyPacketMAC(pkt[:73], pkt[73:81]):
+            raise InvalidHMACException('Bad HMAC in codec2 data packet')
+        ctr = ULONG_UNPACK(packed_ctr)[0]
+        return ctr, self.mac.decrypt(pkt[9:73], ctr)[1:64]
+
+def newMACs():
+    macs = (VoiZMAC(), VoiZMAC())
+    for mac, role in zip(macs, ('Initiator', 'Responder')):
+        mac.s0 = 's' * 32
+        mac.setCounterSuffix('c' * 8)
+        mac.startEncryption(role)
+    return macs
+
+def shiftedFrames(chunks):
+    # the relay loop as it was, shifting the buffer after every packet
+    samples = ''
+    frames = []
+    for chunk in chunks:
+        samples += chunk
+        while len(samples) >= CODEC2_PAYLOAD_LEN:
+            frames.append(samples[:CODEC2_PAYLOAD_LEN])
+            samples = samples[CODEC2_PAYLOAD_LEN:]
+    return frames
+
+def slicedFrames(chunks):
+    samples = ''
+    frames = []
+    for chunk in chunks:
+        samples += chunk
+        if len(samples) >= CODEC2_PAYLOAD_LEN:
+            end = len(samples) - len(samples) % CODEC2_PAYLOAD_LEN
+            for i in xrange(0, end, CODEC2_PAYLOAD_LEN):
+                frames.append(samples[i:i + CODEC2_PAYLOAD_LEN])
+            samples = samples[end:]
+    return frames
+
+def perSecond(fn, items):
+    t0 = now()
+    out = [fn(item) for item in items]
+    return out, len(items) / (now() - t0)
+
+def benchFactory(factory_cls, payloads):
+    best_gen = best_dct = 0
+    for i in xrange(REPEATS):
+        imac, rmac = newMACs()
+        pkts, gen_rate = perSecond(factory_cls(None, imac).gen_pkt_codec2, payloads)
+        out, dct_rate = perSecond(factory_cls(None, rmac).dct_pkt_codec2, pkts)
+        assert [c2data for ctr, c2data in out] == payloads
+        best_gen = max(best_gen, gen_rate)
+        best_dct = max(best_dct, dct_rate)
+    return best_gen, best_dct
+
+def benchFrames(fn, chunks, expected):
+    best = 0
+    for i in xrange(REPEATS):
+        t0 = now()
+        frames = fn(chunks)
+        best = max(best, len(frames) / (now() - t0))
+    assert frames == expected
+    return best
+
+if __name__ == '__main__':
+    payloads = [chr(i % 256) * CODEC2_PAYLOAD_LEN for i in xrange(PACKETS)]
+    print '%-16s %12s %12s' % ('', 'gen pkt/s', 'dct pkt/s')
+    print '%-16s %12d %12d' % (('concatenating',) + benchFactory(ConcatenatingFactory, payloads))
+    print '%-16s %12d %12d' % (('struct layouts',) + benchFactory(VoiZPacketFactory, payloads))
+
+    capture = ''.join(payloads)
+    print
+    print '%-16s %12s %12s' % ('read size', 'shifted f/s', 'sliced f/s')
+    for size in CAPTURE_CHUNKS:
+        chunks = [capture[i:i + size] for i in xrange(0, len(capture), size)]
+        print '%-16d %12d %12d' % (size, benchFrames(shiftedFrames, chunks, payloads), benchFrames(slicedFrames, chunks, payloads))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+Replays the channel of a recorded trace (start_voiz.py -trace) between two
+VoiZApps in this process, and reports how the handshake and relay fared
+
+    python -m bench.replay TRACE [-speed 4] [-seconds 30] [start_voiz options]
+
+-speed shortens airtime and speeds up the voice, synthetic or streamed from
+-micfile, the handshake's retransmit timers still run in real time
+'''
+
+import logging
+from argparse import ArgumentParser
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep
+
+from start_voiz import loadConfig, setupLogging
+from voiz.app import VoiZApp
+from voiz.c2 import Codec2FileSource
+from voiz.crypto import VoiZCache
+from voiz.metrics import VoiZMetrics
+from voiz.replay import VoiZReplayChannel, VoiZReplaySource, VoiZReplaySink, trace_outcomes
+
+SIDES = ('initiator', 'responder')
+HANDSHAKE_TIMEOUT = 60.0
+
+def replay_call(outcomes, conf, speed, seconds):
+    channel = VoiZReplayChannel(outcomes, speed)
+    tmp = mkdtemp()
+    apps = []
+    threads = []
+    for side, name in enumerate(SIDES):
+        side_conf = loadConfig(conf)
+        side_conf.initiate = side == 0
+        metrics = VoiZMetrics(True)
+        app = VoiZApp(side_conf, cache=VoiZCache(join(tmp, name)), metrics=metrics)
+        open_transport = lambda fec, recorder, side=side, varlen=side_conf.varlen or side_conf.fec: \
+            channel.endpoint(side, side_conf.sps, side_conf.interpolation, varlen, fec, recorder)
+        open_voice = lambda app=app, metrics=metrics, micfile=side_conf.micfile: (
+            Codec2FileSource(micfile, speed=speed, metrics=metrics) if micfile else VoiZReplaySource(speed=speed),
+            VoiZReplaySink(
+                app.pkt_factory.codec2_ctr_step,
+                room=app.pkt_factory.codec2_room,
+                speed=speed,
+                metrics=metrics
+            )
+        )
+        thread = Thread(target=app.run, args=(open_transport, open_voice), name=name)
+        thread.daemon = True
+        apps.append(app)
+        threads.append(thread)
+    channel.start()
+    for thread in threads:
+        thread.start()
+    waited = 0.0
+    while waited < HANDSHAKE_TIMEOUT and not all(app.relay for app in apps):
+        if not any(thread.is_alive() for thread in threads):
+            break
+        sleep(0.1)
+        waited += 0.1
+    if all(app.relay for app in apps):
+        sleep(seconds)
+    snapshots = [peer.metrics.snapshot() for peer in apps]
+    for app in apps:
+        app.stop()
+    for thread in threads:
+        thread.join()
+    channel.stop()
+    rmtree(tmp)
+    return channel, snapshots
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Replay a recorded VoiZ channel')
+    parser.add_argument('trace', help='trace recorded with start_voiz.py -trace')
+    parser.add_argument('-speed', type=float, default=1.0)
+    parser.add_argument('-seconds', type=float, default=30.0)
+    args, conf = parser.parse_known_args()
+    setupLogging(logging.WARNING)
+
+    outcomes = trace_outcomes(args.trace)
+    print '%d received frames in trace, %d lost, %d corrupted' % (
+        len(outcomes),
+        outcomes.count(False),
+        sum(1 for outcome in outcomes if outcome)
+    )
+    channel, snapshots = replay_call(outcomes, conf, args.speed, args.seconds)
+    for side, (name, snapshot) in enumerate(zip(SIDES, snapshots)):
+        handshake = snapshot.get('handshake.total', {})
+        jitter = snapshot.get('jitter', {})
+        print '%-10s handshake %6.2fs  sent %5d lost %4d corrupted %4d  played %5d lost %4d late %4d jitter %6.1fms' % (
+            name,
+            handshake.get('max', float('nan')),
+            channel.sent[side],
+            channel.lost[side],
+            channel.corrupted[side],
+            jitter.get('played', 0),
+            jitter.get('lost', 0),
+            jitter.get('late', 0),
+            jitter.get('jitter', 0.0) * 1000
+        )
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import logging
+from argparse import ArgumentParser
+
+from voiz.sim import VoiZChannelSim, random_pkts
+from voiz.sweep import VoiZModemSweep, format_report
+
+LOG_FMT         = '%(asctime)s %(name)-15s %(levelname)-7s %(message)s'
+LOG_DATEFMT     = '%y-%m-%d %H:%M:%S'
+
+def setupLogging(consolelevel=logging.INFO):
+    logging.basicConfig(
+        level   = consolelevel,
+        format  = LOG_FMT,
+        datefmt = LOG_DATEFMT
+    )
+
+def loadConfig():
+    parser = ArgumentParser(description='Simulate the VoiZ modem over a noisy channel, no sound cards needed')
+    parser.add_argument(
+        '-carrier',
+        type=int,
+        help='carrier frequency for digital GFSK',
+        default=2400
+    )
+    parser.add_argument(
+        '-sideband',
+        type=int,
+        help='sideband frequency for digital GFSK',
+        default=2300
+    )
+    parser.add_argument(
+        '-transition',
+        type=int,
+        help='transition frequency for digital GFSK',
+        default=240
+    )
+    parser.add_argument(
+        '-sps',
+        type=int,
+        help='samples/symbol for digital GFSK',
+        default=2
+    )
+    parser.add_argument(
+        '-interpolation',
+        type=int,
+        help='interpolation/decimation for resampler',
+        default=8
+    )
+    parser.add_argument(
+        '-packets',
+        type=int,
+        help='number of packets to send through the channel',
+        default=200
+    )
+    parser.add_argument(
+        '-snr',
+        type=float,
+        help='signal to noise ratio in dB, noiseless if not given',
+        default=None
+    )
+    parser.add_argument(
+        '-freqoffset',
+        type=float,
+        help='carrier frequency offset in Hz',
+        default=0.0
+    )
+    parser.add_argument(
+        '-clockdrift',
+        type=float,
+        help='sample clock drift between the two ends in ppm',
+        default=0.0
+    )
+    parser.add_argument(
+        '-attenuation',
+        type=float,
+        help='channel attenuation in dB',
+        default=0.0
+    )
+    parser.add_argument(
+        '-seed',
+        type=int,
+        help='seed for the packets and channel noise',
+        default=0
+    )
+    parser.add_argument(
+        '-report',
+        type=str,
+        help='file to write the ranked sweep report to',
+        default=None
+    )
+    parser.add_argument(
+        '--sweep',
+        help='sweep the modem parameters instead of simulating one setting',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--verbose',
+        help='print more information',
+        action='store_true'
+    )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    conf = loadConfig()
+
+    setupLogging(logging.DEBUG if conf.verbose else logging.INFO)
+
+    channel = dict(
+        snr_db=conf.snr,
+        freq_offset=conf.freqoffset,
+        clock_drift=conf.clockdrift * 1e-6,
+        attenuation=10 ** (-conf.attenuation / 20.0)
+    )
+
+    if conf.sweep:
+        sweep = VoiZModemSweep(packets=conf.packets, seed=conf.seed, **channel)
+        report = format_report(sweep.run())
+        if conf.report:
+            with open(conf.report, 'w') as f:
+                f.write(report)
+            logging.info('Wrote sweep report to %s', conf.report)
+        print report,
+        raise SystemExit
+
+    sim = VoiZChannelSim(
+        conf.carrier,
+        conf.sideband,
+        conf.transition,
+        conf.sps,
+        conf.interpolation
+    )
+    result = sim.run(
+        random_pkts(conf.packets, seed=conf.seed),
+        seed=conf.seed,
+        **channel
+    )
+    logging.info(
+        'sent %(sent)d, ok %(ok)d, bad crc %(bad_crc)d, missed %(missed)d, PER %(per).3f',
+        result
+    )
+    logging.info(
+        '%(airtime).1fs of airtime in %(elapsed).1fs, %(realtime).1fx realtime',
+        result
+    )
@@ -7,7 +7,12 @@ __status__ = 'prototype'
 import logging
 from argparse import ArgumentParser
 
-from voiz.app import VoiZApp
+from voiz.app import VoiZApp, AUTOTUNE_SNR
+from voiz.gateway import VoiZGateway, load_lines
+from voiz.crypto import DH_EXPONENT_BITS
+from voiz.fec import FEC_CODES, FEC_VOICE, FEC_HANDSHAKE
+from voiz.protocol import HMAC_LEN, MIN_TAG_LEN
+from voiz.framing import PAYLOAD_LEN, MODEMS
 
 LOG_FMT         = '%(asctime)s %(name)-15s %(levelname)-7s %(message)s'
 LOG_DATEFMT     = '%y-%m-%d %H:%M:%S'
@@ -19,7 +24,7 @@ def setupLogging(consolelevel=logging.INFO):
         datefmt = LOG_DATEFMT
     )
 
-def loadConfig():
+def loadConfig(args=None):
     parser = ArgumentParser()
     parser.add_argument(
         '-micdev',
@@ -33,6 +38,24 @@ def loadConfig():
         help='ALSA card/device to use for voice playback',
         default='plughw:0,0'
     )
+    parser.add_argument(
+        '-micfile',
+        type=str,
+        help='stream this raw codec2 file (c2enc output, in the starting mode) instead of capturing from -micdev',
+        default=None
+    )
+    parser.add_argument(
+        '-micspeed',
+        type=float,
+        help='pace -micfile at this multiple of real time, 0 for as fast as the relay takes it',
+        default=1.0
+    )
+    parser.add_argument(
+        '-outfile',
+        type=str,
+        help='record decoded voice to this file as raw 8kHz 16 bit audio instead of playing it on -outdev',
+        default=None
+    )
     parser.add_argument(
         '-lomicdev',
         type=str,
@@ -45,6 +68,12 @@ def loadConfig():
         help='ALSA card/device to use for loopback playback',
         default='plughw:1,1'
     )
+    parser.add_argument(
+        '-modem',
+        choices=MODEMS,
+        help='GFSK modem backend, both work with either at the other end (default: gnuradio)',
+        default='gnuradio'
+    )
     parser.add_argument(
         '-carrier',
         type=int,
@@ -75,6 +104,30 @@ def loadConfig():
         help='interpolation/decimation for resampler',
         default=8
     )
+    parser.add_argument(
+        '-dhbits',
+        type=int,
+        help='length of the private DH exponent in bits',
+        default=DH_EXPONENT_BITS
+    )
+    parser.add_argument(
+        '--keypool',
+        help='persist precomputed DH keypairs for faster startup',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-tunesnr',
+        type=float,
+        help='SNR in dB of the simulated channel --autotune tunes for, not a measurement of the line',
+        default=AUTOTUNE_SNR
+    )
+    parser.add_argument(
+        '--autotune',
+        help='pick the GFSK parameters by simulating a fixed channel at -tunesnr before the call, '
+             'skipping settings over this machine\'s CPU budget; the line itself is not measured, '
+             'and both ends must use the same -tunesnr',
+        action='store_true'
+    )
     parser.add_argument(
         '--verbose',
         help='print more information',
@@ -90,12 +143,79 @@ def loadConfig():
         help='[debug] listen to received audio (uses dev hw:0,0)',
         action='store_true'
     )
+    parser.add_argument(
+        '--varlen',
+        help='send each packet in a frame of its own size instead of padding to %d bytes' % PAYLOAD_LEN,
+        action='store_true'
+    )
+    parser.add_argument(
+        '--fec',
+        help='protect packets with Reed-Solomon codes, implies --varlen, both ends must use it',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-fecvoice',
+        type=int,
+        choices=range(len(FEC_CODES)),
+        help='FEC code for codec2 packets, 0 sends them uncoded',
+        default=FEC_VOICE
+    )
+    parser.add_argument(
+        '-fechandshake',
+        type=int,
+        choices=range(len(FEC_CODES)),
+        help='FEC code for handshake packets, 0 sends them uncoded',
+        default=FEC_HANDSHAKE
+    )
+    parser.add_argument(
+        '--compact',
+        help='offer compact codec2 packets with a short counter, used if the partner offers them too',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-taglen',
+        type=int,
+        choices=range(MIN_TAG_LEN, HMAC_LEN + 1),
+        help='HMAC bytes on compact codec2 packets, the longer of both ends is used',
+        default=HMAC_LEN
+    )
     parser.add_argument(
         '--backoff',
         help='wait between transmissions',
         action='store_true'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '-metricsfile',
+        type=str,
+        help='rewrite this file with JSON stage latencies and counters every 10s',
+        default=None
+    )
+    parser.add_argument(
+        '-metricssocket',
+        type=str,
+        help='serve the JSON metrics to every client connecting to this UNIX socket',
+        default=None
+    )
+    parser.add_argument(
+        '-trace',
+        type=str,
+        help='record every frame sent and received to this file, for replaying the channel with bench.replay',
+        default=None
+    )
+    parser.add_argument(
+        '-lines',
+        type=str,
+        help='gateway mode: serve a call on every line of this table, rows of '
+             '`name micdev outdev lomicdev looutdev initiate|respond`, replacing the device options and --initiate',
+        default=None
+    )
+    parser.add_argument(
+        '-processes',
+        type=int,
+        help='gateway mode: processes in the DH pool shared by all lines (default: one per CPU)',
+        default=None
+    )
+    return parser.parse_args(args)
 
 if __name__ == '__main__':
     # load run configuration
@@ -104,7 +224,10 @@ if __name__ == '__main__':
     setupLogging(logging.DEBUG if conf.verbose else logging.INFO)
 
     logging.info('Starting VoiZ')
-    voiz = VoiZApp(conf)
+    if conf.lines:
+        voiz = VoiZGateway(conf, load_lines(conf.lines))
+    else:
+        voiz = VoiZApp(conf)
     try:
         voiz.run()
     except KeyboardInterrupt:
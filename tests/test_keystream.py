@@ -0,0 +1,60 @@
+'''
+Checks the keystream window against pycryptodome's AES-CTR mode
+
+    python -m unittest discover tests
+'''
+
+import unittest
+from random import Random
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from voiz.crypto import VoiZKeystream, KEYSTREAM_BATCH, KEYSTREAM_BEHIND
+
+KEY = 'k' * 32
+SUFFIX = 's' * 8
+PAYLOAD_LEN = 64
+
+def ctrKeystream(ctr, length):
+    counter = Counter.new(64, suffix=SUFFIX, initial_value=ctr)
+    return AES.new(KEY, AES.MODE_CTR, counter=counter).encrypt('\x00' * length)
+
+class KeystreamTest(unittest.TestCase):
+
+    def assertMatchesCTR(self, ctrs):
+        window = VoiZKeystream(KEY, SUFFIX)
+        for ctr in ctrs:
+            self.assertEqual(window.keystream(ctr, PAYLOAD_LEN), ctrKeystream(ctr, PAYLOAD_LEN), 'counter %d' % ctr)
+
+    def test_in_order(self):
+        step = PAYLOAD_LEN / 16
+        self.assertMatchesCTR([1 + i * step for i in xrange(2000)])
+
+    def test_slide_past_end(self):
+        # jumps of more than KEYSTREAM_BEHIND blocks past the end of a
+        # window that has already slid, where the slide has to clamp
+        # the blocks it keeps to the end of the window
+        end = 2 * KEYSTREAM_BATCH + 1
+        for ctr in xrange(end + KEYSTREAM_BEHIND - 4, end + KEYSTREAM_BATCH + 1):
+            self.assertMatchesCTR([1, KEYSTREAM_BATCH, ctr])
+
+    def test_jumps(self):
+        for jump in xrange(1, 2 * KEYSTREAM_BATCH + KEYSTREAM_BEHIND):
+            self.assertMatchesCTR([1, KEYSTREAM_BATCH, KEYSTREAM_BATCH + jump])
+
+    def test_old_counters(self):
+        for back in xrange(2 * KEYSTREAM_BATCH):
+            self.assertMatchesCTR([1, 4 * KEYSTREAM_BATCH, 4 * KEYSTREAM_BATCH - back])
+
+    def test_random_walk(self):
+        rand = Random(1)
+        ctr = 1
+        ctrs = []
+        for i in xrange(2000):
+            ctr = max(1, ctr + rand.randint(-KEYSTREAM_BATCH, 2 * KEYSTREAM_BATCH))
+            ctrs.append(ctr)
+        self.assertMatchesCTR(ctrs)
+
+if __name__ == '__main__':
+    unittest.main()
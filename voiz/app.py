@@ -1,165 +1,231 @@
 #!/usr/bin/env python
 
 from logging import getLogger
-from time import sleep, time as now
-
-from .c2 import Codec2Source, Codec2Sink
-from .tx import tx_block, PAYLOAD_LEN
-from .rx import rx_block
-from .crypto import VoiZCache, VoiZMAC, InvalidHMACException
+from multiprocessing import Pool
+from time import time as now
+
+from .c2 import Codec2Source, Codec2Sink, Codec2FileSource, Codec2FileSink
+from .dispatch import VoiZDispatcher
+from .fec import VoiZFEC
+from .metrics import VoiZMetrics, VoiZMetricsReporter
+from .proc import gettid
+from .trace import VoiZTraceRecorder
+from .relay import VoiZRelay
+from .session import VoiZLoop, Return, TaskCancelled
+from .crypto import VoiZCache, VoiZKeyPool, VoiZMAC, agreeDH, VOIZ_KEYPOOL_PATH
 from .protocol import *
 
-ZERO = '\x00'
 DELAY = 0.2
 TIMEOUT = 15.0
 BACKOFF = range(5)
+RELAY_STATS_INTERVAL = 10.0
+EXECUTOR_PROCESSES = 1
+AUTOTUNE_SNR = 20.0
 
 class VoiZApp():
 
-    def __init__(self, conf):
+    def __init__(self, conf, pool=None, cache=None, keypool=None, metrics=None):
+        '''
+        A gateway runs many apps and hands each the same pool, cache,
+        keypool and metrics, which are then left for it to shut down
+        '''
         self.logger = getLogger('app')
         self.conf = conf
-        self.cache = VoiZCache()
+        self.reporter = None
+        if metrics is None:
+            metrics = VoiZMetrics(bool(conf.metricsfile or conf.metricssocket))
+            if metrics.enabled:
+                self.reporter = VoiZMetricsReporter(metrics, conf.metricsfile, conf.metricssocket)
+        self.metrics = metrics
+        self.cache = cache or VoiZCache()
         self.logger.info('Using ZID = 0x%s', self.cache.getZID().encode('hex'))
-        self.mac = VoiZMAC()
+        self.owns_pool = pool is None
+        self.owns_keypool = keypool is None
+        # fork the DH workers before any other thread is running
+        self.pool = pool or Pool(EXECUTOR_PROCESSES)
+        # start computing DH keypairs while the flowgraphs come up
+        if self.owns_keypool:
+            keypool = VoiZKeyPool(
+                conf.dhbits,
+                path=VOIZ_KEYPOOL_PATH if conf.keypool else None,
+                pool=self.pool
+            )
+            keypool.start()
+        self.keypool = keypool
+        self.mac = VoiZMAC(self.keypool, conf.dhbits)
         # instantiate packet factory
-        self.pkt_factory = VoiZPacketFactory(self.cache, self.mac)
-
-        self.send_until_pkt = self._send_until_pkt_backoff if conf.backoff else self._send_until_pkt
+        self.pkt_factory = VoiZPacketFactory(self.cache, self.mac, metrics)
+        self.pkt_factory.offer_voice_format(conf.compact, conf.taglen)
 
-    def send(self, send_pkt, count=1):
-        send_pkt = send_pkt.ljust(PAYLOAD_LEN, ZERO)
+        # retransmission pattern for handshake packets
+        if conf.backoff:
+            self.copies, self.period = 3, len(BACKOFF) * DELAY
+        else:
+            self.copies, self.period = 1, DELAY
+        self.running = True
+        self.loop = None
+        self.relay = None
+        self.phases = metrics.phases('handshake')
+        # kernel IDs of the threads working for this call, for CPU accounting
+        self.tids = set()
+
+    def send(self, send_pkt):
         self.tx.send_pkt(send_pkt)
-        count -= 1
-        while count > 0:
-            sleep(DELAY)
+
+    def repeat(self, send_pkt, count):
+        for i in xrange(count):
+            if i:
+                yield self.loop.sleep(DELAY)
             self.tx.send_pkt(send_pkt)
-            count -= 1
 
-    def _send_until_pkt(self, send_pkts, recv_pkt_id, wait_forever=False):
-        send_pkts = [pkt.ljust(PAYLOAD_LEN, ZERO) for pkt in send_pkts]
-        attempts = len(send_pkts) * TIMEOUT / DELAY
-        while wait_forever or attempts > 0:
-            for send_pkt in send_pkts:
-                self.tx.send_pkt(send_pkt)
-                # look for received packet
-                recv_pkt = self.rx.recv_pkt()
-                if recv_pkt:
-                    pkt_id = ord(recv_pkt[0])
-                    if pkt_id == recv_pkt_id:
-                        return recv_pkt
-                    self.logger.debug('Received unanticipated packet: 0x%s', pkt_id)
-                sleep(DELAY)
-                attempts -= 1
-
-    def _send_until_pkt_backoff(self, send_pkts, recv_pkt_id, wait_forever=False):
-        send_pkts = [pkt.ljust(PAYLOAD_LEN, ZERO) for pkt in send_pkts]
-        attempts = len(send_pkts) * TIMEOUT / DELAY
-        while wait_forever or attempts > 0:
+    def retransmit(self, send_pkts):
+        '''
+        Keeps sending packets in turn until cancelled
+        '''
+        while True:
             for send_pkt in send_pkts:
-                self.tx.send_pkt(send_pkt)
-                self.tx.send_pkt(send_pkt)
-                self.tx.send_pkt(send_pkt)
-                for i in BACKOFF:
-                    # look for received packet
-                    recv_pkt = self.rx.recv_pkt()
-                    if recv_pkt:
-                        pkt_id = ord(recv_pkt[0])
-                        if pkt_id == recv_pkt_id:
-                            return recv_pkt
-                        self.logger.debug('Received unanticipated packet: 0x%s', pkt_id)
-                    sleep(DELAY)
-                attempts -= 1
-
-    def wait_until_pkt(self, recv_pkt_id, wait_forever=False):
-        attempts = TIMEOUT / DELAY
-        while wait_forever or attempts > 0:
-            recv_pkt = self.rx.recv_pkt()
+                for i in xrange(self.copies):
+                    self.tx.send_pkt(send_pkt)
+                yield self.loop.sleep(self.period)
+
+    def exchange(self, send_pkts, recv_pkt_ids, wait_forever=False):
+        '''
+        Retransmits send_pkts until a packet with one of recv_pkt_ids comes
+        back, returns None if none does in time
+        '''
+        retransmit = self.loop.spawn(self.retransmit(send_pkts))
+        try:
+            recv_pkt = yield self.loop.expect(recv_pkt_ids, None if wait_forever else len(send_pkts) * TIMEOUT)
+        finally:
+            retransmit.cancel()
+        raise Return(recv_pkt)
+
+    def send_fragments_until_pkt(self, frag_pkts, recv_pkt_ids):
+        first_id = ord(frag_pkts[0][0])
+        frags = dict((ord(pkt[0]), pkt) for pkt in frag_pkts)
+        resend_ids = sorted(frags)
+        deadline = now() + len(frags) * TIMEOUT
+        while now() < deadline:
+            self.logger.debug('Sending %d of %d fragments', len(resend_ids), len(frags))
+            for pkt_id in resend_ids:
+                self.tx.send_pkt(frags[pkt_id])
+            # give the burst and a reply time on air before sending it all again
+            recv_pkt = yield self.loop.expect(
+                recv_pkt_ids + (PKT_DHPARTNACK,),
+                sum(self.tx.airtime(len(frags[pkt_id]), pkt_id) for pkt_id in resend_ids) +
+                self.tx.airtime() + DELAY
+            )
+            resend_ids = sorted(frags)
+            if not recv_pkt:
+                continue
+            if ord(recv_pkt[0]) != PKT_DHPARTNACK:
+                raise Return(recv_pkt)
+            # only resend what the partner reports missing
+            nack_first_id, missing_ids = self.pkt_factory.dct_pkt_dhpartnack(recv_pkt)
+            if nack_first_id == first_id and missing_ids:
+                resend_ids = missing_ids
+
+    def wait_fragments(self, first_id, recv_pkt):
+        fragments = VoiZFragmentBuffer(first_id)
+        fragments.add(recv_pkt)
+        deadline = now() + TIMEOUT
+        while not fragments.complete():
+            missing_ids = fragments.missing()
+            # the rest of a burst arrives back to back, so a gap means loss
+            recv_pkt = yield self.loop.expect(missing_ids, 2 * self.tx.airtime() + DELAY)
             if recv_pkt:
-                pkt_id = ord(recv_pkt[0])
-                if pkt_id == recv_pkt_id:
-                    return recv_pkt
-                self.logger.debug('Received unanticipated packet: 0x%s', pkt_id)
-            sleep(DELAY)
-            attempts -= 1
+                fragments.add(recv_pkt)
+                continue
+            if now() > deadline:
+                raise Return(None)
+            self.logger.debug('Requesting %d missing fragments', len(missing_ids))
+            self.send(self.pkt_factory.gen_pkt_dhpartnack(first_id, missing_ids))
+        raise Return(fragments)
+
+    def computeSecret(self, zidi, zidr):
+        # the modular exponentiation would hold the GIL for the whole time
+        dhresult = yield self.loop.run_in_executor(agreeDH, self.mac.dhpub2, self.mac.dhpriv)
+        self.mac.computeSecret(zidi, zidr, dhresult)
+
+    def checkRetainedSecrets(self, zid, role, rs1id, rs2id):
+        rs = self.cache.getRetainedSecret(zid)
+        if not rs:
+            return
+        if self.mac.retainedSecretID(rs, role) in (rs1id, rs2id):
+            self.logger.debug('Partner holds our retained secret')
+            return
+        self.logger.warning('Partner does not hold our retained secret')
 
     def _initiate(self):
         self.logger.debug('Starting initiation procedure...')
 
         self.logger.debug('Sending packet: PKT_HELLO')
         pkt_hello = self.pkt_factory.gen_pkt_hello()
-        rhello_pkt = self.send_until_pkt([pkt_hello], PKT_HELLO)
+        rhello_pkt = yield self.exchange([pkt_hello], PKT_HELLO)
         if not rhello_pkt:
             self.logger.warning('Timeout reached')
-            return False
+            raise Return(False)
+        self.phases.mark('hello')
         self.logger.debug('Received packet: PKT_HELLO')
         # dissect fields
         (   rh3,
             rzid,
+            rflags,
             rhellohmac
         ) = self.pkt_factory.dct_pkt_hello(rhello_pkt)
         self.logger.debug('Responder ZID: 0x%s', rzid.encode('hex'))
+        self.pkt_factory.accept_voice_format(rflags)
 
-        # prepare commit packet
-        icommit_pkt = self.pkt_factory.gen_pkt_commit()
-        self.logger.debug('Sending packet: PKT_COMMIT')
-        rdhpart11_pkt = self.send_until_pkt([icommit_pkt], PKT_DHPART11)
-        if not rdhpart11_pkt:
-            self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART11')
-        rdhpart12_pkt = self.wait_until_pkt(PKT_DHPART12)
-        if not rdhpart12_pkt:
-            self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART12')
-        rdhpart13_pkt = self.wait_until_pkt(PKT_DHPART13)
-        if not rdhpart13_pkt:
-            self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART13')
-        rdhpart14_pkt = self.wait_until_pkt(PKT_DHPART14)
-        if not rdhpart14_pkt:
+        # prepare commit packet, offering to resume if we retained a secret
+        rs1 = self.cache.getRetainedSecret(rzid)
+        if rs1:
+            icommit_pkt = self.pkt_factory.gen_pkt_commitps(rs1)
+            self.logger.debug('Sending packet: PKT_COMMITPS')
+        else:
+            icommit_pkt = self.pkt_factory.gen_pkt_commit()
+            self.logger.debug('Sending packet: PKT_COMMIT')
+        rreply_pkt = yield self.exchange([icommit_pkt], PKTS_DHPART1 + (PKT_CONFIRM1,))
+        if not rreply_pkt:
             self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART14')
-        rdhpart15_pkt = self.wait_until_pkt(PKT_DHPART15)
-        if not rdhpart15_pkt:
+            raise Return(False)
+        self.phases.mark('commit')
+        if ord(rreply_pkt[0]) == PKT_CONFIRM1:
+            self.logger.debug('Received packet: PKT_CONFIRM1')
+            raise Return((yield self._initiate_resumed(rhello_pkt, rh3, rzid, rhellohmac, icommit_pkt, rreply_pkt, rs1)))
+        rdhpart1 = yield self.wait_fragments(PKT_DHPART11, rreply_pkt)
+        if not rdhpart1:
             self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART15')
+            raise Return(False)
+        self.phases.mark('dhpart1')
+        self.logger.debug('Received packets for DH-part1')
         # dissect fields
         (   rh1,
             rs1iDr,
             rs2iDr,
             pvr,
             dhpart1mac
-        ) = self.pkt_factory.dct_pkts_dhpart1(
-            rdhpart11_pkt[:64] +
-            rdhpart12_pkt[1:64] +
-            rdhpart13_pkt[1:64] +
-            rdhpart14_pkt[1:64] +
-            rdhpart15_pkt[1:61]
-        )
+        ) = self.pkt_factory.dct_pkts_dhpart1(rdhpart1.payload())
         # verify original HELLO packet
         rh2 = self.mac.getHash(rh1)
-        if not self.mac.verifyPacketHMAC(rh2, rhello_pkt[:45], rhellohmac):
+        if not self.mac.verifyPacketHMAC(rh2, rhello_pkt[:HELLO_LEN - HMAC_LEN], rhellohmac):
             self.logger.error('HMAC failed in responders HELLO packet')
-            return False
+            raise Return(False)
         self.logger.debug('Valid HMAC in HELLO packet')
         # verify hash chain components
         if not self.mac.verifyHash(rh2, rh3):
             self.logger.error('Hash chain verification failed: sha256(h2) != h3')
-            return False
+            raise Return(False)
         self.logger.debug('Hash chain verification success: sha256(h2) == h3')
+        self.checkRetainedSecrets(rzid, 'Responder', rs1iDr, rs2iDr)
 
-        dhpart2_pkts = self.pkt_factory.gen_pkts_dhpart2()
+        dhpart2_pkts = yield self.loop.run_in_thread(self.pkt_factory.gen_pkts_dhpart2, rzid)
         # prepare dhpart2 packets
         self.logger.debug('Sending packets for DH-part2')
-        rconfirm1_pkt = self.send_until_pkt(dhpart2_pkts, PKT_CONFIRM1)
+        rconfirm1_pkt = yield self.send_fragments_until_pkt(dhpart2_pkts, (PKT_CONFIRM1,))
         if not rconfirm1_pkt:
             self.logger.warning('Timeout reached')
-            return False
+            raise Return(False)
+        self.phases.mark('dhpart2')
         self.logger.debug('Received packet: PKT_CONFIRM1')
         # dissect fields
         (   rconfirm_mac,
@@ -169,164 +235,204 @@ class VoiZApp():
         # set parameters
         self.mac.setPartnerPublicKey(pvr)
         self.mac.setPackets(
-            rhello_pkt[:53] +
+            rhello_pkt[:HELLO_LEN] +
             icommit_pkt +
-            rdhpart11_pkt[:64] +
-            rdhpart12_pkt[:64] +
-            rdhpart13_pkt[:64] +
-            rdhpart14_pkt[:64] +
-            rdhpart15_pkt[:61] +
+            ''.join(rdhpart1.pkts()) +
             ''.join(dhpart2_pkts)
         )
-        self.mac.computeSecret(self.cache.getZID(), rzid)
+        yield self.computeSecret(self.cache.getZID(), rzid)
+        self.phases.mark('secret')
         # determine keys
-        self.mac.startEncryption(
-            self.mac.hmac_s0('Initiator ZRTP key'),
-            self.mac.hmac_s0('Responder ZRTP key')
-        )
+        self.mac.startEncryption('Initiator')
 
         # verify confirm1 packet
-        rconfirmmackey = self.mac.hmac_s0('Responder HMAC key')
-        if not self.mac.verifyPacketHMAC(rconfirmmackey, rh0_enc, rconfirm_mac):
+        if not self.mac.verifySessionMAC('Responder HMAC key', rh0_enc, rconfirm_mac):
             self.logger.error('HMAC failed in responders CONFIRM1 packet')
-            return False
+            raise Return(False)
         self.logger.debug('Valid HMAC in CONFIRM1 packet')
         # decrypt rh0
         rh0 = self.mac.decrypt(rh0_enc)
         # verify DHPART1 packet mac
         if not self.mac.verifyHash(rh0, rh1):
             self.logger.error('Hash chain verification failed: sha256(h0) != h1')
-            return False
+            raise Return(False)
         self.logger.debug('Hash chain verification success: sha256(h0) == h1')
 
         # prepare dhconfirm2 packet
         iconfirm2_pkt = self.pkt_factory.gen_pkt_confirm2()
         self.logger.debug('Sending packets for CONFIRM2')
-        self.send(iconfirm2_pkt, 10)
+        yield self.repeat(iconfirm2_pkt, 10)
+        self.phases.mark('confirm')
+
+        self.cache.setRetainedSecret(rzid, self.mac.retainedSecret())
+        raise Return(True)
+
+    def _initiate_resumed(self, rhello_pkt, rh3, rzid, rhellohmac, icommit_pkt, rconfirm1_pkt, rs):
+        self.logger.debug('Resuming from retained secret...')
+        # dissect fields
+        (   rconfirm_mac,
+            rh0_enc
+        ) = self.pkt_factory.dct_pkt_confirm1(rconfirm1_pkt)
+
+        # set parameters
+        self.mac.setPackets(
+            rhello_pkt[:HELLO_LEN] +
+            icommit_pkt
+        )
+        self.mac.computeResumedSecret(rs, self.cache.getZID(), rzid)
+        # determine keys
+        self.mac.startEncryption('Initiator')
+
+        # verify confirm1 packet
+        if not self.mac.verifySessionMAC('Responder HMAC key', rh0_enc, rconfirm_mac):
+            self.logger.error('HMAC failed in responders CONFIRM1 packet')
+            raise Return(False)
+        self.logger.debug('Valid HMAC in CONFIRM1 packet')
+        # decrypt rh0, no DH-part revealed h1 so walk the chain up from here
+        rh0 = self.mac.decrypt(rh0_enc)
+        rh2 = self.mac.getHash(self.mac.getHash(rh0))
+        # verify original HELLO packet
+        if not self.mac.verifyPacketHMAC(rh2, rhello_pkt[:HELLO_LEN - HMAC_LEN], rhellohmac):
+            self.logger.error('HMAC failed in responders HELLO packet')
+            raise Return(False)
+        self.logger.debug('Valid HMAC in HELLO packet')
+        # verify hash chain components
+        if not self.mac.verifyHash(rh2, rh3):
+            self.logger.error('Hash chain verification failed: sha256(h2) != h3')
+            raise Return(False)
+        self.logger.debug('Hash chain verification success: sha256(h2) == h3')
+
+        # prepare dhconfirm2 packet
+        iconfirm2_pkt = self.pkt_factory.gen_pkt_confirm2()
+        self.logger.debug('Sending packets for CONFIRM2')
+        yield self.repeat(iconfirm2_pkt, 10)
+        self.phases.mark('confirm')
 
-        return True
+        self.cache.setRetainedSecret(rzid, self.mac.retainedSecret())
+        raise Return(True)
 
     def _respond(self):
         self.logger.debug('Starting response procedure...')
 
-        ihello_pkt = self.wait_until_pkt(PKT_HELLO, True)
+        ihello_pkt = yield self.loop.expect(PKT_HELLO)
         if not ihello_pkt:
             self.logger.warning('Timeout reached')
-            return False
+            raise Return(False)
+        # time the handshake from when the initiator calls
+        self.phases.restart()
         self.logger.debug('Received packet: PKT_HELLO')
         # dissect fields
         (   ih3,
             izid,
+            iflags,
             ihellohmac
         ) = self.pkt_factory.dct_pkt_hello(ihello_pkt)
         self.logger.debug('Initiator ZID: 0x%s', izid.encode('hex'))
+        self.pkt_factory.accept_voice_format(iflags)
 
         # prepare hello packet
         rhello_pkt = self.pkt_factory.gen_pkt_hello()
         # wait for commitment
         self.logger.debug('Sending packet: PKT_HELLO')
-        icommit_pkt = self.send_until_pkt([rhello_pkt], PKT_COMMIT)
+        icommit_pkt = yield self.exchange([rhello_pkt], (PKT_COMMIT, PKT_COMMITPS))
         if not icommit_pkt:
             self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_COMMIT')
+            raise Return(False)
+        self.phases.mark('commit')
         # dissect fields
-        (   ih2,
-            izid2,
-            icounter_suffix,
-            icommithmac
-        ) = self.pkt_factory.dct_pkt_commit(icommit_pkt)
+        if ord(icommit_pkt[0]) == PKT_COMMITPS:
+            self.logger.debug('Received packet: PKT_COMMITPS')
+            (   ih2,
+                izid2,
+                icounter_suffix,
+                irsid,
+                inonce,
+                icommithmac
+            ) = self.pkt_factory.dct_pkt_commitps(icommit_pkt)
+            icommit_pkt = icommit_pkt[:COMMITPS_LEN]
+        else:
+            self.logger.debug('Received packet: PKT_COMMIT')
+            (   ih2,
+                izid2,
+                icounter_suffix,
+                icommithmac
+            ) = self.pkt_factory.dct_pkt_commit(icommit_pkt)
+            irsid = None
+            icommit_pkt = icommit_pkt[:COMMIT_LEN]
         assert izid == izid2
         # verify original HELLO packet
-        if not self.mac.verifyPacketHMAC(ih2, ihello_pkt[:45], ihellohmac):
+        if not self.mac.verifyPacketHMAC(ih2, ihello_pkt[:HELLO_LEN - HMAC_LEN], ihellohmac):
             self.logger.error('HMAC failed in initiators HELLO packet')
-            return False
+            raise Return(False)
         self.logger.debug('Valid HMAC in HELLO packet')
         # verify hash chain components
         if not self.mac.verifyHash(ih2, ih3):
             self.logger.error('Hash chain verification failed: sha256(h2) != h3')
-            return False
+            raise Return(False)
         self.logger.debug('Hash chain verification success: sha256(h2) == h3')
         self.mac.setCounterSuffix(icounter_suffix)
 
+        # resume if the initiator offered a secret we retained as well
+        if irsid:
+            rs = self.cache.getRetainedSecret(izid)
+            if rs and self.mac.retainedSecretID(rs, 'Initiator') == irsid:
+                raise Return((yield self._respond_resumed(rhello_pkt, izid, icommit_pkt, ih2, icommithmac, rs)))
+            self.logger.info('No matching retained secret, falling back to DH')
+
         # prepare dhpart1 packets
-        dhpart1_pkts = self.pkt_factory.gen_pkts_dhpart1()
+        dhpart1_pkts = yield self.loop.run_in_thread(self.pkt_factory.gen_pkts_dhpart1, izid)
         self.logger.debug('Sending packets for DH-part1')
-        idhpart21_pkt = self.send_until_pkt(dhpart1_pkts, PKT_DHPART21)
-        if not idhpart21_pkt:
-            self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART21')
-        idhpart22_pkt = self.wait_until_pkt(PKT_DHPART22)
-        if not idhpart22_pkt:
-            self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART22')
-        idhpart23_pkt = self.wait_until_pkt(PKT_DHPART23)
-        if not idhpart23_pkt:
+        idhpart2_pkt = yield self.send_fragments_until_pkt(dhpart1_pkts, PKTS_DHPART2)
+        if not idhpart2_pkt:
             self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART23')
-        idhpart24_pkt = self.wait_until_pkt(PKT_DHPART24)
-        if not idhpart24_pkt:
+            raise Return(False)
+        self.phases.mark('dhpart1')
+        idhpart2 = yield self.wait_fragments(PKT_DHPART21, idhpart2_pkt)
+        if not idhpart2:
             self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART24')
-        idhpart25_pkt = self.wait_until_pkt(PKT_DHPART25)
-        if not idhpart25_pkt:
-            self.logger.warning('Timeout reached')
-            return False
-        self.logger.debug('Received packet: PKT_DHPART25')
+            raise Return(False)
+        self.phases.mark('dhpart2')
+        self.logger.debug('Received packets for DH-part2')
         # dissect fields
         (   ih1,
             rs1iDi,
             rs2iDi,
             pvi,
             dhpart2mac
-        ) = self.pkt_factory.dct_pkts_dhpart1(
-            idhpart21_pkt[:64] +
-            idhpart22_pkt[1:64] +
-            idhpart23_pkt[1:64] +
-            idhpart24_pkt[1:64] +
-            idhpart25_pkt[1:61]
-        )
+        ) = self.pkt_factory.dct_pkts_dhpart1(idhpart2.payload())
         # verify COMMIT packet
-        if not self.mac.verifyPacketHMAC(ih1, icommit_pkt[:53], icommithmac):
+        if not self.mac.verifyPacketHMAC(ih1, icommit_pkt[:-8], icommithmac):
             self.logger.error('HMAC failed in initiators COMMIT packet')
-            return False
+            raise Return(False)
         self.logger.debug('Valid HMAC in COMMIT packet')
         # verify hash chain components
         if not self.mac.verifyHash(ih1, ih2):
             self.logger.error('Hash chain verification failed: sha256(h1) != h2')
-            return False
+            raise Return(False)
         self.logger.debug('Hash chain verification success: sha256(h1) == h2')
+        self.checkRetainedSecrets(izid, 'Initiator', rs1iDi, rs2iDi)
 
         # set parameters
         self.mac.setPartnerPublicKey(pvi)
         self.mac.setPackets(
             rhello_pkt +
-            icommit_pkt[:61] +
+            icommit_pkt +
             ''.join(dhpart1_pkts) +
-            idhpart21_pkt[:64] +
-            idhpart22_pkt[:64] +
-            idhpart23_pkt[:64] +
-            idhpart24_pkt[:64] +
-            idhpart25_pkt[:61]
+            ''.join(idhpart2.pkts())
         )
-        self.mac.computeSecret(izid, self.cache.getZID())
+        yield self.computeSecret(izid, self.cache.getZID())
+        self.phases.mark('secret')
         # determine keys
-        self.mac.startEncryption(
-            self.mac.hmac_s0('Responder ZRTP key'),
-            self.mac.hmac_s0('Initiator ZRTP key')
-        )
+        self.mac.startEncryption('Responder')
 
         # wait for confirm2
         rconfirm1_pkt = self.pkt_factory.gen_pkt_confirm1()
         self.logger.debug('Sending packet: PKT_CONFIRM1')
-        iconfirm2_pkt = self.send_until_pkt([rconfirm1_pkt], PKT_CONFIRM2)
+        iconfirm2_pkt = yield self.exchange([rconfirm1_pkt], PKT_CONFIRM2)
         if not iconfirm2_pkt:
             self.logger.warning('Timeout reached')
-            return False
+            raise Return(False)
+        self.phases.mark('confirm')
         self.logger.debug('Received packet: PKT_CONFIRM2')
         # dissect fields
         (   iconfirm_mac,
@@ -334,82 +440,210 @@ class VoiZApp():
         ) = self.pkt_factory.dct_pkt_confirm1(iconfirm2_pkt)
 
         # verify confirm2 packet
-        iconfirmmackey = self.mac.hmac_s0('Initiator HMAC key')
-        if not self.mac.verifyPacketHMAC(iconfirmmackey, ih0_enc, iconfirm_mac):
+        if not self.mac.verifySessionMAC('Initiator HMAC key', ih0_enc, iconfirm_mac):
             self.logger.error('HMAC failed in initiators CONFIRM2 packet')
-            return False
+            raise Return(False)
         self.logger.debug('Valid HMAC in CONFIRM2 packet')
         # decrypt ih0
         ih0 = self.mac.decrypt(ih0_enc)
         # verify DHPART2 packet mac
         if not self.mac.verifyHash(ih0, ih1):
             self.logger.error('Hash chain verification failed: sha256(h0) != h1')
-            return False
+            raise Return(False)
         self.logger.debug('Hash chain verification success: sha256(h0) == h1')
 
-        return True
-
-    def relayAudio(self):
-        t0 = now()
-        d = 0
-        with Codec2Source(self.conf.micdev) as voice_src:
-            with Codec2Sink(self.conf.outdev) as voice_sink:
-                src_samples = ''
-                for c2sample in voice_src.read():
-                    # send mic input
-                    if c2sample:
-                        src_samples += c2sample
-                        if len(src_samples) >= 63:
-                            self.send(self.pkt_factory.gen_pkt_codec2(src_samples[:63]))
-                            src_samples = src_samples[63:]
-                    # check for received audio
-                    recv_pkt = self.rx.recv_pkt()
-                    if recv_pkt and recv_pkt[0] == PKT_CODEC2_CHR:
-                        d += len(recv_pkt)
-                        print d / (now() - t0)
-                        try:
-                            c2data = self.pkt_factory.dct_pkt_codec2(recv_pkt)
-                            voice_sink.write(c2data)
-                        except InvalidHMACException:
-                            self.logger.error('Bad HMAC in codec2 data packet')
-                    #else:
-                    #    print 'writing silence...'
-                    #    voice_sink.write_silence()
-
-    def run(self):
-        # setup tx and rx classes
+        self.cache.setRetainedSecret(izid, self.mac.retainedSecret())
+        raise Return(True)
+
+    def _respond_resumed(self, rhello_pkt, izid, icommit_pkt, ih2, icommithmac, rs):
+        self.logger.debug('Resuming from retained secret...')
+        # set parameters
+        self.mac.setPackets(
+            rhello_pkt +
+            icommit_pkt
+        )
+        self.mac.computeResumedSecret(rs, izid, self.cache.getZID())
+        # determine keys
+        self.mac.startEncryption('Responder')
+
+        # wait for confirm2
+        rconfirm1_pkt = self.pkt_factory.gen_pkt_confirm1()
+        self.logger.debug('Sending packet: PKT_CONFIRM1')
+        iconfirm2_pkt = yield self.exchange([rconfirm1_pkt], PKT_CONFIRM2)
+        if not iconfirm2_pkt:
+            self.logger.warning('Timeout reached')
+            raise Return(False)
+        self.phases.mark('confirm')
+        self.logger.debug('Received packet: PKT_CONFIRM2')
+        # dissect fields
+        (   iconfirm_mac,
+            ih0_enc
+        ) = self.pkt_factory.dct_pkt_confirm1(iconfirm2_pkt)
+
+        # verify confirm2 packet
+        if not self.mac.verifySessionMAC('Initiator HMAC key', ih0_enc, iconfirm_mac):
+            self.logger.error('HMAC failed in initiators CONFIRM2 packet')
+            raise Return(False)
+        self.logger.debug('Valid HMAC in CONFIRM2 packet')
+        # decrypt ih0, no DH-part revealed h1 so derive it here
+        ih1 = self.mac.getHash(self.mac.decrypt(ih0_enc))
+        # verify COMMIT packet
+        if not self.mac.verifyPacketHMAC(ih1, icommit_pkt[:-8], icommithmac):
+            self.logger.error('HMAC failed in initiators COMMIT packet')
+            raise Return(False)
+        self.logger.debug('Valid HMAC in COMMIT packet')
+        # verify hash chain components
+        if not self.mac.verifyHash(ih1, ih2):
+            self.logger.error('Hash chain verification failed: sha256(h1) != h2')
+            raise Return(False)
+        self.logger.debug('Hash chain verification success: sha256(h1) == h2')
+
+        self.cache.setRetainedSecret(izid, self.mac.retainedSecret())
+        raise Return(True)
+
+    def open_voice(self):
+        conf = self.conf
+        if conf.micfile:
+            voice_src = Codec2FileSource(conf.micfile, speed=conf.micspeed, metrics=self.metrics)
+        else:
+            voice_src = Codec2Source(conf.micdev, metrics=self.metrics)
+        if conf.outfile:
+            voice_sink = Codec2FileSink(
+                conf.outfile,
+                self.pkt_factory.codec2_ctr_step,
+                room=self.pkt_factory.codec2_room,
+                metrics=self.metrics
+            )
+        else:
+            voice_sink = Codec2Sink(
+                conf.outdev,
+                self.pkt_factory.codec2_ctr_step,
+                room=self.pkt_factory.codec2_room,
+                metrics=self.metrics
+            )
+        return voice_src, voice_sink
+
+    def relayAudio(self, open_voice=None):
+        '''
+        Relays voice until the call ends. `open_voice` returns a source and
+        sink to use instead of the sound cards, it is called once the voice
+        format is settled
+        '''
+        voice_src, voice_sink = (open_voice or self.open_voice)()
+        with voice_src:
+            with voice_sink:
+                relay = self.relay = VoiZRelay(self, voice_src, voice_sink)
+                relay.start()
+                try:
+                    while self.running and relay.wait(RELAY_STATS_INTERVAL):
+                        self.logger.debug('Relay queues: %r, dropped: %r', relay.depths(), relay.dropped())
+                finally:
+                    relay.stop()
+
+    def autotune(self):
+        # the simulator runs the GNU Radio modem, only load it when asked
+        from .sweep import autotune, MODEM_PARAMS
+        self.logger.info('Tuning modem parameters for %.1fdB SNR...', self.conf.tunesnr)
+        best = autotune(self.conf.tunesnr)
+        if not best:
+            self.logger.warning('No usable modem setting found, keeping the configured one')
+            return
+        for param in MODEM_PARAMS:
+            setattr(self.conf, param, best[param])
+        self.logger.info(
+            'Using carrier %(carrier)d, sideband %(sideband)d, transition %(transition)d, '
+            'sps %(sps)d, interpolation %(interpolation)d',
+            best
+        )
+
+    def open_flowgraphs(self, fec, recorder):
+        # import only the backend in use, GNU Radio takes a while to load
+        if self.conf.modem == 'numpy':
+            from .npmodem import np_tx_block as tx_block, np_rx_block as rx_block
+        else:
+            from .tx import tx_block
+            from .rx import rx_block
         self.logger.debug('Instantiating tx block...')
-        self.tx = tx_block(
+        tx = tx_block(
             self.conf.carrier,
             self.conf.sideband,
             self.conf.transition,
             self.conf.sps,
             self.conf.interpolation,
-            self.conf.looutdev
+            self.conf.looutdev,
+            self.conf.varlen or self.conf.fec,
+            fec,
+            recorder
         )
         self.logger.debug('Instantiating rx block...')
-        self.rx = rx_block(
+        rx = rx_block(
             self.conf.carrier,
             self.conf.sideband,
             self.conf.transition,
             self.conf.sps,
             self.conf.interpolation,
             self.conf.lomicdev,
-            self.conf.listen
+            self.conf.listen,
+            fec,
+            recorder
         )
+        return tx, rx
+
+    def run(self, open_transport=None, open_voice=None):
+        '''
+        Makes one call. `open_transport` takes the FEC and trace recorder
+        and returns a (tx, rx) pair to use instead of the flowgraphs,
+        `open_voice` is handed on to relayAudio
+        '''
+        self.tids.add(gettid())
+        if self.conf.autotune:
+            self.autotune()
+        fec = VoiZFEC(self.conf.fecvoice, self.conf.fechandshake) if self.conf.fec else None
+        recorder = VoiZTraceRecorder(self.conf.trace) if self.conf.trace else None
+        # setup tx and rx classes
+        self.tx, self.rx = (open_transport or self.open_flowgraphs)(fec, recorder)
+
+        self.dispatcher = VoiZDispatcher(self.rx)
+        self.loop = VoiZLoop(self.dispatcher, self.pool)
 
         self.rx.start()
         self.tx.start()
-
-        if self.conf.initiate:
-            # initiate communication
-            proceed = self._initiate()
-        else:
-            proceed = self._respond()
-
-        if proceed:
-            self.logger.info('Authentication successful, starting voice relay...')
-            self.relayAudio()
-
-        self.tx.stop()
-        self.rx.stop()
+        self.dispatcher.start()
+
+        if self.reporter:
+            self.reporter.start()
+        try:
+            if self.conf.initiate:
+                # initiate communication
+                proceed = self.loop.run_until_complete(self._initiate())
+            else:
+                proceed = self.loop.run_until_complete(self._respond())
+            self.phases.done(proceed)
+
+            if proceed and self.running:
+                self.logger.info('Authentication successful, starting voice relay...')
+                self.relayAudio(open_voice)
+        except TaskCancelled:
+            self.logger.info('Handshake cancelled')
+        finally:
+            self.dispatcher.stop()
+            if self.owns_keypool:
+                self.keypool.stop()
+            if self.owns_pool:
+                self.pool.terminate()
+            self.tx.stop()
+            self.rx.stop()
+            if self.reporter:
+                self.reporter.stop()
+            if recorder:
+                recorder.close()
+
+    def stop(self):
+        '''
+        Ends the call from another thread, run() then returns
+        '''
+        self.running = False
+        if self.loop:
+            self.loop.stop()
+        if self.relay:
+            self.relay.stopped.set()
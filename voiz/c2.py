@@ -1,30 +1,137 @@
 #!/usr/bin/env python
 
-from os import O_NONBLOCK
+from errno import EAGAIN
+from os import O_NONBLOCK, urandom, pipe, read, write, close
+from audioop import mul
 from fcntl import fcntl, F_GETFL, F_SETFL
+from select import POLLIN
 from subprocess import Popen, PIPE
 from logging import getLogger
+from threading import Thread, Event
 from time import time as now
+from ctypes import CDLL, c_void_p, c_int, c_char_p, create_string_buffer
+from ctypes.util import find_library
 
 import alsaaudio
 
+from .jitter import VoiZJitterBuffer, BUFFERING
+from .metrics import VoiZMetrics
+from .protocol import CODEC2_PAYLOAD_LEN
+
 CODEC2ENC_PATH = '/home/j/codec2/build_linux/src/c2enc'
 CODEC2DEC_PATH = '/home/j/codec2/build_linux/src/c2dec'
+CODEC2_LIB_PATH = find_library('codec2')
 CODEC2_MODE = 1400   # can be any of 3200|2400|1600|1400|1300|1200
 
+# CODEC2_MODE_* constants from codec2.h
+CODEC2_LIB_MODES = {
+    3200:   0,
+    2400:   1,
+    1600:   2,
+    1400:   3,
+    1300:   4,
+    1200:   5,
+}
+
+# bytes and samples per frame for each mode
+CODEC2_FRAMES = {
+    3200:   (8, 160),
+    2400:   (6, 160),
+    1600:   (8, 320),
+    1400:   (7, 320),
+    1300:   (7, 320),
+    1200:   (6, 320),
+}
+
+SAMPLE_RATE = 8000
 SILENCE = '\x00' * 320
 
+PLAYOUT_LEAD = 0.1          # seconds of audio handed out ahead of the device
+FADE_SLOTS = 2              # lost packets concealed by fading the last audio
+COMFORT_NOISE_LEVEL = 0.003
+STATS_INTERVAL = 10.0
+FAST_READ_FRAMES = 50       # frames a file source hands out per read when not paced
+
+_libcodec2 = None
+
+def codec2_payload_len(mode, room=CODEC2_PAYLOAD_LEN):
+    # whole frames only, so that a mode switch never splits a frame
+    frame_bytes = CODEC2_FRAMES[mode][0]
+    return room / frame_bytes * frame_bytes
+
+def codec2_packet_duration(mode, room=CODEC2_PAYLOAD_LEN):
+    frame_bytes, frame_samples = CODEC2_FRAMES[mode]
+    return codec2_payload_len(mode, room) / frame_bytes * frame_samples / float(SAMPLE_RATE)
+
+def loadCodec2Lib():
+    global _libcodec2
+    if _libcodec2 is None and CODEC2_LIB_PATH:
+        lib = CDLL(CODEC2_LIB_PATH)
+        lib.codec2_create.argtypes = (c_int,)
+        lib.codec2_create.restype = c_void_p
+        lib.codec2_destroy.argtypes = (c_void_p,)
+        lib.codec2_destroy.restype = None
+        lib.codec2_samples_per_frame.argtypes = (c_void_p,)
+        lib.codec2_samples_per_frame.restype = c_int
+        lib.codec2_bits_per_frame.argtypes = (c_void_p,)
+        lib.codec2_bits_per_frame.restype = c_int
+        # speech and bits are both passed as raw byte strings
+        lib.codec2_encode.argtypes = (c_void_p, c_char_p, c_char_p)
+        lib.codec2_encode.restype = None
+        lib.codec2_decode.argtypes = (c_void_p, c_char_p, c_char_p)
+        lib.codec2_decode.restype = None
+        _libcodec2 = lib
+    return _libcodec2
+
+class Codec2():
+    '''
+    In-process codec2 encoder/decoder backed by libcodec2
+    '''
+
+    def __init__(self, mode=CODEC2_MODE):
+        self.lib = loadCodec2Lib()
+        self.mode = mode
+        self.state = self.lib.codec2_create(CODEC2_LIB_MODES[mode])
+        self.samples_per_frame = self.lib.codec2_samples_per_frame(self.state)
+        self.pcm_bytes = self.samples_per_frame * 2
+        self.frame_bytes = (self.lib.codec2_bits_per_frame(self.state) + 7) / 8
+        self.bits_buf = create_string_buffer(self.frame_bytes)
+        self.pcm_buf = create_string_buffer(self.pcm_bytes)
+
+    @staticmethod
+    def available():
+        return loadCodec2Lib() is not None
+
+    def close(self):
+        if self.state:
+            self.lib.codec2_destroy(self.state)
+            self.state = None
+
+    def encode(self, pcm):
+        # pcm holds exactly one frame of 16 bit signed little endian samples
+        self.lib.codec2_encode(self.state, self.bits_buf, pcm)
+        return self.bits_buf.raw
+
+    def decode(self, bits):
+        self.lib.codec2_decode(self.state, self.pcm_buf, bits)
+        return self.pcm_buf.raw
+
 class Codec2Source():
 
-    def __init__(self, micdev):
+    def __init__(self, micdev, mode=CODEC2_MODE, metrics=None):
         self.logger = getLogger('codec2-src')
         self.logger.debug('Using device `%s` as mic source', micdev)
         self.micdev = micdev
+        self.mode = mode
+        metrics = metrics or VoiZMetrics()
+        self.captured = metrics.counter('capture.bytes')
+        self.encoded = metrics.counter('encode.bytes')
+        self.encode_time = metrics.histogram('encode')
 
     def __enter__(self):
         self.inp = alsaaudio.PCM(
             alsaaudio.PCM_CAPTURE,
-            alsaaudio.PCM_NORMAL,
+            alsaaudio.PCM_NONBLOCK,
             self.micdev
         )
         self.inp.setchannels(1)
@@ -32,87 +139,411 @@ class Codec2Source():
         self.inp.setformat(alsaaudio.PCM_FORMAT_S16_LE)
         self.inp.setperiodsize(160)
 
-        c2args = (CODEC2ENC_PATH, str(CODEC2_MODE), '-', '-')
-        self.proc = Popen(c2args, stdin=PIPE, stdout=PIPE)
-
-        # set stdout to nonblocking
-        fd = self.proc.stdout.fileno()
-        fl = fcntl(fd, F_GETFL)
-        fcntl(fd, F_SETFL, fl | O_NONBLOCK)
-
-        self.w = 0
-        self.r = 0
-        self.t0 = now()
+        self.pcm = ''
+        self._open_codec()
 
         return self
 
     def __exit__(self, type, value, traceback):
-        self.proc.stdin.close()
+        self._close_codec()
         self.inp.close()
 
+    def _open_codec(self):
+        if Codec2.available():
+            self.logger.debug('Encoding codec2 %d with `%s`', self.mode, CODEC2_LIB_PATH)
+            self.codec = Codec2(self.mode)
+        else:
+            self.codec = None
+            c2args = (CODEC2ENC_PATH, str(self.mode), '-', '-')
+            self.proc = Popen(c2args, stdin=PIPE, stdout=PIPE)
+
+            # set stdout to nonblocking
+            fd = self.proc.stdout.fileno()
+            fl = fcntl(fd, F_GETFL)
+            fcntl(fd, F_SETFL, fl | O_NONBLOCK)
+
+    def _close_codec(self):
+        if self.codec:
+            self.codec.close()
+        else:
+            self.proc.stdin.close()
+
+    def set_mode(self, mode):
+        '''
+        Switches the encoder, captured audio not yet encoded carries over
+        '''
+        self.logger.info('Switching encoder to codec2 %d', mode)
+        self._close_codec()
+        self.mode = mode
+        self._open_codec()
+
+    def poll_fds(self):
+        fds = self.inp.polldescriptors()
+        if not self.codec:
+            fds.append((self.proc.stdout.fileno(), POLLIN))
+        return fds
+
     def read(self):
-        inp_read = self.inp.read
-        proc_read = self.proc.stdout.read
-        proc_write = self.proc.stdin.write
-        while True:
-            num_frames, micdata = inp_read()
-            if num_frames > 0:
-                proc_write(micdata)
-                self.w += len(micdata)
-            try:
-                d = proc_read()
-                self.r += len(d)
-                #print 'mic:', self.w / (now() - self.t0)
-                yield d
-            except IOError:
-                yield None
+        '''
+        Takes whatever audio the capture device has ready and returns the
+        codec2 bits encoded so far, which may be empty
+        '''
+        num_frames, micdata = self.inp.read()
+        if num_frames > 0:
+            self.captured.add(len(micdata))
+        else:
+            micdata = ''
+        if self.codec:
+            return self._read_frames(micdata)
+        return self._read_pipe(micdata)
+
+    def _read_frames(self, micdata):
+        # encode every complete codec2 frame captured so far
+        self.pcm += micdata
+        pcm_bytes = self.codec.pcm_bytes
+        bits = []
+        while len(self.pcm) >= pcm_bytes:
+            start = now()
+            bits.append(self.codec.encode(self.pcm[:pcm_bytes]))
+            self.encode_time.observe(now() - start)
+            self.pcm = self.pcm[pcm_bytes:]
+        bits = ''.join(bits)
+        self.encoded.add(len(bits))
+        return bits
+
+    def _read_pipe(self, micdata):
+        if micdata:
+            self.proc.stdin.write(micdata)
+        try:
+            bits = self.proc.stdout.read()
+        except IOError:
+            return ''
+        self.encoded.add(len(bits))
+        return bits
 
 class Codec2Sink():
 
-    def __init__(self, outdev):
+    def __init__(self, outdev, ctr_step, mode=CODEC2_MODE, room=CODEC2_PAYLOAD_LEN, metrics=None):
         self.logger = getLogger('codec2-sink')
         self.logger.debug('Using device `%s` as out sink', outdev)
         self.outdev = outdev
+        self.mode = mode
+        # room for codec2 frames in each packet
+        self.room = room
+        # (counter, mode) switches announced by the peer, oldest first
+        self.switches = []
+        self.timing_ctr = 0
+        self.jitter = VoiZJitterBuffer(codec2_packet_duration(mode, self.room), ctr_step, PLAYOUT_LEAD)
+        metrics = metrics or VoiZMetrics()
+        self.received = metrics.counter('decode.bytes')
+        self.played = metrics.counter('playback.bytes')
+        self.concealed_slots = metrics.counter('playback.concealed')
+        self.decode_time = metrics.histogram('decode')
+        metrics.gauge('jitter', self.jitter.stats)
 
     def __enter__(self):
-        self.out = alsaaudio.PCM(
+        self.out = self._open_output()
+        self._open_codec()
+
+        self.pcm = ''
+        self.last_pcm = ''
+        self.concealed = 0
+        self.queued_until = now()
+        self.stats_time = now()
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._close_codec()
+        self.out.close()
+
+    def _open_output(self):
+        out = alsaaudio.PCM(
             alsaaudio.PCM_PLAYBACK,
-            alsaaudio.PCM_NORMAL,
+            alsaaudio.PCM_NONBLOCK,
             self.outdev
         )
-        self.out.setchannels(1)
-        self.out.setrate(8000)
-        self.out.setformat(alsaaudio.PCM_FORMAT_S16_LE)
-        self.out.setperiodsize(160)
+        out.setchannels(1)
+        out.setrate(8000)
+        out.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+        out.setperiodsize(160)
+        return out
+
+    def _open_codec(self):
+        frame_bytes, frame_samples = CODEC2_FRAMES[self.mode]
+        self.payload_len = codec2_payload_len(self.mode, self.room)
+        self.packet_samples = self.payload_len / frame_bytes * frame_samples
+        if Codec2.available():
+            self.logger.debug('Decoding codec2 %d with `%s`', self.mode, CODEC2_LIB_PATH)
+            self.codec = Codec2(self.mode)
+            self.bits = ''
+        else:
+            self.codec = None
+            c2args = (CODEC2DEC_PATH, str(self.mode), '-', '-')
+            self.proc = Popen(c2args, stdin=PIPE, stdout=PIPE)
 
-        c2args = (CODEC2DEC_PATH, str(CODEC2_MODE), '-', '-')
-        self.proc = Popen(c2args, stdin=PIPE, stdout=PIPE)
+            # set stdout to nonblocking
+            fd = self.proc.stdout.fileno()
+            fl = fcntl(fd, F_GETFL)
+            fcntl(fd, F_SETFL, fl | O_NONBLOCK)
 
-        # set stdout to nonblocking
-        fd = self.proc.stdout.fileno()
-        fl = fcntl(fd, F_GETFL)
-        fcntl(fd, F_SETFL, fl | O_NONBLOCK)
+    def _close_codec(self):
+        if self.codec:
+            self.codec.close()
+        else:
+            self.proc.stdin.close()
 
-        self.w = 0
-        self.r = 0
-        self.t0 = now()
+    def announce(self, mode, ctr):
+        '''
+        Notes that the peer sends packets from counter `ctr` on in `mode`
+        '''
+        if ctr <= self.timing_ctr or (ctr, mode) in self.switches:
+            return
+        if not self.switches and mode == self.mode:
+            return
+        self.switches.append((ctr, mode))
+        self.switches.sort()
 
+    def poll_fds(self):
+        # playback readiness only matters while there is audio to play
+        fds = [(fd, mask if self.pcm else 0) for fd, mask in self.out.polldescriptors()]
+        if not self.codec:
+            fds.append((self.proc.stdout.fileno(), POLLIN))
+        return fds
+
+    def timeout(self):
+        '''
+        Milliseconds until the next playout slot is due, None if idle
+        '''
+        due = self.jitter.due()
+        if self.pcm or due is None:
+            return None
+        return max(0, max(due, self.queued_until - PLAYOUT_LEAD) - now()) * 1000
+
+    def write(self, ctr, c2data):
+        self.received.add(len(c2data))
+        for switch_ctr, mode in self.switches:
+            if self.timing_ctr < switch_ctr <= ctr:
+                # counters map to time differently from here on
+                self.timing_ctr = switch_ctr
+                self.jitter.set_packet_duration(codec2_packet_duration(mode, self.room))
+        self.jitter.push(ctr, c2data)
+        self.flush()
+
+    def _switch_decoder(self, mode):
+        self.logger.info('Peer switched to codec2 %d', mode)
+        self._close_codec()
+        self.mode = mode
+        self._open_codec()
+
+    def _decode(self, c2data):
+        self.concealed = 0
+        if not self.codec:
+            self.proc.stdin.write(c2data[:self.payload_len])
+            return
+        # decode only whole frames, keeping a partial one for the next packet
+        self.bits += c2data[:self.payload_len]
+        frame_bytes = self.codec.frame_bytes
+        pcm = []
+        while len(self.bits) >= frame_bytes:
+            start = now()
+            pcm.append(self.codec.decode(self.bits[:frame_bytes]))
+            self.decode_time.observe(now() - start)
+            self.bits = self.bits[frame_bytes:]
+        self.last_pcm = ''.join(pcm)
+        self.pcm += self.last_pcm
+
+    def _conceal(self):
+        self.concealed += 1
+        self.concealed_slots.add()
+        size = self.packet_samples * 2
+        if self.last_pcm and self.concealed <= FADE_SLOTS:
+            # repeat the last audio at half the level each time
+            pcm = (self.last_pcm * (size / len(self.last_pcm) + 1))[:size]
+            self.pcm += mul(pcm, 2, 0.5 ** self.concealed)
+        else:
+            self.pcm += mul(urandom(size), 2, COMFORT_NOISE_LEVEL)
+
+    def flush(self):
+        '''
+        Releases packets from the jitter buffer as their playout slots come
+        up and moves decoded audio to the playback device
+        '''
+        if not self.codec:
+            try:
+                pcm = self.proc.stdout.read()
+                self.pcm += pcm
+                self.last_pcm = pcm[:len(pcm) & ~1] or self.last_pcm
+            except IOError:
+                pass
+        while self.queued_until - now() < PLAYOUT_LEAD:
+            c2data = self.jitter.pop()
+            if c2data is BUFFERING:
+                break
+            # switch decoders at the first packet sent in the new mode
+            while self.switches and self.jitter.slot_ctr >= self.switches[0][0]:
+                self._switch_decoder(self.switches.pop(0)[1])
+            self.queued_until = max(self.queued_until, now()) + codec2_packet_duration(self.mode, self.room)
+            if c2data is None:
+                self._conceal()
+            else:
+                self._decode(c2data)
+        if self.pcm:
+            num_frames = self.out.write(self.pcm)
+            if num_frames > 0:
+                self.pcm = self.pcm[num_frames * 2:]
+                self.played.add(num_frames * 2)
+        if now() - self.stats_time > STATS_INTERVAL:
+            self.stats_time = now()
+            self.logger.debug('Playout: %r', self.jitter.stats())
+
+    def write_silence(self):
+        self.out.write(SILENCE)
+
+class Codec2FileSource():
+    '''
+    Streams the frames of a raw codec2 file, as written by c2enc, in place
+    of Codec2Source. Paced at `speed` times real time, or as fast as the
+    relay reads if speed is 0, starting over at the end. Mode switches
+    transcode through libcodec2, without it the source stays in the
+    file's mode
+    '''
+
+    def __init__(self, path, mode=CODEC2_MODE, speed=1.0, metrics=None):
+        self.logger = getLogger('codec2-src')
+        self.logger.debug('Streaming `%s` as codec2 %d', path, mode)
+        self.path = path
+        self.mode = self.file_mode = mode
+        self.speed = speed
+        metrics = metrics or VoiZMetrics()
+        self.encoded = metrics.counter('encode.bytes')
+
+    def __enter__(self):
+        self.fp = open(self.path, 'rb')
+        self.decoder = self.encoder = None
+        self.pcm = ''
+        # readable whenever frames are due, so the relay can poll() it
+        self.ticks_r, self.ticks_w = pipe()
+        for fd in (self.ticks_r, self.ticks_w):
+            fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+        self.stopped = Event()
+        self.thread = None
+        if self.speed:
+            self.thread = Thread(target=self._tick, name='codec2-file')
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            # never drained, so always readable
+            write(self.ticks_w, '\x00')
         return self
 
     def __exit__(self, type, value, traceback):
-        self.proc.stdin.close()
-        self.out.close()
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self._close_transcoder()
+        close(self.ticks_r)
+        close(self.ticks_w)
+        self.fp.close()
 
-    def write(self, c2data):
-        self.proc.stdin.write(c2data)
-        self.w += len(c2data)
+    def _tick(self):
+        # a byte in the pipe for every frame of the file that falls due
+        frame_time = CODEC2_FRAMES[self.file_mode][1] / float(SAMPLE_RATE) / self.speed
+        next_tick = now()
+        while not self.stopped.is_set():
+            next_tick += frame_time
+            self.stopped.wait(max(0, next_tick - now()))
+            try:
+                write(self.ticks_w, '\x00')
+            except OSError as e:
+                if e.errno != EAGAIN:
+                    raise
+
+    def _close_transcoder(self):
+        if self.decoder:
+            self.decoder.close()
+            self.encoder.close()
+        self.decoder = self.encoder = None
+
+    def set_mode(self, mode):
+        '''
+        Switches the mode frames are handed out in, unless that needs
+        libcodec2 and it is missing, so check self.mode afterwards
+        '''
+        if mode != self.file_mode and not Codec2.available():
+            self.logger.warning('Cannot switch to codec2 %d without libcodec2, staying in %d', mode, self.mode)
+            return
+        self.logger.info('Switching file source to codec2 %d', mode)
+        self._close_transcoder()
+        self.pcm = ''
+        self.mode = mode
+        if mode != self.file_mode:
+            self.decoder = Codec2(self.file_mode)
+            self.encoder = Codec2(mode)
+
+    def poll_fds(self):
+        return [(self.ticks_r, POLLIN)]
+
+    def _due_frames(self):
+        if not self.speed:
+            return FAST_READ_FRAMES
         try:
-            frames = self.proc.stdout.read()
-            self.out.write(frames)
-            self.r += len(frames)
-            #print 'out:', self.r / (now() - self.t0)
-        except IOError:
-            pass
+            return len(read(self.ticks_r, 4096))
+        except OSError as e:
+            if e.errno != EAGAIN:
+                raise
+            return 0
 
-    def write_silence(self):
-        self.out.write(SILENCE)
+    def _read_file(self, length):
+        bits = self.fp.read(length)
+        while len(bits) < length:
+            self.fp.seek(0)
+            more = self.fp.read(length - len(bits))
+            if not more:
+                break
+            bits += more
+        return bits
+
+    def read(self):
+        frame_bytes = CODEC2_FRAMES[self.file_mode][0]
+        bits = self._read_file(self._due_frames() * frame_bytes)
+        bits = bits[:len(bits) / frame_bytes * frame_bytes]
+        if self.decoder:
+            # transcode whole frames, keeping partial speech for the next read
+            for i in xrange(0, len(bits), frame_bytes):
+                self.pcm += self.decoder.decode(bits[i:i + frame_bytes])
+            pcm_bytes = self.encoder.pcm_bytes
+            frames = []
+            while len(self.pcm) >= pcm_bytes:
+                frames.append(self.encoder.encode(self.pcm[:pcm_bytes]))
+                self.pcm = self.pcm[pcm_bytes:]
+            bits = ''.join(frames)
+        self.encoded.add(len(bits))
+        return bits
+
+class PCMFile():
+    '''
+    Takes the place of the playback device, storing raw 16 bit 8kHz audio
+    '''
+
+    def __init__(self, path):
+        self.fp = open(path, 'wb')
+
+    def polldescriptors(self):
+        return []
+
+    def write(self, pcm):
+        self.fp.write(pcm)
+        return len(pcm) / 2
+
+    def close(self):
+        self.fp.close()
+
+class Codec2FileSink(Codec2Sink):
+    '''
+    Plays out like Codec2Sink, concealment included, but records the
+    decoded audio to a raw file instead of a sound card
+    '''
+
+    def _open_output(self):
+        return PCMFile(self.outdev)
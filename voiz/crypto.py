@@ -3,16 +3,37 @@
 Stores stateful cryptographic routines
 '''
 
+from os import open as osOpen, fdopen, chmod, fchmod, remove, rename, umask, O_WRONLY, O_CREAT, O_TRUNC
 from os.path import expanduser, isfile
 from pickle import load as pickleLoad, dump as pickleDump
+from sqlite3 import connect as sqliteConnect
 from logging import getLogger
+from threading import Thread, Condition, Lock
+from time import time as now
+from struct import Struct
+from hashlib import sha256
+from hmac import new as hmacNew
 
 from Crypto import Random
 from Crypto.Hash import SHA256, HMAC
-from Crypto.Util import Counter
+from Crypto.Util.strxor import strxor
 from Crypto.Cipher import AES
 
 VOIZ_CACHE_PATH = '~/.voiz_cache'
+VOIZ_KEYPOOL_PATH = '~/.voiz_keypool'
+
+SQLITE_MAGIC = 'SQLite format 3\x00'
+CACHE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key         TEXT PRIMARY KEY,
+        value       BLOB
+    );
+    CREATE TABLE IF NOT EXISTS peers (
+        zid         BLOB PRIMARY KEY,
+        rs1         BLOB,
+        expires     REAL
+    );
+'''
 
 DH_MODULUS = int('''
     FFFFFFFF FFFFFFFF C90FDAA2 2168C234 C4C6628B 80DC1CD1
@@ -28,45 +49,280 @@ DH_MODULUS = int('''
     15728E5A 8AACAA68 FFFFFFFF FFFFFFFF
 '''.replace(' ', '').replace('\n', '').lower(), 16)
 DH_GENERATOR = 2
+RETAINED_SECRET_LIFETIME = 30 * 24 * 3600
+# a 256 bit exponent matches the ~112 bit strength of the 2048 bit group
+DH_EXPONENT_BITS = 256
+KEYPOOL_SIZE = 4
+AES_BLOCK_LEN = 16
+KEYSTREAM_BATCH = 256       # blocks generated per refill
+KEYSTREAM_BEHIND = 64       # blocks kept behind the newest counter for reordered packets
+
+ULONG_PACK = Struct('!Q').pack
+
+ROLES = ('Initiator', 'Responder')
+SESSION_KEY_LABELS = ('ZRTP key', 'HMAC key', 'packet key')
 
 class InvalidHMACException(Exception):
     pass
 
+def openPrivate(path):
+    # owner-only, even if an older version left the file readable
+    fd = osOpen(path, O_WRONLY | O_CREAT | O_TRUNC, 0600)
+    fchmod(fd, 0600)
+    return fdopen(fd, 'wb')
+
+def newDHKeypair(exponent_bits=DH_EXPONENT_BITS):
+    dhpriv = int(Random.new().read(exponent_bits / 8).encode('hex'), 16)
+    return dhpriv, pow(DH_GENERATOR, dhpriv, DH_MODULUS)
+
+def agreeDH(dhpub2, dhpriv):
+    # module level so that it can run in a process pool
+    return hex(pow(dhpub2, dhpriv, DH_MODULUS)).rstrip('L')[2:]
+
 class VoiZCache():
+    '''
+    Persistent store for our ZID and per-peer state, kept in an SQLite
+    database indexed by peer ZID
+    '''
 
     def __init__(self, path=VOIZ_CACHE_PATH):
         self.logger = getLogger('cache')
         self.path = expanduser(path)
         self.logger.debug('Using VoiZ cache file `%s`' % self.path)
+        self.lock = Lock()
         self.load()
 
     def newZID(self):
         return Random.new().read(12)
 
+    def connect(self, path):
+        # retained secrets: the database is owner-only, and SQLite gives its
+        # -wal and -shm files the database's permissions
+        for side in ('', '-wal', '-shm'):
+            if isfile(path + side):
+                chmod(path + side, 0600)
+        mask = umask(077)
+        try:
+            db = sqliteConnect(path, check_same_thread=False)
+            # the write-ahead log appends commits instead of rewriting the file
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(CACHE_SCHEMA)
+        finally:
+            umask(mask)
+        return db
+
     def load(self):
-        if not isfile(self.path):
-            self.cache = {
-                'ZID':  self.newZID()
-            }
-            self.save()
+        if isfile(self.path):
+            with open(self.path, 'rb') as fp:
+                legacy = fp.read(len(SQLITE_MAGIC)) != SQLITE_MAGIC
+            if legacy:
+                self.migrate()
+        self.db = self.connect(self.path)
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', ('ZID',)).fetchone()
+        if row:
+            self.zid = str(row[0])
             return
-        with open(self.path, 'rb') as fp:
-            self.cache = pickleLoad(fp)
+        self.zid = self.newZID()
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO meta VALUES (?, ?)', ('ZID', buffer(self.zid)))
 
-    def save(self):
-        with open(self.path, 'wb') as fp:
-            pickleDump(self.cache, fp)
+    def migrate(self):
+        self.logger.info('Migrating pickled VoiZ cache `%s`' % self.path)
+        with open(self.path, 'rb') as fp:
+            cache = pickleLoad(fp)
+        # build the database next to the old cache and swap it in atomically
+        tmp_path = self.path + '.tmp'
+        if isfile(tmp_path):
+            remove(tmp_path)
+        db = self.connect(tmp_path)
+        with db:
+            db.execute('INSERT INTO meta VALUES (?, ?)', ('ZID', buffer(cache['ZID'])))
+            for zid, peer in cache.get('peers', {}).items():
+                db.execute(
+                    'INSERT INTO peers VALUES (?, ?, ?)',
+                    (buffer(zid), buffer(peer['rs1']), peer['expires'])
+                )
+        db.execute('PRAGMA journal_mode=DELETE')
+        db.close()
+        rename(tmp_path, self.path)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
 
     def getZID(self):
-        return self.cache['ZID']
+        return self.zid
+
+    def getRetainedSecret(self, zid):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT rs1 FROM peers WHERE zid = ? AND expires >= ?',
+                (buffer(zid), now())
+            ).fetchone()
+        if not row:
+            return None
+        return str(row[0])
+
+    def setRetainedSecret(self, zid, rs):
+        # replaces the previous secret, which expires with it
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO peers VALUES (?, ?, ?)',
+                (buffer(zid), buffer(rs), now() + RETAINED_SECRET_LIFETIME)
+            )
+
+class VoiZKeyPool(Thread):
+    '''
+    Keeps a few DH keypairs precomputed in the background, optionally
+    persisting them so the next run starts with a full pool
+    '''
+
+    def __init__(self, exponent_bits=DH_EXPONENT_BITS, size=KEYPOOL_SIZE, path=None, pool=None):
+        Thread.__init__(self, name='keypool')
+        self.daemon = True
+        self.logger = getLogger('keypool')
+        self.exponent_bits = exponent_bits
+        self.size = size
+        self.path = path and expanduser(path)
+        # process pool to generate in, so the GIL stays free for the calls
+        self.pool = pool
+        self.cond = Condition()
+        self.keypairs = []
+        self.running = True
+        self.load()
+
+    def load(self):
+        if not self.path or not isfile(self.path):
+            return
+        self.logger.debug('Using VoiZ keypool file `%s`' % self.path)
+        with open(self.path, 'rb') as fp:
+            pool = pickleLoad(fp)
+        # keypairs drawn with another exponent length are discarded
+        if pool['exponent_bits'] == self.exponent_bits:
+            self.keypairs = pool['keypairs']
+
+    def save(self):
+        if not self.path:
+            return
+        pool = {
+            'exponent_bits':    self.exponent_bits,
+            'keypairs':         list(self.keypairs)
+        }
+        # private keys: write owner-only, and replace the old pool atomically
+        tmp_path = self.path + '.tmp'
+        with openPrivate(tmp_path) as fp:
+            pickleDump(pool, fp)
+        rename(tmp_path, self.path)
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                while self.running and len(self.keypairs) >= self.size:
+                    self.cond.wait(1.0)
+            if not self.running:
+                break
+            self.logger.debug('Generating Finite Field DH keypair...')
+            if self.pool:
+                keypair = self.pool.apply(newDHKeypair, (self.exponent_bits,))
+            else:
+                keypair = newDHKeypair(self.exponent_bits)
+            with self.cond:
+                self.keypairs.append(keypair)
+                self.save()
+                self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while not self.keypairs:
+                self.cond.wait(1.0)
+            keypair = self.keypairs.pop(0)
+            # a keypair must never be handed out twice, even after a crash
+            self.save()
+            self.cond.notify_all()
+        return keypair
+
+class VoiZKeystream():
+    '''
+    AES-CTR keystream for one direction, generated a batch of blocks at a
+    time so that any counter inside the window is just an XOR away
+    '''
+
+    def __init__(self, key, counter_suffix, batch=KEYSTREAM_BATCH, behind=KEYSTREAM_BEHIND):
+        self.cipher = AES.new(key, AES.MODE_ECB)
+        self.counter_suffix = counter_suffix
+        self.batch = batch
+        self.behind = behind
+        self.start = 1
+        self.blocks = self.generateBlocks(1, batch)
+
+    def generateBlocks(self, start, count):
+        # counter blocks laid out as Counter.new(64, suffix=...) would
+        suffix = self.counter_suffix
+        return self.cipher.encrypt(''.join(ULONG_PACK(ctr) + suffix for ctr in xrange(start, start + count)))
+
+    def keystream(self, ctr, length):
+        nblocks = (length + AES_BLOCK_LEN - 1) / AES_BLOCK_LEN
+        end = self.start + len(self.blocks) / AES_BLOCK_LEN
+        if ctr < self.start:
+            # too old for the window, generate just what it needs
+            return self.generateBlocks(ctr, nblocks)[:length]
+        if ctr + nblocks > end:
+            if ctr > end + self.batch:
+                # jumped well ahead, start a new window there
+                self.start = ctr
+                self.blocks = self.generateBlocks(ctr, max(nblocks, self.batch))
+            else:
+                # slide forward, keeping some blocks behind ctr but none
+                # past the end of the window, which is where new blocks go
+                keep = max(self.start, min(ctr - self.behind, end))
+                count = max(ctr + nblocks - end, self.batch)
+                self.blocks = self.blocks[(keep - self.start) * AES_BLOCK_LEN:] + self.generateBlocks(end, count)
+                self.start = keep
+        offset = (ctr - self.start) * AES_BLOCK_LEN
+        return self.blocks[offset:offset + length]
+
+    def crypt(self, payload, ctr):
+        return strxor(payload, self.keystream(ctr, len(payload)))
+
+class VoiZKeySchedule():
+    '''
+    Session keys derived once from s0, along with HMAC states that are
+    already keyed so a MAC only has to hash the payload
+    '''
+
+    def __init__(self, s0):
+        self.keys = {}
+        self.macs = {}
+        for role in ROLES:
+            for label in SESSION_KEY_LABELS:
+                name = '%s %s' % (role, label)
+                self.keys[name] = HMAC.new(s0, name, SHA256).digest()
+                # hashlib states copy far cheaper than Crypto.Hash ones
+                self.macs[name] = hmacNew(self.keys[name], digestmod=sha256)
+        self.keys['retained secret'] = HMAC.new(s0, 'retained secret', SHA256).digest()
+
+    def key(self, label):
+        return self.keys[label]
+
+    def mac(self, label, payload):
+        h = self.macs[label].copy()
+        h.update(payload)
+        return h.digest()
 
 class VoiZMAC():
 
-    def __init__(self):
+    def __init__(self, keypool=None, exponent_bits=DH_EXPONENT_BITS):
         self.logger = getLogger('mac')
         self.prng = Random.new()
+        self.keypool = keypool
+        self.exponent_bits = exponent_bits
+        self.dhpub = None
         self._computeHashChain()
-        self._computeDHKeypair()
 
     def _computeHashChain(self):
         self.logger.debug('Generating MAC hash chain...')
@@ -76,9 +332,15 @@ class VoiZMAC():
         self.h3 = self.getHash(self.h2)
 
     def _computeDHKeypair(self):
-        self.logger.debug('Generating Finite Field DH keypair...')
-        self.dhpriv = int(self.prng.read(2047).encode('hex'), 16)
-        self.dhpub = pow(DH_GENERATOR, self.dhpriv, DH_MODULUS)
+        # deferred until first use so that a pool can fill in the meantime
+        if self.dhpub is not None:
+            return
+        if self.keypool:
+            self.logger.debug('Taking Finite Field DH keypair from pool...')
+            self.dhpriv, self.dhpub = self.keypool.get()
+        else:
+            self.logger.debug('Generating Finite Field DH keypair...')
+            self.dhpriv, self.dhpub = newDHKeypair(self.exponent_bits)
 
     def getHMAC(self, key, payload):
         return HMAC.new(key, payload, SHA256).digest()
@@ -102,7 +364,19 @@ class VoiZMAC():
     def setCounterSuffix(self, cs):
         self.counter_suffix = cs
 
+    def generateNonce(self):
+        return self.prng.read(8)
+
+    def retainedSecretID(self, rs, role):
+        if rs is None:
+            return '\x00' * 8
+        return self.getHMAC(rs, role)[:8]
+
+    def retainedSecret(self):
+        return self.keys.key('retained secret')
+
     def packedPublicKey(self):
+        self._computeDHKeypair()
         return hex(self.dhpub).rstrip('L')[2:].rjust(512, '0').decode('hex')
 
     def setPartnerPublicKey(self, key):
@@ -111,9 +385,11 @@ class VoiZMAC():
     def setPackets(self, packets):
         self.total_hash = self.getHash(packets)
 
-    def computeSecret(self, zidi, zidr):
+    def computeSecret(self, zidi, zidr, dhresult=None):
         self.logger.debug('Computing shared secret s0...')
-        dhresult = hex(pow(self.dhpub2, self.dhpriv, DH_MODULUS)).rstrip('L')[2:]
+        if dhresult is None:
+            self._computeDHKeypair()
+            dhresult = agreeDH(self.dhpub2, self.dhpriv)
         self.s0 = self.getHash(
             dhresult +
             'ZRTP-HMAC-KDF' +
@@ -122,39 +398,57 @@ class VoiZMAC():
             self.total_hash
         )
 
+    def computeResumedSecret(self, rs, zidi, zidr):
+        self.logger.debug('Computing shared secret s0 from retained secret...')
+        self.s0 = self.getHash(
+            rs +
+            'ZRTP-PSK-KDF' +
+            zidi +
+            zidr +
+            self.total_hash
+        )
+
     def verifyPacketHMAC(self, key, payload, expected):
         return HMAC.new(key, payload, SHA256).digest()[:8] == expected
 
+    def sessionMAC(self, label, payload):
+        return self.keys.mac(label, payload)
+
+    def verifySessionMAC(self, label, payload, expected):
+        return self.keys.mac(label, payload)[:8] == expected
+
+    def packetMAC(self, payload):
+        return self.keys.mac(self.role + ' packet key', payload)
+
+    def verifyPacketMAC(self, payload, expected, length=8):
+        return self.keys.mac(self.partner_role + ' packet key', payload)[:length] == expected
+
     def verifyHash(self, payload, expected):
         return SHA256.new(payload).digest() == expected
 
     def getHash(self, payload):
         return SHA256.new(payload).digest()
 
-    def startEncryption(self, enckey, deckey):
-        self.logger.debug('Instantiating symmetric ciphers...')
-        self.enckey = enckey
-        self.deckey = deckey
-        # encryption
-        encctro = Counter.new(64, suffix=self.counter_suffix)
-        self.enccipher = AES.new(enckey, AES.MODE_CTR, counter=encctro)
-        # decryption
-        decctro = Counter.new(64, suffix=self.counter_suffix)
-        self.deccipher = AES.new(deckey, AES.MODE_CTR, counter=decctro)
+    def startEncryption(self, role):
+        self.logger.debug('Deriving session keys...')
+        self.keys = VoiZKeySchedule(self.s0)
+        self.role = role
+        self.partner_role = ROLES[1 - ROLES.index(role)]
+        self.enckey = self.keys.key(self.role + ' ZRTP key')
+        self.deckey = self.keys.key(self.partner_role + ' ZRTP key')
+        self.logger.debug('Precomputing keystreams...')
+        self.enckeystream = VoiZKeystream(self.enckey, self.counter_suffix)
+        self.deckeystream = VoiZKeystream(self.deckey, self.counter_suffix)
         # counters
         self.encctr = 1
         self.decctr = 1
 
     def encrypt(self, payload):
-        self.encctr += len(payload) / 16
-        return self.enccipher.encrypt(payload)
+        ciphertext = self.enckeystream.crypt(payload, self.encctr)
+        self.encctr += (len(payload) + AES_BLOCK_LEN - 1) / AES_BLOCK_LEN
+        return ciphertext
 
     def decrypt(self, payload, ctr=None):
         ctr = ctr or self.decctr
-        if ctr != self.decctr:
-            self.logger.debug('Reinstantiating decryption cipher due to out-of-sync counter...')
-            decctro = Counter.new(64, suffix=self.counter_suffix, initial_value=ctr)
-            self.deccipher = AES.new(self.deckey, AES.MODE_CTR, counter=decctro)
-            self.decctr = ctr
-        self.decctr += len(payload) / 16
-        return self.deccipher.decrypt(payload)
\ No newline at end of file
+        self.decctr = ctr + (len(payload) + AES_BLOCK_LEN - 1) / AES_BLOCK_LEN
+        return self.deckeystream.crypt(payload, ctr)
\ No newline at end of file
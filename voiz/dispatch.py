@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+from collections import deque
+from errno import EAGAIN
+from fcntl import fcntl, F_GETFL, F_SETFL
+from os import O_NONBLOCK, pipe, read, write
+from logging import getLogger
+from threading import Thread, Condition
+from time import time as now
+
+QUEUE_LEN = 32
+WAIT_FOREVER_SLICE = 1.0    # keeps indefinite waits interruptible
+
+class VoiZDispatcher(Thread):
+
+    def __init__(self, rx):
+        Thread.__init__(self, name='dispatcher')
+        self.daemon = True
+        self.logger = getLogger('dispatcher')
+        self.rx = rx
+        self.cond = Condition()
+        self.pending = {}
+        self.running = True
+        # becomes readable whenever a packet is queued, for poll() loops
+        self.wakeup_r, self.wakeup_w = pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+
+    def run(self):
+        # block on the rx queue and hand packets to waiters as they arrive
+        while self.running:
+            pkt = self.rx.wait_pkt()
+            if pkt:
+                self.put(pkt)
+
+    def stop(self):
+        self.running = False
+        self.rx.close_queue()
+
+    def put(self, pkt):
+        pkt_id = ord(pkt[0])
+        with self.cond:
+            queue = self.pending.get(pkt_id)
+            if queue is None:
+                queue = self.pending[pkt_id] = deque(maxlen=QUEUE_LEN)
+            elif len(queue) == QUEUE_LEN:
+                self.logger.debug('Dropping stale packet: 0x%02x', pkt_id)
+            queue.append(pkt)
+            self.cond.notify_all()
+        try:
+            write(self.wakeup_w, '\x00')
+        except OSError as e:
+            # a full pipe is already readable
+            if e.errno != EAGAIN:
+                raise
+
+    def fileno(self):
+        return self.wakeup_r
+
+    def clear_wakeup(self):
+        try:
+            while read(self.wakeup_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != EAGAIN:
+                raise
+
+    def recv_pkt(self, pkt_ids, timeout=None):
+        '''
+        Returns the oldest queued packet with one of the given IDs, waiting
+        up to `timeout` seconds for one to arrive (forever if None)
+        '''
+        if isinstance(pkt_ids, int):
+            pkt_ids = (pkt_ids,)
+        deadline = None if timeout is None else now() + timeout
+        with self.cond:
+            while True:
+                for pkt_id in pkt_ids:
+                    queue = self.pending.get(pkt_id)
+                    if queue:
+                        return queue.popleft()
+                if deadline is None:
+                    self.cond.wait(WAIT_FOREVER_SLICE)
+                    continue
+                remaining = deadline - now()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+'''
+Reed-Solomon forward error correction between the packet factory and the
+modem, so that a few corrupted bytes no longer cost the whole packet
+'''
+
+from logging import getLogger
+
+from .protocol import PKT_CODEC2, PKT_C2MODE
+
+# (parity bytes per codeword, interleaved codewords), indexed by the code
+# number sent in front of every frame. a codeword corrects half as many
+# byte errors as it has parity bytes, interleaving spreads bursts out
+FEC_CODES = (
+    (0, 1),     # uncoded
+    (8, 2),
+    (16, 2),
+    (16, 4),
+)
+FEC_VOICE = 1
+FEC_HANDSHAKE = 2
+RS_BLOCK_LEN = 255
+HEADER_COPIES = 3           # the code number is sent three times and voted on
+HEADER_LEN = HEADER_COPIES
+
+# GF(2^8) over x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = bytearray(512)
+GF_LOG = [0] * 256
+_x = 1
+for _i in xrange(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in xrange(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+class UncorrectableFECException(Exception):
+    pass
+
+def gf_mul(x, y):
+    if x == 0 or y == 0:
+        return 0
+    return GF_EXP[GF_LOG[x] + GF_LOG[y]]
+
+def gf_div(x, y):
+    if x == 0:
+        return 0
+    return GF_EXP[GF_LOG[x] + 255 - GF_LOG[y]]
+
+def poly_eval(poly, x):
+    # lowest degree coefficient first
+    if x == 0:
+        return poly[0]
+    log_x = GF_LOG[x]
+    y = 0
+    for coef in reversed(poly):
+        y = (GF_EXP[GF_LOG[y] + log_x] if y else 0) ^ coef
+    return y
+
+_generators = {}
+
+def rs_generator(nsym):
+    '''
+    Returns the logs of the generator polynomial's coefficients below the
+    leading one, highest degree first
+    '''
+    if nsym not in _generators:
+        gen = [1]
+        for i in xrange(nsym):
+            # multiply by (x + a^i)
+            root = GF_EXP[i]
+            gen = [c ^ gf_mul(p, root) for c, p in zip(gen + [0], [0] + gen)]
+        _generators[nsym] = [GF_LOG[c] for c in gen[1:]]
+    return _generators[nsym]
+
+def rs_encode(msg, nsym):
+    '''
+    Returns the nsym parity bytes for msg, the remainder of msg * x^nsym
+    divided by the generator polynomial
+    '''
+    gen = rs_generator(nsym)
+    parity = bytearray(nsym)
+    for byte in msg:
+        coef = byte ^ parity[0]
+        parity[:-1] = parity[1:]
+        parity[-1] = 0
+        if coef:
+            log_coef = GF_LOG[coef]
+            for j, log_g in enumerate(gen):
+                parity[j] ^= GF_EXP[log_g + log_coef]
+    return parity
+
+def rs_syndromes(codeword, nsym):
+    syndromes = []
+    for i in xrange(nsym):
+        # codeword is highest degree first, evaluate at a^i by Horner
+        s = 0
+        for byte in codeword:
+            s = (GF_EXP[GF_LOG[s] + i] if s else 0) ^ byte
+        syndromes.append(s)
+    return syndromes
+
+def rs_decode(codeword, nsym):
+    '''
+    Corrects up to nsym / 2 byte errors in codeword in place, raises
+    UncorrectableFECException if there are more
+    '''
+    syndromes = rs_syndromes(codeword, nsym)
+    if not any(syndromes):
+        return 0
+    # Berlekamp-Massey for the error locator, lowest degree first
+    locator = [1]
+    prev = [1]
+    errors = 0
+    shift = 1
+    prev_d = 1
+    for n in xrange(nsym):
+        d = syndromes[n]
+        for i in xrange(1, errors + 1):
+            d ^= gf_mul(locator[i], syndromes[n - i])
+        if d == 0:
+            shift += 1
+            continue
+        scale = gf_div(d, prev_d)
+        updated = locator + [0] * max(0, len(prev) + shift - len(locator))
+        for i, coef in enumerate(prev):
+            updated[i + shift] ^= gf_mul(scale, coef)
+        if 2 * errors <= n:
+            prev = locator
+            prev_d = d
+            errors = n + 1 - errors
+            shift = 1
+        else:
+            shift += 1
+        locator = updated
+    if 2 * errors > nsym:
+        raise UncorrectableFECException('Too many errors in codeword')
+    # Chien search: the error at index k has locator a^(n - 1 - k)
+    n = len(codeword)
+    positions = []
+    for k in xrange(n):
+        if poly_eval(locator, GF_EXP[255 - (n - 1 - k) % 255]) == 0:
+            positions.append(k)
+    if len(positions) != errors:
+        raise UncorrectableFECException('Error locator has no matching roots')
+    # Forney for the error values
+    evaluator = [0] * nsym
+    for i, s in enumerate(syndromes):
+        for j, coef in enumerate(locator[:nsym - i]):
+            evaluator[i + j] ^= gf_mul(s, coef)
+    derivative = [coef if i % 2 == 0 else 0 for i, coef in enumerate(locator[1:])]
+    for k in positions:
+        x = GF_EXP[(n - 1 - k) % 255]
+        x_inv = GF_EXP[255 - (n - 1 - k) % 255]
+        codeword[k] ^= gf_div(
+            gf_mul(x, poly_eval(evaluator, x_inv)),
+            poly_eval(derivative, x_inv)
+        )
+    if any(rs_syndromes(codeword, nsym)):
+        raise UncorrectableFECException('Codeword still corrupt after correction')
+    return errors
+
+def split_lengths(total, parts):
+    # as even as possible, longer parts first
+    return [total / parts + (1 if i < total % parts else 0) for i in xrange(parts)]
+
+def interleave_order(lengths):
+    # byte i of every codeword in turn, skipping codewords that are shorter
+    return [(j, i) for i in xrange(max(lengths)) for j, length in enumerate(lengths) if i < length]
+
+class VoiZFEC():
+    '''
+    Encodes packets into interleaved Reed-Solomon codewords behind a
+    repeated code number, so the receiver can decode whatever code the
+    sender chose for each packet type
+    '''
+
+    def __init__(self, voice=FEC_VOICE, handshake=FEC_HANDSHAKE):
+        self.logger = getLogger('fec')
+        self.codes = {PKT_CODEC2: voice, PKT_C2MODE: voice}
+        self.default_code = handshake
+        # statistics
+        self.corrected = 0
+        self.uncorrectable = 0
+
+    def code(self, pkt_id):
+        return self.codes.get(pkt_id, self.default_code)
+
+    def encoded_len(self, length, pkt_id=None):
+        nsym, depth = FEC_CODES[self.code(pkt_id)]
+        return HEADER_LEN + length + depth * nsym
+
+    def encode(self, pkt):
+        code = self.code(ord(pkt[0]))
+        nsym, depth = FEC_CODES[code]
+        if len(pkt) + depth * nsym > depth * RS_BLOCK_LEN:
+            raise ValueError('Packet of %d bytes too long for FEC code %d' % (len(pkt), code))
+        data = bytearray(pkt)
+        codewords = []
+        offset = 0
+        for length in split_lengths(len(data), depth):
+            msg = data[offset:offset + length]
+            codewords.append(msg + rs_encode(msg, nsym))
+            offset += length
+        frame = bytearray(chr(code) * HEADER_COPIES)
+        frame.extend(codewords[j][i] for j, i in interleave_order([len(cw) for cw in codewords]))
+        return str(frame)
+
+    def decode(self, frame, crc_ok=False):
+        '''
+        Returns the packet carried in frame. A frame that passed the CRC
+        only needs its parity stripped, anything else gets corrected
+        '''
+        if len(frame) <= HEADER_LEN:
+            raise UncorrectableFECException('Frame too short')
+        a, b, c = bytearray(frame[:HEADER_COPIES])
+        # bitwise majority vote
+        code = (a & b) | (a & c) | (b & c)
+        if code >= len(FEC_CODES):
+            raise UncorrectableFECException('Unknown FEC code %d' % code)
+        nsym, depth = FEC_CODES[code]
+        body = bytearray(frame[HEADER_LEN:])
+        data_len = len(body) - depth * nsym
+        if data_len < depth:
+            raise UncorrectableFECException('Frame too short for FEC code %d' % code)
+        lengths = [length + nsym for length in split_lengths(data_len, depth)]
+        codewords = [bytearray(length) for length in lengths]
+        for byte, (j, i) in zip(body, interleave_order(lengths)):
+            codewords[j][i] = byte
+        if not crc_ok:
+            if not nsym:
+                raise UncorrectableFECException('Corrupt frame sent without FEC')
+            try:
+                errors = sum(rs_decode(codeword, nsym) for codeword in codewords)
+            except UncorrectableFECException:
+                self.uncorrectable += 1
+                raise
+            self.logger.debug('Corrected %d bytes', errors)
+            self.corrected += errors
+        return ''.join(str(codeword[:len(codeword) - nsym]) for codeword in codewords)
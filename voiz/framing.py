@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+'''
+Frame layout of GNU Radio's packet_utils, without GNU Radio: preamble,
+access code, a doubled length header, the whitened payload with its
+CRC32 and a trailer byte
+'''
+
+from struct import Struct
+from zlib import crc32
+
+SAMPLE_RATE = 48000
+PAYLOAD_LEN = 81
+MAX_PAYLOAD_LEN = 4095  # the frame header's length field is 12 bits
+FRAME_OVERHEAD = 19     # preamble, access code, header, crc and trailer bytes
+ZERO = '\x00'
+# GFSK modem backends that put these frames on air
+MODEMS = ('gnuradio', 'numpy')
+
+# packet_utils.default_preamble and default_access_code, packed
+PREAMBLE = '\xa4\xf2'
+ACCESS_CODE = '\xac\xdd\xa4\xe2\xf2\x8c\x20\xfc'
+ACCESS_CODE_THRESHOLD = 12  # bit errors packet_decoder tolerates in the access code
+FRAME_HEADER = Struct('!HH')
+FRAME_CRC = Struct('!I')
+TRAILER = '\x55'
+
+def whitener_mask(length=MAX_PAYLOAD_LEN + 1):
+    '''
+    packet_utils.random_mask_tuple: bytes of the x^15 + x + 1 LFSR that
+    gr::blocks::lfsr_32k runs, least significant bit first
+    '''
+    sr = 0x7fff
+    mask = bytearray(length)
+    for i in xrange(length):
+        byte = 0
+        for j in xrange(8):
+            bit = ((sr >> 1) ^ sr) & 1
+            sr = (sr >> 1) | (bit << 14)
+            byte = (byte >> 1) | ((sr & 1) << 7)
+        mask[i] = byte
+    return mask
+
+WHITENER_MASK = whitener_mask()
+
+def whiten(data, offset=0):
+    return str(bytearray(x ^ y for x, y in zip(bytearray(data), WHITENER_MASK[offset:])))
+
+def make_header(length, offset=0):
+    value = ((offset & 0xf) << 12) | (length & 0xfff)
+    return FRAME_HEADER.pack(value, value)
+
+def parse_header(header):
+    '''
+    Returns (payload length, whitener offset), or None if the two copies
+    of the header disagree
+    '''
+    value, copy = FRAME_HEADER.unpack(header)
+    if value != copy:
+        return None
+    return value & 0xfff, value >> 12
+
+def make_packet(payload, offset=0):
+    '''
+    Frames a payload as packet_utils.make_packet does with the default
+    preamble and access code and no USRP padding
+    '''
+    payload += FRAME_CRC.pack(crc32(payload) & 0xffffffff)
+    if len(payload) > MAX_PAYLOAD_LEN:
+        raise ValueError('Packet of %d bytes does not fit in a frame' % (len(payload) - FRAME_CRC.size))
+    return ''.join((PREAMBLE, ACCESS_CODE, make_header(len(payload), offset), whiten(payload, offset), TRAILER))
+
+def unmake_packet(whitened, offset=0):
+    '''
+    Returns (crc ok, payload) for the whitened payload and CRC following
+    a frame header
+    '''
+    payload = whiten(whitened, offset)
+    ok = len(payload) >= FRAME_CRC.size and \
+        FRAME_CRC.unpack(payload[-FRAME_CRC.size:])[0] == crc32(payload[:-FRAME_CRC.size]) & 0xffffffff
+    return ok, payload[:-FRAME_CRC.size]
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''
+Gateway mode: one process serving a call on each of many lines, sharing
+the DH process pool, keypool and peer cache between them
+'''
+
+from copy import copy
+from logging import getLogger
+from multiprocessing import Pool, cpu_count
+from threading import Thread, Event, Lock
+from time import time as now
+
+from .app import VoiZApp
+from .crypto import VoiZCache, VoiZKeyPool, VOIZ_KEYPOOL_PATH
+from .metrics import VoiZMetrics, VoiZMetricsReporter
+from .proc import task_cpu_time, process_cpu_time
+
+LINE_FIELDS = ('name', 'micdev', 'outdev', 'lomicdev', 'looutdev', 'role')
+LINE_ROLES = ('initiate', 'respond')
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_TIME = 60.0          # a call this long resets the restart backoff
+STATS_INTERVAL = 10.0
+STOP_TIMEOUT = 5.0
+
+def load_lines(path):
+    '''
+    Reads the line table, one line per row with whitespace separated
+    name, micdev, outdev, lomicdev, looutdev and role (initiate/respond)
+    '''
+    lines = []
+    with open(path) as fp:
+        for n, row in enumerate(fp, 1):
+            row = row.split('#', 1)[0].split()
+            if not row:
+                continue
+            if len(row) != len(LINE_FIELDS):
+                raise ValueError('%s:%d: expected %d fields, got %d' % (path, n, len(LINE_FIELDS), len(row)))
+            line = dict(zip(LINE_FIELDS, row))
+            if line['role'] not in LINE_ROLES:
+                raise ValueError('%s:%d: role must be one of %s' % (path, n, ', '.join(LINE_ROLES)))
+            lines.append(line)
+    names = [entry['name'] for entry in lines]
+    if len(set(names)) != len(names):
+        raise ValueError('%s: line names must be unique' % path)
+    return lines
+
+class VoiZLine():
+    '''
+    Runs calls on one line in a thread of their own, a new call whenever
+    the last one ends, and keeps count of what they did
+    '''
+
+    def __init__(self, gateway, line):
+        self.logger = getLogger('line.%s' % line['name'])
+        self.gateway = gateway
+        self.name = line['name']
+        self.conf = copy(gateway.conf)
+        for field in ('micdev', 'outdev', 'lomicdev', 'looutdev'):
+            setattr(self.conf, field, line[field])
+        self.conf.initiate = line['role'] == 'initiate'
+        self.trace = self.conf.trace
+        if self.conf.outfile:
+            self.conf.outfile = '%s.%s' % (self.conf.outfile, self.name)
+        self.app = None
+        self.thread = None
+        self.started = None
+        self.restart_at = 0
+        self.restart_delay = RESTART_DELAY
+        # statistics, kept across restarts
+        self.calls = 0
+        self.failures = 0
+        self.sent = 0
+        self.received = 0
+        self.cpu_time = 0.0
+        # what the current call had done at the last collect
+        self.relay_counts = (0, 0)
+        self.task_times = {}
+        self.lock = Lock()
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def state(self):
+        if not self.alive():
+            return 'restarting'
+        if self.app and self.app.relay:
+            return 'relaying'
+        return 'handshake'
+
+    def start(self):
+        self.calls += 1
+        if self.trace:
+            # a trace per call, the recorder starts its file afresh
+            self.conf.trace = '%s.%s.%d' % (self.trace, self.name, self.calls)
+        self.started = now()
+        self.relay_counts = (0, 0)
+        self.task_times = {}
+        self.thread = Thread(target=self._run, name='line-%s' % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        app = self.app
+        if app:
+            app.stop()
+        if self.thread:
+            self.thread.join(STOP_TIMEOUT)
+
+    def ended(self):
+        '''
+        Collects the finished call and schedules the next one, backing off
+        while calls keep failing quickly
+        '''
+        self.collect()
+        self.thread = None
+        self.app = None
+        if now() - self.started > STABLE_TIME:
+            self.restart_delay = RESTART_DELAY
+        self.restart_at = now() + self.restart_delay
+        self.logger.info('Restarting in %.0fs', self.restart_delay)
+        self.restart_delay = min(MAX_RESTART_DELAY, 2 * self.restart_delay)
+
+    def collect(self):
+        '''
+        Adds what the current call did since the last collect to the totals
+        '''
+        app = self.app
+        if not app:
+            return
+        with self.lock:
+            self._collect(app)
+
+    def _collect(self, app):
+        relay = app.relay
+        if relay:
+            sent, received = relay.sent, relay.received
+            self.sent += sent - self.relay_counts[0]
+            self.received += received - self.relay_counts[1]
+            self.relay_counts = sent, received
+        for tid in list(app.tids):
+            cpu_time = task_cpu_time(tid) if tid else None
+            if cpu_time is None:
+                # exited, what it used since the last collect is lost
+                continue
+            self.cpu_time += cpu_time - self.task_times.get(tid, 0.0)
+            self.task_times[tid] = cpu_time
+
+    def _run(self):
+        gateway = self.gateway
+        try:
+            self.app = VoiZApp(
+                self.conf,
+                gateway.pool,
+                gateway.cache,
+                gateway.keypool,
+                gateway.metrics.scope(self.name)
+            )
+            self.app.run()
+        except Exception:
+            self.failures += 1
+            self.logger.exception('Call failed')
+        finally:
+            # while this thread still exists to be counted
+            self.collect()
+
+class VoiZGateway():
+    '''
+    Supervises the lines, restarting calls as they end, and reports
+    throughput and CPU use per line
+    '''
+
+    def __init__(self, conf, lines):
+        self.logger = getLogger('gateway')
+        self.conf = conf
+        # fork the workers before any other thread is running
+        self.pool = Pool(conf.processes or cpu_count())
+        self.cache = VoiZCache()
+        self.logger.info('Using ZID = 0x%s', self.cache.getZID().encode('hex'))
+        # enough keypairs ready for every line to start at once
+        self.keypool = VoiZKeyPool(
+            conf.dhbits,
+            size=len(lines),
+            path=VOIZ_KEYPOOL_PATH if conf.keypool else None,
+            pool=self.pool
+        )
+        # one registry for all lines, each under its own name
+        self.metrics = VoiZMetrics(bool(conf.metricsfile or conf.metricssocket))
+        self.reporter = None
+        if self.metrics.enabled:
+            self.reporter = VoiZMetricsReporter(self.metrics, conf.metricsfile, conf.metricssocket)
+        self.lines = [VoiZLine(self, entry) for entry in lines]
+        self.stopped = Event()
+
+    def run(self):
+        self.logger.info('Serving %d lines', len(self.lines))
+        self.keypool.start()
+        if self.reporter:
+            self.reporter.start()
+        last = now(), process_cpu_time(), dict((line.name, (0, 0, 0.0)) for line in self.lines)
+        try:
+            while not self.stopped.is_set():
+                for line in self.lines:
+                    if line.thread and not line.alive():
+                        line.ended()
+                    if not line.thread and now() >= line.restart_at:
+                        line.start()
+                self.stopped.wait(min(RESTART_DELAY, STATS_INTERVAL))
+                if now() - last[0] >= STATS_INTERVAL:
+                    last = self.report(*last)
+        finally:
+            for line in self.lines:
+                line.stop()
+            self.keypool.stop()
+            self.pool.terminate()
+            self.cache.close()
+            if self.reporter:
+                self.reporter.stop()
+
+    def stop(self):
+        self.stopped.set()
+
+    def report(self, t0, cpu0, totals0):
+        t = now()
+        interval = t - t0
+        cpu = process_cpu_time()
+        totals = {}
+        sent = received = 0
+        for line in self.lines:
+            line.collect()
+            totals[line.name] = line.sent, line.received, line.cpu_time
+            line_sent, line_received, line_cpu = [
+                (total - total0) for total, total0 in zip(totals[line.name], totals0[line.name])
+            ]
+            sent += line_sent
+            received += line_received
+            self.logger.info(
+                '%-10s %-10s calls %3d failed %3d tx %7.1fB/s rx %7.1fB/s cpu %5.1f%%',
+                line.name,
+                line.state(),
+                line.calls,
+                line.failures,
+                line_sent / interval,
+                line_received / interval,
+                100.0 * line_cpu / interval
+            )
+        # the rest goes to the flowgraphs, dispatchers and keypool
+        self.logger.info(
+            'all %d lines: tx %7.1fB/s rx %7.1fB/s cpu %5.1f%% (%5.1f%% outside the calls)',
+            len(self.lines),
+            sent / interval,
+            received / interval,
+            100.0 * (cpu - cpu0) / interval,
+            100.0 * ((cpu - cpu0) - sum(totals[name][2] - totals0[name][2] for name in totals)) / interval
+        )
+        return t, cpu, totals
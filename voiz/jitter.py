@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''
+Playout buffering for received codec2 packets
+'''
+
+from logging import getLogger
+from time import time as now
+
+MAX_DELAY = 2.0
+JITTER_GAIN = 1 / 16.0      # smoothing of the RFC 3550 interarrival jitter
+JITTER_FACTOR = 3.0         # playout delay added per unit of jitter
+
+# returned by pop() while the buffer is still filling up
+BUFFERING = object()
+
+class VoiZJitterBuffer():
+    '''
+    Orders packets by their counter and releases one per playout slot,
+    delaying the start of playout long enough to ride out the measured
+    arrival jitter
+    '''
+
+    def __init__(self, packet_duration, ctr_step, min_delay):
+        self.logger = getLogger('jitter')
+        self.packet_duration = packet_duration
+        self.ctr_step = ctr_step
+        self.min_delay = min_delay
+        self.packets = {}
+        self.next_ctr = None
+        self.slot_ctr = None
+        self.playing = False
+        self.delay = min_delay
+        self.jitter = 0.0
+        self.last_transit = None
+        # statistics
+        self.received = 0
+        self.played = 0
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+        self.underruns = 0
+        self.latency = 0.0
+
+    def push(self, ctr, payload, arrival=None):
+        arrival = arrival or now()
+        if self.next_ctr is not None and ctr < self.next_ctr:
+            self.late += 1
+            return
+        if ctr in self.packets:
+            self.duplicates += 1
+            return
+        self.received += 1
+        self.packets[ctr] = (arrival, payload)
+        # the counter doubles as the sender's timestamp
+        transit = arrival - ctr / self.ctr_step * self.packet_duration
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) * JITTER_GAIN
+        self.last_transit = transit
+        self.delay = min(MAX_DELAY, self.min_delay + JITTER_FACTOR * self.jitter)
+
+    def set_packet_duration(self, packet_duration):
+        # restart the transit baseline so the change does not read as jitter
+        self.packet_duration = packet_duration
+        self.last_transit = None
+
+    def due(self):
+        '''
+        Returns the time playout can go ahead, None while there is nothing
+        '''
+        if self.playing:
+            return now()
+        if not self.packets:
+            return None
+        return min(arrival for arrival, payload in self.packets.itervalues()) + self.delay
+
+    def pop(self):
+        '''
+        Returns the payload for the next playout slot, None if that slot has
+        to be concealed, or BUFFERING while waiting to build up depth
+        '''
+        if not self.playing:
+            due = self.due()
+            if due is None or due > now():
+                return BUFFERING
+            self.playing = True
+            first_ctr = min(self.packets)
+            if self.next_ctr is None:
+                self.next_ctr = first_ctr
+            elif first_ctr > self.next_ctr:
+                # whatever we were waiting on never turned up
+                self.lost += (first_ctr - self.next_ctr) / self.ctr_step
+                self.next_ctr = first_ctr
+        ctr = self.slot_ctr = self.next_ctr
+        if ctr in self.packets:
+            self.next_ctr += self.ctr_step
+            arrival, payload = self.packets.pop(ctr)
+            self.played += 1
+            self.latency = now() - arrival
+            return payload
+        if self.packets:
+            # a later packet is here, so this one is lost
+            self.next_ctr += self.ctr_step
+            self.lost += 1
+            return None
+        # ran dry: conceal this slot, but the packet is only late so keep
+        # waiting for it and delay playout again
+        self.underruns += 1
+        self.playing = False
+        return None
+
+    def stats(self):
+        return {
+            'received':     self.received,
+            'played':       self.played,
+            'lost':         self.lost,
+            'late':         self.late,
+            'duplicates':   self.duplicates,
+            'underruns':    self.underruns,
+            'depth':        len(self.packets),
+            'delay':        self.delay,
+            'jitter':       self.jitter,
+            'latency':      self.latency,
+        }
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+'''
+Counters and latency histograms for the relay stages and the handshake,
+dumped as JSON to a file or a UNIX socket
+'''
+
+from bisect import bisect_right
+from json import dumps
+from logging import getLogger
+from os import rename, remove
+from os.path import exists
+from select import select
+from socket import socket, error as SocketError, AF_UNIX, SOCK_STREAM
+from threading import Thread, Event, Lock
+from time import time as now
+
+# upper bounds of the histogram buckets in seconds, 10us to ~20s
+HISTOGRAM_BOUNDS = tuple(10e-6 * 2 ** i for i in xrange(22))
+PERCENTILES = (50, 90, 99)
+DUMP_INTERVAL = 10.0
+STOP_POLL = 0.5             # how often a reporter waiting on clients checks for stop()
+
+class VoiZNullMetric():
+    '''
+    Stands in for every counter and histogram while metrics are disabled
+    '''
+
+    def add(self, n=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+NULL_METRIC = VoiZNullMetric()
+
+class VoiZCounter():
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+class VoiZHistogram():
+    '''
+    Counts observations into exponentially growing buckets, enough for
+    percentiles within a factor of two at a bisect per observation
+    '''
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_right(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        snapshot = {
+            'count':    self.count,
+            'sum':      self.sum,
+            'mean':     self.sum / self.count if self.count else 0.0,
+            'max':      self.max,
+        }
+        for p in PERCENTILES:
+            snapshot['p%d' % p] = self.percentile(p) if self.count else 0.0
+        return snapshot
+
+class VoiZPhaseTimer():
+    '''
+    Times consecutive phases of an exchange into histograms under a prefix
+    '''
+
+    def __init__(self, metrics, prefix):
+        self.metrics = metrics
+        self.prefix = prefix
+        self.restart()
+
+    def restart(self):
+        self.start = self.last = now()
+
+    def mark(self, phase):
+        t = now()
+        self.metrics.histogram('%s.%s' % (self.prefix, phase)).observe(t - self.last)
+        self.last = t
+
+    def done(self, ok):
+        self.metrics.histogram('%s.total' % self.prefix).observe(now() - self.start)
+        self.metrics.counter('%s.%s' % (self.prefix, 'ok' if ok else 'failed')).add()
+
+class VoiZMetrics():
+    '''
+    Registry of named counters, histograms and gauges. Disabled, it hands
+    out a shared no-op metric, so instrumented code costs a method call.
+    Stages look their metrics up once and keep them, the registry is only
+    locked when a name is first used
+    '''
+
+    def __init__(self, enabled=False, prefix=''):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = Lock()
+        self.metrics = {}
+        self.gauges = {}
+        self.started = now()
+
+    def scope(self, prefix):
+        '''
+        Returns a view that puts prefix in front of every name, sharing
+        this registry
+        '''
+        scoped = VoiZMetrics(self.enabled, self.prefix + prefix + '.')
+        scoped.lock = self.lock
+        scoped.metrics = self.metrics
+        scoped.gauges = self.gauges
+        scoped.started = self.started
+        return scoped
+
+    def _get(self, name, kind):
+        if not self.enabled:
+            return NULL_METRIC
+        name = self.prefix + name
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, kind())
+        return metric
+
+    def counter(self, name):
+        return self._get(name, VoiZCounter)
+
+    def histogram(self, name):
+        return self._get(name, VoiZHistogram)
+
+    def gauge(self, name, fn):
+        '''
+        Registers fn to be called for a value whenever a snapshot is taken
+        '''
+        if self.enabled:
+            with self.lock:
+                self.gauges[self.prefix + name] = fn
+
+    def unregister_gauges(self, prefix=''):
+        with self.lock:
+            for name in self.gauges.keys():
+                if name.startswith(self.prefix + prefix):
+                    del self.gauges[name]
+
+    def phases(self, prefix):
+        return VoiZPhaseTimer(self, prefix)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = self.metrics.items()
+            gauges = self.gauges.items()
+        snapshot = {
+            'time':     now(),
+            'uptime':   now() - self.started,
+        }
+        for name, metric in metrics:
+            snapshot[name] = metric.snapshot()
+        for name, fn in gauges:
+            try:
+                snapshot[name] = fn()
+            except Exception as e:
+                snapshot[name] = repr(e)
+        return snapshot
+
+class VoiZMetricsReporter(Thread):
+    '''
+    Rewrites a JSON snapshot to `path` every `interval` seconds, and/or
+    writes one to every client connecting to the UNIX socket `sock_path`
+    '''
+
+    def __init__(self, metrics, path=None, sock_path=None, interval=DUMP_INTERVAL):
+        Thread.__init__(self, name='metrics')
+        self.daemon = True
+        self.logger = getLogger('metrics')
+        self.metrics = metrics
+        self.path = path
+        self.sock_path = sock_path
+        self.interval = interval
+        self.stopped = Event()
+        self.sock = None
+        if sock_path:
+            if exists(sock_path):
+                remove(sock_path)
+            self.sock = socket(AF_UNIX, SOCK_STREAM)
+            self.sock.bind(sock_path)
+            self.sock.listen(4)
+            self.logger.info('Serving metrics on `%s`', sock_path)
+
+    def run(self):
+        next_dump = now() + self.interval
+        while not self.stopped.is_set():
+            timeout = max(0, next_dump - now())
+            if self.sock:
+                readable = select([self.sock], [], [], min(timeout, STOP_POLL))[0]
+                if readable:
+                    self.serve()
+            else:
+                self.stopped.wait(timeout)
+            if now() >= next_dump:
+                next_dump += self.interval
+                self.dump()
+        self.dump()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.sock:
+            self.sock.close()
+            remove(self.sock_path)
+
+    def dump(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(dumps(self.metrics.snapshot(), sort_keys=True, indent=1))
+        rename(tmp_path, self.path)
+
+    def serve(self):
+        conn = self.sock.accept()[0]
+        try:
+            conn.sendall(dumps(self.metrics.snapshot(), sort_keys=True) + '\n')
+        except SocketError as e:
+            self.logger.debug('Metrics client went away: %s', e)
+        finally:
+            conn.close()
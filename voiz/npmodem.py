@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+'''
+GFSK modem in NumPy, in place of the tx_block and rx_block flowgraphs.
+Frames on air are the same, so either end may run either backend, but
+audio is processed a block at a time with vectorized filters instead of
+streaming through GNU Radio blocks
+'''
+
+from logging import getLogger
+from math import pi, sqrt, log
+from Queue import Queue
+from threading import Thread
+
+import alsaaudio
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+from .fec import UncorrectableFECException
+from .framing import SAMPLE_RATE, PAYLOAD_LEN, FRAME_OVERHEAD, ZERO, ACCESS_CODE, \
+    ACCESS_CODE_THRESHOLD, FRAME_HEADER, make_packet, parse_header, unmake_packet
+
+BT = 0.35
+SENSITIVITY = 1.0           # radians per sample at sps samples per symbol, as gfsk_mod
+TX_GAIN = 0.5               # tx_modulator's band-pass gain
+HAMMING_ATTENUATION = 53    # dB, what firdes sizes hamming windowed filters by
+MIN_DEMOD_SPS = 4           # samples per symbol left for timing after decimation
+TRACK_SYMBOLS = 64          # symbols between timing adjustments within a frame
+PERIOD = 960                # samples per ALSA period, 20ms
+FULL_SCALE = 32767
+
+ACCESS_CODE_BITS = numpy.unpackbits(numpy.frombuffer(ACCESS_CODE, numpy.uint8)).astype(bool)
+ACCESS_CODE_SIGNS = ACCESS_CODE_BITS * 2.0 - 1.0
+HEADER_BITS = FRAME_HEADER.size * 8
+
+def gaussian_taps(spb, bt=BT, ntaps=None):
+    # firdes.gaussian
+    ntaps = ntaps or 4 * spb
+    s = 2 * pi * bt / sqrt(log(2.0))
+    t = s / spb * (numpy.arange(ntaps) + 1 - 0.5 * ntaps)
+    taps = numpy.exp(-0.5 * t * t)
+    return taps / taps.sum()
+
+def low_pass_taps(cutoff, transition, rate=SAMPLE_RATE):
+    # firdes.low_pass with a hamming window, unity gain at DC
+    ntaps = int(HAMMING_ATTENUATION * rate / (22.0 * transition)) | 1
+    n = numpy.arange(ntaps) - (ntaps - 1) / 2
+    taps = numpy.sinc(2.0 * cutoff / rate * n) * numpy.hamming(ntaps)
+    return taps / taps.sum()
+
+def fft_convolve(x, h):
+    size = len(x) + len(h) - 1
+    n = 1 << (size - 1).bit_length()
+    return numpy.fft.ifft(numpy.fft.fft(x, n) * numpy.fft.fft(h, n))[:size]
+
+def demod_decimation(sps, interpolation, sideband, transition):
+    '''
+    Largest factor of the interpolation the receiver can decimate by and
+    keep MIN_DEMOD_SPS samples per symbol and the sideband below Nyquist
+    '''
+    for decimation in xrange(interpolation, 1, -1):
+        if interpolation % decimation:
+            continue
+        if sps * interpolation / decimation < MIN_DEMOD_SPS:
+            continue
+        if SAMPLE_RATE / (2.0 * decimation) < sideband + transition:
+            continue
+        return decimation
+    return 1
+
+class gfsk_modulator():
+    '''
+    Takes frames to real passband audio. The Gaussian pulse is designed
+    at the audio rate and drives the phase directly, which leaves no
+    resampler to run, and the band-pass is applied to the baseband before
+    it is translated up to the carrier
+    '''
+
+    def __init__(   self,
+                    carrier,
+                    sideband,
+                    transition,
+                    sps,
+                    interpolation):
+
+        self.spb = sps * interpolation
+        # gfsk_mod's Gaussian convolved with a symbol long square wave,
+        # scaled to radians per audio sample
+        self.pulse = numpy.convolve(gaussian_taps(self.spb), numpy.ones(self.spb)) * SENSITIVITY / interpolation
+        self.band = low_pass_taps(sideband, transition)
+        self.omega = 2 * pi * carrier / SAMPLE_RATE
+
+    def modulate(self, frame):
+        nrz = numpy.unpackbits(numpy.frombuffer(frame, numpy.uint8)) * 2.0 - 1.0
+        impulses = numpy.zeros(len(nrz) * self.spb)
+        impulses[::self.spb] = nrz
+        phase = numpy.cumsum(numpy.convolve(impulses, self.pulse))
+        baseband = fft_convolve(numpy.exp(1j * phase), self.band)
+        carrier = numpy.exp(1j * self.omega * numpy.arange(len(baseband)))
+        return TX_GAIN * (baseband * carrier).real
+
+class gfsk_demodulator():
+    '''
+    Takes real passband audio, a block at a time, to frames. One polyphase
+    stage selects the band, translates it to baseband and decimates, a
+    quadrature discriminator turns phase steps into soft symbols, and
+    frames are found by correlating for the access code at every sample
+    offset. The best offset gives the symbol timing, which is tracked
+    through the rest of the frame
+    '''
+
+    def __init__(   self,
+                    carrier,
+                    sideband,
+                    transition,
+                    sps,
+                    interpolation,
+                    threshold=ACCESS_CODE_THRESHOLD):
+
+        self.decimation = demod_decimation(sps, interpolation, sideband, transition)
+        self.spb = sps * interpolation / self.decimation
+        self.threshold = threshold
+        omega = 2 * pi * carrier / SAMPLE_RATE
+        # rotated to the carrier, the real input is filtered before it is
+        # translated, and only for the samples kept; reversed for dot()
+        taps = low_pass_taps(sideband, transition)
+        rotated = (taps * numpy.exp(1j * omega * numpy.arange(len(taps))))[::-1]
+        self.taps_re = rotated.real.copy()
+        self.taps_im = rotated.imag.copy()
+        self.step = omega * self.decimation
+        self.phase = 0.0
+        self.pending = numpy.zeros(len(taps) - 1)
+        self.last = 0j
+        # discriminator output not yet searched or read
+        self.soft = numpy.zeros(0)
+        self.in_frame = False
+
+    def channelize(self, samples):
+        pending = numpy.concatenate((self.pending, samples))
+        count = (len(pending) - len(self.taps_re)) // self.decimation + 1
+        if count <= 0:
+            self.pending = pending
+            return numpy.zeros(0, complex)
+        windows = as_strided(
+            pending,
+            (count, len(self.taps_re)),
+            (self.decimation * pending.itemsize, pending.itemsize)
+        )
+        baseband = windows.dot(self.taps_re) + 1j * windows.dot(self.taps_im)
+        self.pending = pending[count * self.decimation:]
+        baseband *= numpy.exp(-1j * (self.phase + self.step * numpy.arange(count)))
+        self.phase = (self.phase + self.step * count) % (2 * pi)
+        return baseband
+
+    def discriminate(self, baseband):
+        if not len(baseband):
+            return baseband.real
+        previous = numpy.concatenate(([self.last], baseband[:-1]))
+        self.last = baseband[-1]
+        return numpy.angle(baseband * previous.conj())
+
+    def demodulate(self, samples):
+        '''
+        Returns (crc ok, payload) for every frame these samples completed
+        '''
+        self.soft = numpy.concatenate((self.soft, self.discriminate(self.channelize(samples))))
+        frames = []
+        while True:
+            if not self.in_frame and not self.search():
+                break
+            frame = self.read_frame()
+            if frame is None:
+                break
+            if frame is not False:
+                frames.append(frame)
+        return frames
+
+    def search(self):
+        '''
+        Looks for an access code, leaving the soft symbols to start at the
+        frame header if one is found
+        '''
+        spb = self.spb
+        offsets = len(self.soft) - (len(ACCESS_CODE_BITS) - 1) * spb
+        if offsets <= 0:
+            return False
+        bits = self.soft > 0
+        matches = numpy.zeros(offsets, int)
+        for i, bit in enumerate(ACCESS_CODE_BITS):
+            matches += bits[i * spb:i * spb + offsets] == bit
+        hits = numpy.flatnonzero(matches >= len(ACCESS_CODE_BITS) - self.threshold)
+        if not len(hits):
+            self.soft = self.soft[offsets:]
+            return False
+        first = hits[0]
+        if first + spb > offsets:
+            # the best offset may be among those not searched yet
+            self.soft = self.soft[first:]
+            return False
+        candidates = first + numpy.arange(spb)
+        symbols = candidates[:, numpy.newaxis] + numpy.arange(len(ACCESS_CODE_BITS)) * spb
+        best = candidates[numpy.argmax(self.soft[symbols].dot(ACCESS_CODE_SIGNS))]
+        self.soft = self.soft[best + len(ACCESS_CODE_BITS) * spb:]
+        self.in_frame = True
+        return True
+
+    def sample(self, symbols):
+        '''
+        Soft symbols at the symbol centres, adjusting the timing a sample
+        either way every TRACK_SYMBOLS towards the largest deviation
+        '''
+        spb = self.spb
+        centres = []
+        offset = 0
+        for start in xrange(0, symbols, TRACK_SYMBOLS):
+            positions = numpy.arange(start, min(symbols, start + TRACK_SYMBOLS)) * spb + offset
+            early = positions[positions > 0] - 1
+            late = positions[positions + 1 < len(self.soft)] + 1
+            energy = abs(self.soft[positions]).mean()
+            if len(early) and abs(self.soft[early]).mean() > energy:
+                offset -= 1
+            elif len(late) and abs(self.soft[late]).mean() > energy:
+                offset += 1
+            centres.append(positions)
+        return numpy.concatenate(centres)
+
+    def read_frame(self):
+        '''
+        Returns the frame following the access code, None while it is
+        still being received, or False if its header is corrupt
+        '''
+        spb = self.spb
+        if len(self.soft) <= HEADER_BITS * spb:
+            return None
+        header = numpy.packbits(self.soft[:HEADER_BITS * spb:spb] > 0).tostring()
+        parsed = parse_header(header)
+        if not parsed or not parsed[0]:
+            self.in_frame = False
+            return False
+        length, offset = parsed
+        symbols = HEADER_BITS + length * 8
+        # room for the timing to drift a sample per TRACK_SYMBOLS
+        if len(self.soft) <= symbols * spb + symbols / TRACK_SYMBOLS + 1:
+            return None
+        centres = self.sample(symbols)
+        payload = numpy.packbits(self.soft[centres[HEADER_BITS:]] > 0).tostring()
+        self.soft = self.soft[centres[-1] + 1:]
+        self.in_frame = False
+        return unmake_packet(payload, offset)
+
+class np_tx_block():
+    '''
+    Stands in for tx_block, modulating frames in a thread of its own and
+    playing them on `looutdev`
+    '''
+
+    def __init__(   self,
+                    carrier,
+                    sideband,
+                    transition,
+                    sps,
+                    interpolation,
+                    looutdev,
+                    varlen=False,
+                    fec=None,
+                    recorder=None):
+
+        self.logger = getLogger('np-tx')
+        self.samp_rate = SAMPLE_RATE
+        self.sps = sps
+        self.interpolation = interpolation
+        self.looutdev = looutdev
+        self.varlen = varlen
+        # FEC frames are longer than the packets they carry
+        self.fec = fec
+        if fec and not varlen:
+            raise ValueError('FEC needs variable length frames')
+        self.recorder = recorder
+        self.modulator = gfsk_modulator(carrier, sideband, transition, sps, interpolation)
+        self.queue = Queue()
+        self.thread = None
+
+    def start(self):
+        self.out = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL, self.looutdev)
+        self.out.setchannels(1)
+        self.out.setrate(SAMPLE_RATE)
+        self.out.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+        self.out.setperiodsize(PERIOD)
+        self.thread = Thread(target=self._run, name='np-tx')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.out.close()
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            audio = self.modulator.modulate(frame)
+            # whole periods, the last one padded with silence
+            audio = numpy.concatenate((audio, numpy.zeros(-len(audio) % PERIOD)))
+            pcm = numpy.clip(audio * FULL_SCALE, -FULL_SCALE, FULL_SCALE).astype('<i2').tostring()
+            for i in xrange(0, len(pcm), PERIOD * 2):
+                self.out.write(pcm[i:i + PERIOD * 2])
+
+    def airtime(self, length=PAYLOAD_LEN, pkt_id=None):
+        # seconds on air for a frame carrying a `length` byte packet
+        if self.fec:
+            length = self.fec.encoded_len(length, pkt_id)
+        elif not self.varlen:
+            length = PAYLOAD_LEN
+        return (length + FRAME_OVERHEAD) * 8.0 * self.sps * self.interpolation / self.samp_rate
+
+    def send_pkt(self, payload):
+        if self.fec:
+            payload = self.fec.encode(payload)
+        if not self.varlen:
+            payload = payload.ljust(PAYLOAD_LEN, ZERO)
+        frame = make_packet(payload)
+        if self.recorder:
+            self.recorder.sent(payload)
+        self.queue.put(frame)
+
+class np_rx_block():
+    '''
+    Stands in for rx_block, demodulating what `lomicdev` captures in a
+    thread of its own
+    '''
+
+    def __init__(   self,
+                    carrier,
+                    sideband,
+                    transition,
+                    sps,
+                    interpolation,
+                    lomicdev,
+                    listen=False,
+                    fec=None,
+                    recorder=None):
+
+        self.logger = getLogger('np-rx')
+        self.samp_rate = SAMPLE_RATE
+        self.lomicdev = lomicdev
+        self.listen = listen
+        self.bad_pkts = 0
+        self.fec = fec
+        self.recorder = recorder
+        self.demodulator = gfsk_demodulator(carrier, sideband, transition, sps, interpolation)
+        self.sink_queue = Queue()
+        self.running = False
+        self.thread = None
+
+    def _open_pcm(self, kind, device):
+        pcm = alsaaudio.PCM(kind, alsaaudio.PCM_NORMAL, device)
+        pcm.setchannels(1)
+        pcm.setrate(SAMPLE_RATE)
+        pcm.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+        pcm.setperiodsize(PERIOD)
+        return pcm
+
+    def start(self):
+        self.inp = self._open_pcm(alsaaudio.PCM_CAPTURE, self.lomicdev)
+        # sound playback
+        self.out = self._open_pcm(alsaaudio.PCM_PLAYBACK, 'plughw:0,0') if self.listen else None
+        self.running = True
+        self.thread = Thread(target=self._run, name='np-rx')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+            self.inp.close()
+            if self.out:
+                self.out.close()
+
+    def _run(self):
+        while self.running:
+            num_frames, data = self.inp.read()
+            if num_frames <= 0:
+                continue
+            if self.out:
+                self.out.write(data)
+            samples = numpy.frombuffer(data, '<i2') / float(FULL_SCALE)
+            for ok, payload in self.demodulator.demodulate(samples):
+                self.deliver_pkt(ok, payload)
+
+    def deliver_pkt(self, ok, payload):
+        if self.recorder:
+            self.recorder.received(ok, payload)
+        if self.fec:
+            # frames that failed the CRC may still be correctable
+            try:
+                payload = self.fec.decode(payload, ok)
+                ok = True
+            except UncorrectableFECException:
+                ok = False
+        if ok:
+            self.sink_queue.put(payload)
+        else:
+            self.bad_pkts += 1
+
+    def recv_pkt(self):
+        if not self.sink_queue.empty():
+            return self.sink_queue.get()
+
+    def wait_pkt(self):
+        # blocks until the demodulator delivers a packet or the queue is closed
+        return self.sink_queue.get()
+
+    def close_queue(self):
+        self.sink_queue.put(None)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+'''
+Per-thread CPU accounting from Linux procfs
+'''
+
+from os import readlink, sysconf
+
+CLK_TCK = sysconf('SC_CLK_TCK')
+
+def gettid():
+    '''
+    Returns the kernel thread ID of the calling thread, None off Linux
+    '''
+    try:
+        return int(readlink('/proc/thread-self').rsplit('/', 1)[1])
+    except (OSError, ValueError):
+        return None
+
+def task_cpu_time(tid):
+    '''
+    Returns the user + system CPU seconds used by a thread of this process,
+    None once it has exited
+    '''
+    try:
+        with open('/proc/self/task/%d/stat' % tid) as fp:
+            stat = fp.read()
+    except IOError:
+        return None
+    # the command name may contain spaces, the fields after it do not
+    fields = stat.rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(CLK_TCK)
+
+def process_cpu_time():
+    with open('/proc/self/stat') as fp:
+        fields = fp.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(CLK_TCK)
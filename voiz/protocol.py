@@ -2,8 +2,10 @@
 
 from logging import getLogger
 from struct import Struct
+from time import time as now
 
 from .crypto import InvalidHMACException
+from .metrics import VoiZMetrics
 
 PKT_HELLO       = 0x00
 PKT_HELLOACK    = 0x01  # unused
@@ -22,45 +24,169 @@ PKT_DHPART2     = 0x0d
 PKT_CONFIRM1    = 0x0e
 PKT_CONFIRM2    = 0x0f
 PKT_CODEC2      = 0x10
+PKT_DHPARTNACK  = 0x11
+PKT_COMMITPS    = 0x12
+PKT_C2MODE      = 0x13
+PKT_CODEC2C     = 0x14  # compact codec2 data
 
-ULONG_PACK = Struct('!Q').pack
-ULONG_UNPACK = Struct('!Q').unpack
+PKTS_CODEC2 = (PKT_CODEC2, PKT_CODEC2C)
+
+# kinds of PKT_C2MODE
+C2MODE_REQUEST  = 0x00  # asks the peer to send in a mode
+C2MODE_ANNOUNCE = 0x01  # tells the peer which counter a mode starts at
+
+# flags in PKT_HELLO, the high nibble holds the voice tag length wanted
+HELLO_COMPACT_VOICE = 0x01
+HELLO_TAG_SHIFT     = 4
+
+CODEC2_PAYLOAD_LEN = 63
+# cipher blocks per codec2 packet, by which the packet counter advances
+CODEC2_CTR_STEP = (1 + CODEC2_PAYLOAD_LEN) / 16
+
+# wire layouts, the HMAC is always the last field
+HELLO_LAYOUT        = Struct('!B32s12sB8s')         # id, h3, zid, flags
+COMMIT_LAYOUT       = Struct('!B32s12s8s8s')        # id, h2, zid, counter suffix
+COMMITPS_LAYOUT     = Struct('!B32s12s8s8s8s8s')    # id, h2, zid, counter suffix, rs id, nonce
+DHPART_LAYOUT       = Struct('!32s8s8s256s8s')      # h1, rs1 id, rs2 id, public key
+DHPARTNACK_LAYOUT   = Struct('!BBB')                # id, first fragment id, missing mask
+CONFIRM_LAYOUT      = Struct('!B8s32s')             # id, hmac, encrypted h0
+CODEC2_HEADER       = Struct('!BQ')                 # id, counter
+C2MODE_LAYOUT       = Struct('!BBHQ8s')             # id, kind, mode, first counter
+COMPACT_HEADER      = Struct('!BH')                 # id, low bits of the counter
+HMAC_LEN = 8
+MIN_TAG_LEN = 4
+COMPACT_CTR_SPAN = 1 << 16
+
+# unpadded packet lengths, including the trailing HMAC
+HELLO_LEN       = HELLO_LAYOUT.size
+COMMIT_LEN      = COMMIT_LAYOUT.size
+COMMITPS_LEN    = COMMITPS_LAYOUT.size
+CODEC2_LEN      = CODEC2_HEADER.size + 1 + CODEC2_PAYLOAD_LEN + HMAC_LEN
+
+PKTS_DHPART1 = tuple(range(PKT_DHPART11, PKT_DHPART15 + 1))
+PKTS_DHPART2 = tuple(range(PKT_DHPART21, PKT_DHPART25 + 1))
+# unpadded length of each DH-part fragment, including the ID byte
+DHPART_FRAGMENT_LENS = (64, 64, 64, 64, 61)
 
 PKT_CODEC2_CHR = chr(PKT_CODEC2)
 
+def compact_payload_len(tag_len):
+    # compact codec2 packets are as long as full ones, the header bytes
+    # they save go to speech
+    return CODEC2_LEN - COMPACT_HEADER.size - tag_len
+
+def expand_ctr(low, last):
+    '''
+    Rebuilds a full counter from its low bits, picking the value closest
+    to the last counter accepted
+    '''
+    ctr = last - last % COMPACT_CTR_SPAN + low
+    if ctr > last + COMPACT_CTR_SPAN / 2 and ctr >= COMPACT_CTR_SPAN:
+        ctr -= COMPACT_CTR_SPAN
+    elif ctr < last - COMPACT_CTR_SPAN / 2:
+        ctr += COMPACT_CTR_SPAN
+    return ctr
+
 class VoiZPacketFactory():
 
-    def __init__(self, cache, mac):
+    def __init__(self, cache, mac, metrics=None):
         self.logger = getLogger('pkt-factory')
         self.cache = cache
         self.mac = mac
+        metrics = metrics or VoiZMetrics()
+        self.verify_time = metrics.histogram('verify')
+        self.verify_failed = metrics.counter('verify.failed')
+        self.decrypt_time = metrics.histogram('decrypt')
+        # voice format offered in our HELLO and the one settled on
+        self.offer_voice_format(False)
+        self.compact = False
+        self.tag_len = HMAC_LEN
+        self.codec2_room = CODEC2_PAYLOAD_LEN
+        self.codec2_ctr_step = CODEC2_CTR_STEP
+
+    def _seal(self, layout, hmac, *fields):
+        # packs the fields and fills in the trailing HMAC in place
+        pkt = bytearray(layout.size)
+        layout.pack_into(pkt, 0, *(fields + ('',)))
+        pkt[-HMAC_LEN:] = hmac(memoryview(pkt)[:-HMAC_LEN])[:HMAC_LEN]
+        return str(pkt)
+
+    def offer_voice_format(self, compact, tag_len=HMAC_LEN):
+        self.hello_flags = (HELLO_COMPACT_VOICE if compact else 0) | tag_len << HELLO_TAG_SHIFT
 
-    def gen_pkt_payload_hello(self):
-        return chr(PKT_HELLO) + self.mac.h3 + self.cache.getZID()
+    def accept_voice_format(self, flags):
+        '''
+        Settles the codec2 packet format from the flags in the peer's HELLO,
+        both ends come to the same result from the two HELLOs
+        '''
+        self.compact = bool(self.hello_flags & flags & HELLO_COMPACT_VOICE)
+        if not self.compact:
+            return
+        # the longer of the two tags asked for
+        tag_len = max(self.hello_flags >> HELLO_TAG_SHIFT, flags >> HELLO_TAG_SHIFT)
+        self.tag_len = min(HMAC_LEN, max(MIN_TAG_LEN, tag_len))
+        self.codec2_room = compact_payload_len(self.tag_len)
+        # every packet takes the same number of cipher blocks
+        self.codec2_ctr_step = (self.codec2_room + 15) / 16
+        self.logger.debug(
+            'Compact codec2 packets with %d byte tags and %d bytes of speech',
+            self.tag_len, self.codec2_room
+        )
 
     def gen_pkt_hello(self):
-        payload = self.gen_pkt_payload_hello()
-        return payload + self.mac.hmac_h2(payload)[:8]
+        return self._seal(
+            HELLO_LAYOUT,
+            self.mac.hmac_h2,
+            PKT_HELLO,
+            self.mac.h3,
+            self.cache.getZID(),
+            self.hello_flags
+        )
 
     def dct_pkt_hello(self, pkt):
-        return pkt[1:33], pkt[33:45], pkt[45:53]
-
-    def gen_pkt_payload_commit(self):
-        return chr(PKT_COMMIT) + self.mac.h2 + self.cache.getZID() + self.mac.generateCounterSuffix()
+        return HELLO_LAYOUT.unpack_from(pkt)[1:]
 
     def gen_pkt_commit(self):
-        payload = self.gen_pkt_payload_commit()
-        return payload + self.mac.hmac_h1(payload)[:8]
+        return self._seal(
+            COMMIT_LAYOUT,
+            self.mac.hmac_h1,
+            PKT_COMMIT,
+            self.mac.h2,
+            self.cache.getZID(),
+            self.mac.generateCounterSuffix()
+        )
 
     def dct_pkt_commit(self, pkt):
-        return pkt[1:33], pkt[33:45], pkt[45:53], pkt[53:61]
+        return COMMIT_LAYOUT.unpack_from(pkt)[1:]
+
+    def gen_pkt_commitps(self, rs):
+        return self._seal(
+            COMMITPS_LAYOUT,
+            self.mac.hmac_h1,
+            PKT_COMMITPS,
+            self.mac.h2,
+            self.cache.getZID(),
+            self.mac.generateCounterSuffix(),
+            self.mac.retainedSecretID(rs, 'Initiator'),
+            self.mac.generateNonce()
+        )
+
+    def dct_pkt_commitps(self, pkt):
+        return COMMITPS_LAYOUT.unpack_from(pkt)[1:]
 
-    def gen_pkt_payload_dhpart1(self):
-        return self.mac.h1 + ('\x00' * 8 * 2) + self.mac.packedPublicKey()
+    def gen_pkt_payload_dhpart1(self, zid, role):
+        # only one secret is retained per peer, so the rs2 ID stays zero
+        return self._seal(
+            DHPART_LAYOUT,
+            self.mac.hmac_h0,
+            self.mac.h1,
+            self.mac.retainedSecretID(self.cache.getRetainedSecret(zid), role),
+            self.mac.retainedSecretID(None, role),
+            self.mac.packedPublicKey()
+        )
 
-    def gen_pkts_dhpart1(self):
-        payload = self.gen_pkt_payload_dhpart1()
-        payload += self.mac.hmac_h0(payload)[:8]
+    def gen_pkts_dhpart1(self, izid):
+        payload = self.gen_pkt_payload_dhpart1(izid, 'Responder')
         return [
             chr(PKT_DHPART11) + payload[0:63],
             chr(PKT_DHPART12) + payload[63:126],
@@ -69,9 +195,8 @@ class VoiZPacketFactory():
             chr(PKT_DHPART15) + payload[252:312],
         ]
 
-    def gen_pkts_dhpart2(self):
-        payload = self.gen_pkt_payload_dhpart1()
-        payload += self.mac.hmac_h0(payload)[:8]
+    def gen_pkts_dhpart2(self, rzid):
+        payload = self.gen_pkt_payload_dhpart1(rzid, 'Initiator')
         return [
             chr(PKT_DHPART21) + payload[0:63],
             chr(PKT_DHPART22) + payload[63:126],
@@ -81,35 +206,118 @@ class VoiZPacketFactory():
         ]
 
     def dct_pkts_dhpart1(self, pkt):
-        return pkt[1:33], pkt[33:41], pkt[41:49], pkt[49:305], pkt[305:313]
+        # skips the ID byte of the first fragment
+        return DHPART_LAYOUT.unpack_from(pkt, 1)
+
+    def gen_pkt_dhpartnack(self, first_id, missing_ids):
+        mask = 0
+        for pkt_id in missing_ids:
+            mask |= 1 << (pkt_id - first_id)
+        return DHPARTNACK_LAYOUT.pack(PKT_DHPARTNACK, first_id, mask)
+
+    def dct_pkt_dhpartnack(self, pkt):
+        pkt_id, first_id, mask = DHPARTNACK_LAYOUT.unpack_from(pkt)
+        missing_ids = [first_id + i for i in range(len(DHPART_FRAGMENT_LENS)) if mask & (1 << i)]
+        return first_id, missing_ids
 
     def gen_pkt_confirm1(self):
         # encrypt h0
         enc_h0 = self.mac.encrypt(self.mac.h0)
-        confirmmackey = self.mac.hmac_s0('Responder HMAC key')
-        confirmmac = self.mac.getHMAC(confirmmackey, enc_h0)
-        return chr(PKT_CONFIRM1) + confirmmac[:8] + enc_h0
+        confirmmac = self.mac.sessionMAC('Responder HMAC key', enc_h0)
+        return CONFIRM_LAYOUT.pack(PKT_CONFIRM1, confirmmac[:HMAC_LEN], enc_h0)
 
     def gen_pkt_confirm2(self):
         # encrypt h0
         enc_h0 = self.mac.encrypt(self.mac.h0)
-        confirmmackey = self.mac.hmac_s0('Initiator HMAC key')
-        confirmmac = self.mac.getHMAC(confirmmackey, enc_h0)
-        return chr(PKT_CONFIRM2) + confirmmac[:8] + enc_h0
+        confirmmac = self.mac.sessionMAC('Initiator HMAC key', enc_h0)
+        return CONFIRM_LAYOUT.pack(PKT_CONFIRM2, confirmmac[:HMAC_LEN], enc_h0)
 
     def dct_pkt_confirm1(self, pkt):
-        return pkt[1:9], pkt[9:41]
+        return CONFIRM_LAYOUT.unpack_from(pkt)[1:]
 
     def gen_pkt_codec2(self, payload):
-        packed_encctr = ULONG_PACK(self.mac.encctr)
-        pkt = PKT_CODEC2_CHR + packed_encctr + self.mac.encrypt(PKT_CODEC2_CHR + payload)
-        mackey = self.mac.hmac_s0(packed_encctr)
-        return pkt + self.mac.getHMAC(mackey, pkt)[:8]
+        # payload is shorter than CODEC2_PAYLOAD_LEN in modes whose frames
+        # do not fill it
+        if self.compact:
+            return self.gen_pkt_codec2c(payload)
+        pkt = CODEC2_HEADER.pack(PKT_CODEC2, self.mac.encctr) + \
+            self.mac.encrypt(PKT_CODEC2_CHR + payload.ljust(CODEC2_PAYLOAD_LEN, '\x00'))
+        return pkt + self.mac.packetMAC(pkt)[:HMAC_LEN]
 
     def dct_pkt_codec2(self, pkt):
-        packed_ctr = pkt[1:9]
-        mackey = self.mac.hmac_s0(packed_ctr)
-        if not self.mac.verifyPacketHMAC(mackey, pkt[:73], pkt[73:81]):
+        if ord(pkt[0]) == PKT_CODEC2C:
+            return self.dct_pkt_codec2c(pkt)
+        start = now()
+        valid = self.mac.verifyPacketMAC(pkt[:CODEC2_LEN - HMAC_LEN], pkt[CODEC2_LEN - HMAC_LEN:CODEC2_LEN])
+        self.verify_time.observe(now() - start)
+        if not valid:
+            self.verify_failed.add()
             raise InvalidHMACException('Bad HMAC in codec2 data packet')
-        ctr = ULONG_UNPACK(packed_ctr)[0]
-        return self.mac.decrypt(pkt[9:73], ctr)[1:64]
\ No newline at end of file
+        pkt_id, ctr = CODEC2_HEADER.unpack_from(pkt)
+        start = now()
+        c2data = self.mac.decrypt(pkt[CODEC2_HEADER.size:CODEC2_LEN - HMAC_LEN], ctr)[1:]
+        self.decrypt_time.observe(now() - start)
+        return ctr, c2data
+
+    def gen_pkt_codec2c(self, payload):
+        # only the low bits of the counter and a short tag go on air, but
+        # the tag covers the full counter
+        ctr = self.mac.encctr
+        ciphertext = self.mac.encrypt(payload.ljust(self.codec2_room, '\x00'))
+        return COMPACT_HEADER.pack(PKT_CODEC2C, ctr % COMPACT_CTR_SPAN) + ciphertext + \
+            self.mac.packetMAC(CODEC2_HEADER.pack(PKT_CODEC2C, ctr) + ciphertext)[:self.tag_len]
+
+    def dct_pkt_codec2c(self, pkt):
+        pkt_id, low = COMPACT_HEADER.unpack_from(pkt)
+        ctr = expand_ctr(low, self.mac.decctr)
+        ciphertext = pkt[COMPACT_HEADER.size:CODEC2_LEN - self.tag_len]
+        start = now()
+        valid = self.mac.verifyPacketMAC(
+            CODEC2_HEADER.pack(PKT_CODEC2C, ctr) + ciphertext,
+            pkt[CODEC2_LEN - self.tag_len:CODEC2_LEN],
+            self.tag_len
+        )
+        self.verify_time.observe(now() - start)
+        if not valid:
+            self.verify_failed.add()
+            raise InvalidHMACException('Bad HMAC in compact codec2 data packet')
+        start = now()
+        c2data = self.mac.decrypt(ciphertext, ctr)
+        self.decrypt_time.observe(now() - start)
+        return ctr, c2data
+
+    def gen_pkt_c2mode(self, kind, mode, ctr=0):
+        return self._seal(C2MODE_LAYOUT, self.mac.packetMAC, PKT_C2MODE, kind, mode, ctr)
+
+    def dct_pkt_c2mode(self, pkt):
+        if not self.mac.verifyPacketMAC(pkt[:C2MODE_LAYOUT.size - HMAC_LEN], pkt[C2MODE_LAYOUT.size - HMAC_LEN:C2MODE_LAYOUT.size]):
+            raise InvalidHMACException('Bad HMAC in codec2 mode packet')
+        return C2MODE_LAYOUT.unpack_from(pkt)[1:4]
+
+class VoiZFragmentBuffer():
+    '''
+    Collects DH-part fragments in any order until all of them are present
+    '''
+
+    def __init__(self, first_id):
+        self.first_id = first_id
+        self.ids = tuple(range(first_id, first_id + len(DHPART_FRAGMENT_LENS)))
+        self.fragments = {}
+
+    def add(self, pkt):
+        pkt_id = ord(pkt[0])
+        if pkt_id in self.ids and pkt_id not in self.fragments:
+            self.fragments[pkt_id] = pkt[:DHPART_FRAGMENT_LENS[pkt_id - self.first_id]]
+
+    def complete(self):
+        return len(self.fragments) == len(self.ids)
+
+    def missing(self):
+        return tuple(pkt_id for pkt_id in self.ids if pkt_id not in self.fragments)
+
+    def pkts(self):
+        return [self.fragments[pkt_id] for pkt_id in self.ids]
+
+    def payload(self):
+        pkts = self.pkts()
+        return pkts[0] + ''.join(pkt[1:] for pkt in pkts[1:])
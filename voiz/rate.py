@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Picks the codec2 mode the peer should send with from receive statistics
+'''
+
+from logging import getLogger
+from time import time as now
+
+# slowest to fastest
+CODEC2_LADDER = (1200, 1300, 1400, 1600, 2400, 3200)
+
+RATE_INTERVAL = 5.0         # seconds of statistics behind each decision
+STEP_DOWN_LOSS = 0.10
+STEP_UP_LOSS = 0.02
+STEP_UP_JITTER = 0.05
+STEP_UP_INTERVALS = 2       # clean intervals in a row before stepping up
+REQUEST_RETRY = 3.0
+# a packet has to go on air in this fraction of the audio it carries
+AIRTIME_MARGIN = 0.8
+
+class VoiZRateControl():
+    '''
+    Watches loss, HMAC failures and jitter on the receive path, steps the
+    peer's codec2 mode down when packets go missing and back up once the
+    line has been clean for a while
+    '''
+
+    def __init__(self, mode, airtime, packet_duration):
+        self.logger = getLogger('rate')
+        self.mode = mode
+        # modes whose packets the modem can keep up with
+        self.ladder = tuple(m for m in CODEC2_LADDER if airtime <= packet_duration(m) * AIRTIME_MARGIN)
+        if mode not in self.ladder:
+            self.ladder = tuple(sorted(self.ladder + (mode,)))
+        self.logger.debug('Usable codec2 modes: %r', self.ladder)
+        self.requested = None
+        self.requested_time = 0.0
+        self.clean_intervals = 0
+        self.interval_start = now()
+        self.last = {'received': 0, 'lost': 0, 'late': 0, 'hmac_failures': 0}
+
+    def confirmed(self, mode):
+        # the peer announced the mode it sends with, which settles any
+        # outstanding request even if it could not go along with it
+        self.mode = mode
+        self.requested = None
+
+    def update(self, stats, hmac_failures):
+        '''
+        Returns a mode to request from the peer, or None to leave it be
+        '''
+        t = now()
+        if self.requested is not None:
+            if t - self.requested_time > REQUEST_RETRY:
+                self.requested_time = t
+                return self.requested
+            return None
+        if t - self.interval_start < RATE_INTERVAL:
+            return None
+        self.interval_start = t
+        current = dict(stats, hmac_failures=hmac_failures)
+        delta = dict((key, current[key] - self.last[key]) for key in self.last)
+        self.last = dict((key, current[key]) for key in self.last)
+        missing = delta['lost'] + delta['late'] + delta['hmac_failures']
+        total = delta['received'] + delta['lost'] + delta['hmac_failures']
+        if total == 0:
+            return None
+        loss = missing / float(total)
+        index = self.ladder.index(self.mode)
+        if loss > STEP_DOWN_LOSS and index > 0:
+            self.clean_intervals = 0
+            return self._request(self.ladder[index - 1], loss, stats['jitter'])
+        if loss <= STEP_UP_LOSS and stats['jitter'] <= STEP_UP_JITTER:
+            self.clean_intervals += 1
+            if self.clean_intervals >= STEP_UP_INTERVALS and index < len(self.ladder) - 1:
+                self.clean_intervals = 0
+                return self._request(self.ladder[index + 1], loss, stats['jitter'])
+        else:
+            self.clean_intervals = 0
+        return None
+
+    def _request(self, mode, loss, jitter):
+        self.logger.info(
+            'Asking peer for codec2 %d (loss %.1f%%, jitter %.0fms)',
+            mode, loss * 100, jitter * 1000
+        )
+        self.requested = mode
+        self.requested_time = now()
+        return mode
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+'''
+Full-duplex voice relay as a pipeline of threads, one per stage
+'''
+
+from logging import getLogger
+from select import poll
+from threading import Thread, Event
+from time import time as now
+
+from .c2 import codec2_payload_len, codec2_packet_duration, CODEC2_MODE
+from .crypto import InvalidHMACException
+from .proc import gettid
+from .rate import VoiZRateControl
+from .protocol import *
+
+RING_LEN = 32
+STAGE_TIMEOUT = 0.1         # how often an idle stage checks for shutdown
+PLAYBACK_TICK = 0.02        # playback polls the device this often while it has audio
+# codec2 packets that each carry a copy of a mode announcement behind them
+C2MODE_ANNOUNCE_REPEAT = 3
+
+RELAY_PKTS = (PKT_C2MODE,) + PKTS_CODEC2
+
+def register_fds(poller, old_fds, fds):
+    # fds change when a codec pipe is restarted for a new mode
+    fds = dict(fds)
+    for fd in set(old_fds) - set(fds):
+        poller.unregister(fd)
+    for fd, mask in fds.iteritems():
+        poller.register(fd, mask)
+    return fds
+
+def wait_rings(ready, rings, timeout):
+    # rings feeding the same stage share its ready event
+    if not any(len(ring) for ring in rings):
+        ready.wait(timeout)
+    ready.clear()
+
+class VoiZRing():
+    '''
+    Bounded ring between one producer and one consumer thread. Only the
+    producer moves head and only the consumer moves tail, so neither side
+    takes a lock; a full ring drops the new item rather than block
+    '''
+
+    def __init__(self, size=RING_LEN, ready=None):
+        self.slots = [None] * size
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.ready = ready or Event()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def put(self, item):
+        if self.head - self.tail >= self.size:
+            self.dropped += 1
+            return False
+        self.slots[self.head % self.size] = item
+        # publish only once the slot holds the item
+        self.head += 1
+        self.ready.set()
+        return True
+
+    def get(self):
+        if self.tail == self.head:
+            return None
+        i = self.tail % self.size
+        item = self.slots[i]
+        self.slots[i] = None
+        self.tail += 1
+        return item
+
+    def wait(self, timeout):
+        wait_rings(self.ready, (self,), timeout)
+
+class VoiZRelay():
+    '''
+    Moves voice both ways through capture -> encrypt -> transmit and
+    receive -> verify -> playback threads, so that a slow step in one
+    direction does not hold up the other
+    '''
+
+    def __init__(self, app, voice_src, voice_sink):
+        self.logger = getLogger('relay')
+        self.app = app
+        self.pkt_factory = app.pkt_factory
+        self.voice_src = voice_src
+        self.voice_sink = voice_sink
+        # room for speech in each packet depends on the negotiated format
+        self.room = self.pkt_factory.codec2_room
+        self.rate = VoiZRateControl(
+            CODEC2_MODE,
+            app.tx.airtime(CODEC2_LEN, PKT_CODEC2),
+            lambda mode: codec2_packet_duration(mode, self.room)
+        )
+        # mode the peer asked us to send in, switched to at a packet boundary
+        self.src_mode = None
+        self.hmac_failures = 0
+        # bytes handed to the modem and received from it
+        self.sent = 0
+        self.received = 0
+        self.metrics = metrics = app.metrics
+        self.capture_time = metrics.histogram('capture')
+        self.encrypt_time = metrics.histogram('encrypt')
+        self.tx_queue_time = metrics.histogram('tx.queue')
+        self.tx_time = metrics.histogram('tx.send')
+        self.tx_packets = metrics.counter('tx.packets')
+        self.rx_interval = metrics.histogram('rx.arrival')
+        self.rx_packets = metrics.counter('rx.packets')
+        self.rx_bytes = metrics.counter('rx.bytes')
+        self.playback_time = metrics.histogram('playback')
+        # the encrypt stage takes both voice and control items
+        encrypt_ready = Event()
+        self.rings = {
+            'captured':     VoiZRing(ready=encrypt_ready),
+            'control':      VoiZRing(ready=encrypt_ready),
+            'outgoing':     VoiZRing(),
+            'incoming':     VoiZRing(),
+            'decoded':      VoiZRing(),
+        }
+        self.running = False
+        self.stopped = Event()
+        self.threads = [
+            Thread(target=self._stage, args=(stage,), name=stage.__name__)
+            for stage in (self.capture, self.encrypt, self.transmit, self.receive, self.verify, self.playback)
+        ]
+
+    def start(self):
+        for name, ring in self.rings.iteritems():
+            self.metrics.gauge('relay.%s.depth' % name, ring.__len__)
+            self.metrics.gauge('relay.%s.dropped' % name, lambda ring=ring: ring.dropped)
+        self.running = True
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.metrics.unregister_gauges('relay.')
+
+    def wait(self, timeout):
+        '''
+        Returns False once the relay has stopped
+        '''
+        self.stopped.wait(timeout)
+        return self.running
+
+    def depths(self):
+        return dict((name, len(ring)) for name, ring in self.rings.iteritems())
+
+    def dropped(self):
+        return dict((name, ring.dropped) for name, ring in self.rings.iteritems())
+
+    def _stage(self, stage):
+        self.app.tids.add(gettid())
+        try:
+            stage()
+        except Exception:
+            self.logger.exception('Relay stage %s failed', stage.__name__)
+            self.running = False
+            self.stopped.set()
+
+    def capture(self):
+        captured = self.rings['captured']
+        poller = poll()
+        src_fds = register_fds(poller, {}, self.voice_src.poll_fds())
+        frame_len = codec2_payload_len(self.voice_src.mode, self.room)
+        src_samples = ''
+        while self.running:
+            if not poller.poll(STAGE_TIMEOUT * 1000):
+                continue
+            start = now()
+            src_samples += self.voice_src.read()
+            self.capture_time.observe(now() - start)
+            if len(src_samples) >= frame_len:
+                # one slice per packet and one for the rest, rather than
+                # shifting the buffer after every packet
+                end = len(src_samples) - len(src_samples) % frame_len
+                for i in xrange(0, end, frame_len):
+                    captured.put(('voice', src_samples[i:i + frame_len]))
+                src_samples = src_samples[end:]
+            # frames go out whole, so this is a packet boundary
+            mode = self.src_mode
+            if mode is not None and not src_samples:
+                self.src_mode = None
+                self.voice_src.set_mode(mode)
+                if self.voice_src.mode != mode:
+                    # the source could not switch, tell the peer what it gets
+                    captured.put(('answer', self.voice_src.mode))
+                    continue
+                src_fds = register_fds(poller, src_fds, self.voice_src.poll_fds())
+                frame_len = codec2_payload_len(mode, self.room)
+                captured.put(('mode', mode))
+
+    def encrypt(self):
+        captured = self.rings['captured']
+        control = self.rings['control']
+        outgoing = self.rings['outgoing']
+        announce_pkt = None
+        announce_left = 0
+        while self.running:
+            wait_rings(captured.ready, (captured, control), STAGE_TIMEOUT)
+            item = control.get()
+            while item:
+                kind, mode = item
+                if kind == 'request':
+                    outgoing.put((now(), self.pkt_factory.gen_pkt_c2mode(C2MODE_REQUEST, mode)))
+                else:
+                    # nothing to switch, answer with the mode we send in
+                    announce_pkt = announce_pkt or self.pkt_factory.gen_pkt_c2mode(C2MODE_ANNOUNCE, mode, 1)
+                    outgoing.put((now(), announce_pkt))
+                item = control.get()
+            item = captured.get()
+            while item:
+                kind, value = item
+                if kind == 'voice':
+                    start = now()
+                    pkt = self.pkt_factory.gen_pkt_codec2(value)
+                    self.encrypt_time.observe(now() - start)
+                    outgoing.put((start, pkt))
+                    if announce_left:
+                        outgoing.put((start, announce_pkt))
+                        announce_left -= 1
+                elif kind == 'answer':
+                    announce_pkt = announce_pkt or self.pkt_factory.gen_pkt_c2mode(C2MODE_ANNOUNCE, value, 1)
+                    outgoing.put((now(), announce_pkt))
+                else:
+                    # the new mode starts with the next packet encrypted
+                    announce_pkt = self.pkt_factory.gen_pkt_c2mode(C2MODE_ANNOUNCE, value, self.app.mac.encctr)
+                    announce_left = C2MODE_ANNOUNCE_REPEAT
+                    outgoing.put((now(), announce_pkt))
+                item = captured.get()
+
+    def transmit(self):
+        outgoing = self.rings['outgoing']
+        while self.running:
+            outgoing.wait(STAGE_TIMEOUT)
+            item = outgoing.get()
+            while item:
+                queued, pkt = item
+                start = now()
+                self.tx_queue_time.observe(start - queued)
+                self.app.send(pkt)
+                self.tx_time.observe(now() - start)
+                self.tx_packets.add()
+                self.sent += len(pkt)
+                item = outgoing.get()
+
+    def receive(self):
+        incoming = self.rings['incoming']
+        last = None
+        while self.running:
+            pkt = self.app.dispatcher.recv_pkt(RELAY_PKTS, STAGE_TIMEOUT)
+            if pkt:
+                arrival = now()
+                if last is not None:
+                    self.rx_interval.observe(arrival - last)
+                last = arrival
+                self.rx_packets.add()
+                self.rx_bytes.add(len(pkt))
+                self.received += len(pkt)
+                incoming.put(pkt)
+
+    def verify(self):
+        incoming = self.rings['incoming']
+        control = self.rings['control']
+        decoded = self.rings['decoded']
+        while self.running:
+            incoming.wait(STAGE_TIMEOUT)
+            recv_pkt = incoming.get()
+            while recv_pkt:
+                try:
+                    if ord(recv_pkt[0]) == PKT_C2MODE:
+                        kind, mode, ctr = self.pkt_factory.dct_pkt_c2mode(recv_pkt)
+                        if kind == C2MODE_ANNOUNCE:
+                            decoded.put(('announce', mode, ctr))
+                            self.rate.confirmed(mode)
+                        elif mode != self.voice_src.mode and mode in self.rate.ladder:
+                            self.src_mode = mode
+                        else:
+                            self.src_mode = None
+                            control.put(('answer', self.voice_src.mode))
+                    else:
+                        ctr, c2data = self.pkt_factory.dct_pkt_codec2(recv_pkt)
+                        decoded.put(('voice', ctr, c2data))
+                except InvalidHMACException as e:
+                    self.hmac_failures += 1
+                    self.logger.error(str(e))
+                recv_pkt = incoming.get()
+            # ask the peer to change mode if the line calls for it
+            mode = self.rate.update(self.voice_sink.jitter.stats(), self.hmac_failures)
+            if mode:
+                control.put(('request', mode))
+
+    def playback(self):
+        decoded = self.rings['decoded']
+        voice_sink = self.voice_sink
+        while self.running:
+            timeout = STAGE_TIMEOUT
+            due = voice_sink.timeout()
+            if due is not None:
+                timeout = min(timeout, due / 1000.0)
+            if voice_sink.pcm or not voice_sink.codec:
+                # the device or decoder pipe may be ready any moment
+                timeout = min(timeout, PLAYBACK_TICK)
+            decoded.wait(timeout)
+            item = decoded.get()
+            while item:
+                if item[0] == 'voice':
+                    start = now()
+                    voice_sink.write(item[1], item[2])
+                    self.playback_time.observe(now() - start)
+                else:
+                    voice_sink.announce(item[1], item[2])
+                item = decoded.get()
+            # play out whatever is due
+            voice_sink.flush()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+'''
+Loopback transport that replays the losses of a recorded trace between
+two VoiZApps, with synthetic voice at either end, so handshake and relay
+can be benchmarked without sound cards
+'''
+
+from heapq import heappush, heappop
+from logging import getLogger
+from os import O_NONBLOCK, pipe, read, write, close
+from fcntl import fcntl, F_GETFL, F_SETFL
+from errno import EAGAIN
+from itertools import count, cycle
+from Queue import Queue
+from select import POLLIN
+from threading import Thread, Condition, Event
+from time import time as now
+
+from .c2 import CODEC2_MODE, CODEC2_FRAMES, SAMPLE_RATE as CODEC2_SAMPLE_RATE, codec2_packet_duration
+from .fec import VoiZFEC, UncorrectableFECException, HEADER_COPIES
+from .jitter import VoiZJitterBuffer, BUFFERING
+from .metrics import VoiZMetrics
+from .protocol import CODEC2_PAYLOAD_LEN
+from .trace import read_trace
+from .framing import PAYLOAD_LEN, FRAME_OVERHEAD, SAMPLE_RATE, ZERO
+
+PLAYOUT_LEAD = 0.1
+
+def fec_error_mask(frame):
+    '''
+    Returns the bytes a correctable FEC frame was corrupted by, as an XOR
+    mask, or None if the frame cannot be restored to find out
+    '''
+    try:
+        pkt = VoiZFEC().decode(frame)
+    except UncorrectableFECException:
+        return None
+    a, b, c = bytearray(frame[:HEADER_COPIES])
+    code = (a & b) | (a & c) | (b & c)
+    clean = bytearray(VoiZFEC(code, code).encode(pkt))
+    return bytearray(x ^ y for x, y in zip(bytearray(frame), clean))
+
+def trace_outcomes(path):
+    '''
+    Returns what happened to each frame received in the trace, in order:
+    None for a clean frame, an XOR mask for one corrupted in a known way,
+    and False for one that was lost
+    '''
+    outcomes = []
+    for t, received, ok, frame in read_trace(path):
+        if not received:
+            continue
+        if ok:
+            outcomes.append(None)
+            continue
+        mask = fec_error_mask(frame)
+        outcomes.append(mask if mask and any(mask) else False)
+    if not outcomes:
+        raise ValueError('`%s` has no received frames' % path)
+    return outcomes
+
+class VoiZLoopbackTx():
+    '''
+    Stands in for tx_block, handing frames to the replay channel
+    '''
+
+    def __init__(self, channel, direction, sps, interpolation, varlen=False, fec=None, recorder=None):
+        self.channel = channel
+        self.direction = direction
+        self.sps = sps
+        self.interpolation = interpolation
+        self.varlen = varlen
+        self.fec = fec
+        self.recorder = recorder
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def airtime(self, length=PAYLOAD_LEN, pkt_id=None):
+        if self.fec:
+            length = self.fec.encoded_len(length, pkt_id)
+        elif not self.varlen:
+            length = PAYLOAD_LEN
+        return (length + FRAME_OVERHEAD) * 8.0 * self.sps * self.interpolation / SAMPLE_RATE
+
+    def send_pkt(self, payload):
+        if self.fec:
+            payload = self.fec.encode(payload)
+        if not self.varlen:
+            payload = payload.ljust(PAYLOAD_LEN, ZERO)
+        if self.recorder:
+            self.recorder.sent(payload)
+        airtime = (len(payload) + FRAME_OVERHEAD) * 8.0 * self.sps * self.interpolation / SAMPLE_RATE
+        self.channel.send(self.direction, payload, airtime)
+
+class VoiZLoopbackRx():
+    '''
+    Stands in for rx_block, taking frames from the replay channel
+    '''
+
+    def __init__(self, fec=None, recorder=None):
+        self.fec = fec
+        self.recorder = recorder
+        self.bad_pkts = 0
+        self.queue = Queue()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def deliver_pkt(self, ok, payload):
+        # as rx_block does it
+        if self.recorder:
+            self.recorder.received(ok, payload)
+        if self.fec:
+            try:
+                payload = self.fec.decode(payload, ok)
+                ok = True
+            except UncorrectableFECException:
+                ok = False
+        if ok:
+            self.queue.put(payload)
+        else:
+            self.bad_pkts += 1
+
+    def wait_pkt(self):
+        return self.queue.get()
+
+    def close_queue(self):
+        self.queue.put(None)
+
+class VoiZReplayChannel(Thread):
+    '''
+    Carries frames both ways between two loopback endpoints, one frame on
+    air at a time per direction. Each frame meets the fate of the next
+    received frame in the trace: delivered, corrupted by the same bytes
+    or lost. Airtime is divided by `speed`
+    '''
+
+    def __init__(self, outcomes, speed=1.0):
+        Thread.__init__(self, name='replay')
+        self.daemon = True
+        self.logger = getLogger('replay')
+        self.speed = speed
+        # both directions replay the trace, from opposite ends of it
+        half = len(outcomes) / 2
+        self.outcomes = (cycle(outcomes), cycle(outcomes[half:] + outcomes[:half]))
+        self.rxs = [None, None]
+        self.free_at = [0.0, 0.0]
+        self.pending = []
+        self.sequence = count()
+        self.cond = Condition()
+        self.running = True
+        # statistics per direction
+        self.sent = [0, 0]
+        self.lost = [0, 0]
+        self.corrupted = [0, 0]
+
+    def endpoint(self, side, sps, interpolation, varlen=False, fec=None, recorder=None):
+        '''
+        Returns (tx, rx) for one end, side 0 or 1
+        '''
+        rx = VoiZLoopbackRx(fec, recorder)
+        self.rxs[side] = rx
+        return VoiZLoopbackTx(self, side, sps, interpolation, varlen, fec, recorder), rx
+
+    def send(self, direction, frame, airtime):
+        self.sent[direction] += 1
+        with self.cond:
+            # a lost frame took its airtime all the same
+            done = max(now(), self.free_at[direction]) + airtime / self.speed
+            self.free_at[direction] = done
+        outcome = next(self.outcomes[direction])
+        ok = True
+        if outcome is False:
+            self.lost[direction] += 1
+            return
+        if outcome:
+            self.corrupted[direction] += 1
+            frame = str(bytearray(x ^ y for x, y in zip(bytearray(frame), outcome)) + frame[len(outcome):])
+            ok = False
+        with self.cond:
+            heappush(self.pending, (done, next(self.sequence), 1 - direction, ok, frame))
+            self.cond.notify()
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                while self.running and not (self.pending and self.pending[0][0] <= now()):
+                    self.cond.wait(self.pending[0][0] - now() if self.pending else None)
+                if not self.running:
+                    break
+                done, sequence, side, ok, frame = heappop(self.pending)
+            self.rxs[side].deliver_pkt(ok, frame)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+class VoiZReplaySource():
+    '''
+    Stands in for Codec2Source, producing codec2 frames of a counting
+    pattern at `speed` times the codec's frame rate
+    '''
+
+    def __init__(self, mode=CODEC2_MODE, speed=1.0):
+        self.mode = mode
+        self.speed = speed
+        self.frames = 0
+
+    def __enter__(self):
+        self.ticks_r, self.ticks_w = pipe()
+        for fd in (self.ticks_r, self.ticks_w):
+            fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+        self.stopped = Event()
+        self.thread = Thread(target=self._tick, name='replay-src')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        close(self.ticks_r)
+        close(self.ticks_w)
+
+    def _tick(self):
+        # one byte in the pipe for every frame captured
+        next_tick = now()
+        while not self.stopped.is_set():
+            next_tick += CODEC2_FRAMES[self.mode][1] / float(CODEC2_SAMPLE_RATE) / self.speed
+            self.stopped.wait(max(0, next_tick - now()))
+            try:
+                write(self.ticks_w, '\x00')
+            except OSError as e:
+                if e.errno != EAGAIN:
+                    raise
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+    def poll_fds(self):
+        return [(self.ticks_r, POLLIN)]
+
+    def read(self):
+        try:
+            ticks = len(read(self.ticks_r, 4096))
+        except OSError as e:
+            if e.errno != EAGAIN:
+                raise
+            return ''
+        frame_bytes = CODEC2_FRAMES[self.mode][0]
+        bits = []
+        for i in xrange(ticks):
+            bits.append(chr(self.frames % 256) * frame_bytes)
+            self.frames += 1
+        return ''.join(bits)
+
+class VoiZReplaySink():
+    '''
+    Stands in for Codec2Sink, playing out through the same jitter buffer
+    but only counting what it would have decoded
+    '''
+
+    def __init__(self, ctr_step, mode=CODEC2_MODE, room=CODEC2_PAYLOAD_LEN, speed=1.0, metrics=None):
+        self.mode = mode
+        self.room = room
+        self.speed = speed
+        self.jitter = VoiZJitterBuffer(self.packet_duration(), ctr_step, PLAYOUT_LEAD / speed)
+        metrics = metrics or VoiZMetrics()
+        metrics.gauge('jitter', self.jitter.stats)
+        # the relay's playback stage looks at these
+        self.codec = True
+        self.pcm = ''
+        self.next_slot = None
+        self.played = 0
+        self.concealed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def packet_duration(self):
+        return codec2_packet_duration(self.mode, self.room) / self.speed
+
+    def announce(self, mode, ctr):
+        self.mode = mode
+        self.jitter.set_packet_duration(self.packet_duration())
+
+    def timeout(self):
+        due = self.jitter.due()
+        if due is None:
+            return None
+        if self.next_slot is not None:
+            due = max(due, self.next_slot)
+        return max(0, due - now()) * 1000
+
+    def write(self, ctr, c2data):
+        self.jitter.push(ctr, c2data)
+        self.flush()
+
+    def flush(self):
+        while self.next_slot is None or self.next_slot <= now():
+            c2data = self.jitter.pop()
+            if c2data is BUFFERING:
+                self.next_slot = None
+                break
+            self.next_slot = max(self.next_slot or 0, now()) + self.packet_duration()
+            if c2data is None:
+                self.concealed += 1
+            else:
+                self.played += 1
@@ -1,14 +1,79 @@
 #!/usr/bin/env python
 
 from gnuradio import audio
-from gnuradio import blocks
 from gnuradio import digital
 from gnuradio import filter
 from gnuradio import gr
 from gnuradio.filter import firdes
 from grc_gnuradio import blks2 as grc_blks2
 
+from .fec import UncorrectableFECException
+
 SAMPLE_RATE = 48000
+MSG_CLOSE = 1
+
+_channel_taps = {}
+
+def channel_taps(sideband, transition, interpolation):
+    '''
+    Low-pass taps for the channelizer, designed once per setting. The
+    stopband has to end below the decimated Nyquist frequency, which
+    narrows the passband for settings that would otherwise alias
+    '''
+    key = (sideband, transition, interpolation)
+    taps = _channel_taps.get(key)
+    if taps is None:
+        cutoff = min(sideband, SAMPLE_RATE / (2.0 * interpolation) - transition)
+        taps = _channel_taps.setdefault(key, tuple(firdes.low_pass(1, SAMPLE_RATE, cutoff, transition)))
+    return taps
+
+class rx_demodulator(gr.hier_block2):
+    '''
+    GFSK demodulator taking the real audio passband to unpacked bits. One
+    decimating frequency translating filter selects the band around the
+    carrier, moves it to baseband and computes only the samples kept
+    '''
+
+    def __init__(   self,
+                    carrier,
+                    sideband,
+                    transition,
+                    sps,
+                    interpolation):
+
+        gr.hier_block2.__init__(
+            self,
+            "Receive demodulator",
+            gr.io_signature(1, 1, gr.sizeof_float),
+            gr.io_signature(1, 1, gr.sizeof_char)
+        )
+
+        ##################################################
+        # Blocks
+        ##################################################
+        self.channelizer = filter.freq_xlating_fir_filter_fcf(
+                interpolation,
+                channel_taps(sideband, transition, interpolation),
+                carrier,
+                SAMPLE_RATE,
+        )
+        self.digital_gfsk_demod_0 = digital.gfsk_demod(
+            samples_per_symbol=sps,
+            sensitivity=1.0,
+            gain_mu=0.175,
+            mu=0.5,
+            omega_relative_limit=0.005,
+            freq_error=0.0,
+            verbose=False,
+            log=False,
+        )
+
+        ##################################################
+        # Connections
+        ##################################################
+        self.connect((self, 0), (self.channelizer, 0))
+        self.connect((self.channelizer, 0), (self.digital_gfsk_demod_0, 0))
+        self.connect((self.digital_gfsk_demod_0, 0), (self, 0))
 
 class rx_block(gr.top_block):
 
@@ -19,7 +84,9 @@ class rx_block(gr.top_block):
                     sps,
                     interpolation,
                     lomicdev,
-                    listen=False):
+                    listen=False,
+                    fec=None,
+                    recorder=None):
 
         gr.top_block.__init__(self, "Receive block")
 
@@ -33,60 +100,63 @@ class rx_block(gr.top_block):
         self.transition = transition
         self.sps = sps
         self.interpolation = interpolation
+        self.bad_pkts = 0
+        self.fec = fec
+        self.recorder = recorder
 
         ##################################################
         # Blocks
         ##################################################
-        self.rational_resampler_xxx_0_0_0 = filter.rational_resampler_ccc(
-                interpolation=1,
-                decimation=interpolation,
-                taps=None,
-                fractional_bw=None,
-        )
-        self.freq_xlating_fir_filter_xxx_0_0 = filter.freq_xlating_fir_filter_ccc(1, (firdes.low_pass(1,SAMPLE_RATE,sideband,transition)), carrier, SAMPLE_RATE)
-        self.digital_gfsk_demod_0 = digital.gfsk_demod(
-            samples_per_symbol=sps,
-            sensitivity=1.0,
-            gain_mu=0.175,
-            mu=0.5,
-            omega_relative_limit=0.005,
-            freq_error=0.0,
-            verbose=False,
-            log=False,
-        )
-        self.blocks_float_to_complex_0 = blocks.float_to_complex(1)
-        self.blks2_packet_decoder_0 = grc_blks2.packet_demod_b(grc_blks2.packet_decoder(
-                access_code="",
-                threshold=-1,
-                callback=lambda ok, payload: self.blks2_packet_decoder_0.recv_pkt(ok, payload),
-            ),
+        self.sink_queue = gr.msg_queue()
+
+        self.demodulator = rx_demodulator(carrier, sideband, transition, sps, interpolation)
+        # decoded packets go straight onto the sink queue, one message each
+        self.blks2_packet_decoder_0 = grc_blks2.packet_decoder(
+            access_code="",
+            threshold=-1,
+            callback=self.deliver_pkt,
         )
         self.audio_source_0 = audio.source(SAMPLE_RATE, lomicdev, True)
 
         if listen:
             self.audio_sink_0_tmp = audio.sink(SAMPLE_RATE, 'plughw:0,0', True)
 
-        self.fft_filter_xxx_1 = filter.fft_filter_ccc(1, (firdes.complex_band_pass_2(1.0,SAMPLE_RATE,carrier-sideband,carrier+sideband,transition,100,firdes.WIN_HAMMING,6.76)), 1)
-        self.fft_filter_xxx_1.declare_sample_delay(0)
-
-        self.sink_queue = gr.msg_queue()
-        self.msg_sink = blocks.message_sink(gr.sizeof_char, self.sink_queue, False)
-
         ##################################################
         # Connections
         ##################################################
-        self.connect((self.blks2_packet_decoder_0, 0), (self.msg_sink, 0))
-        self.connect((self.freq_xlating_fir_filter_xxx_0_0, 0), (self.rational_resampler_xxx_0_0_0, 0))
-        self.connect((self.digital_gfsk_demod_0, 0), (self.blks2_packet_decoder_0, 0))
-        self.connect((self.audio_source_0, 0), (self.blocks_float_to_complex_0, 0))
-        self.connect((self.blocks_float_to_complex_0, 0), (self.fft_filter_xxx_1, 0))
-        self.connect((self.fft_filter_xxx_1, 0), (self.freq_xlating_fir_filter_xxx_0_0, 0))
-        self.connect((self.rational_resampler_xxx_0_0_0, 0), (self.digital_gfsk_demod_0, 0))
+        self.connect((self.audio_source_0, 0), (self.demodulator, 0))
+        self.connect((self.demodulator, 0), (self.blks2_packet_decoder_0, 0))
 
         # sound playback
         if listen:
             self.connect((self.audio_source_0, 0), (self.audio_sink_0_tmp, 0))
 
+    def deliver_pkt(self, ok, payload):
+        # the decoder reads the length from each frame header, so padded
+        # and variable length frames arrive the same way
+        if self.recorder:
+            self.recorder.received(ok, payload)
+        if self.fec:
+            # frames that failed the CRC may still be correctable
+            try:
+                payload = self.fec.decode(payload, ok)
+                ok = True
+            except UncorrectableFECException:
+                ok = False
+        if ok:
+            self.sink_queue.insert_tail(gr.message_from_string(payload))
+        else:
+            self.bad_pkts += 1
+
     def recv_pkt(self):
         if self.sink_queue.count() > 0:
             return self.sink_queue.delete_head().to_string()
+
+    def wait_pkt(self):
+        # blocks until the decoder delivers a packet or the queue is closed
+        msg = self.sink_queue.delete_head()
+        if msg.type() != MSG_CLOSE:
+            return msg.to_string()
+
+    def close_queue(self):
+        self.sink_queue.insert_tail(gr.message(MSG_CLOSE))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+'''
+Generator based event loop for the handshake, in the manner of asyncio's
+coroutines: a task yields futures (or other coroutines) and is resumed
+with their results
+'''
+
+from collections import deque
+from errno import EAGAIN
+from fcntl import fcntl, F_GETFL, F_SETFL
+from heapq import heappush, heappop
+from itertools import count
+from logging import getLogger
+from os import O_NONBLOCK, pipe, read, write
+from select import poll, POLLIN
+from sys import exc_info
+from threading import Thread
+from time import time as now
+from types import GeneratorType
+
+class Return(Exception):
+    # Python 2 generators cannot return a value, so coroutines raise this
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class TaskCancelled(Exception):
+    pass
+
+class VoiZFuture():
+    '''
+    Result of an operation that completes later, on the loop's thread
+    '''
+
+    def __init__(self):
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+    def set_result(self, value):
+        if self.finished:
+            return
+        self.finished = True
+        self.value = value
+        self._run_callbacks()
+
+    def set_exception(self, error):
+        # takes the exc_info() triple, so the traceback survives
+        if self.finished:
+            return
+        self.finished = True
+        self.error = error
+        self._run_callbacks()
+
+    def cancel(self):
+        try:
+            raise TaskCancelled()
+        except TaskCancelled:
+            self.set_exception(exc_info())
+
+    def add_done_callback(self, callback):
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def _run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+class VoiZTask(VoiZFuture):
+    '''
+    Runs a coroutine on the loop until it returns, raises or is cancelled
+    '''
+
+    def __init__(self, loop, coro):
+        VoiZFuture.__init__(self)
+        self.loop = loop
+        self.coro = coro
+        self.waiting = None
+        loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        if self.finished:
+            return
+        # the coroutine sees TaskCancelled where it is waiting, and may
+        # clean up in a finally block on its way out
+        waiting, self.waiting = self.waiting, None
+        if waiting:
+            waiting.cancel()
+        try:
+            raise TaskCancelled()
+        except TaskCancelled:
+            self.loop.call_soon(self._step, None, exc_info())
+
+    def _step(self, value, error):
+        if self.finished:
+            return
+        self.waiting = None
+        try:
+            if error:
+                yielded = self.coro.throw(*error)
+            else:
+                yielded = self.coro.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return as e:
+            self.set_result(e.value)
+        except Exception:
+            error = exc_info()
+            if not self.callbacks and not isinstance(error[1], TaskCancelled):
+                self.loop.logger.error('Task failed with nobody waiting', exc_info=error)
+            self.set_exception(error)
+        else:
+            if isinstance(yielded, GeneratorType):
+                yielded = self.loop.spawn(yielded)
+            self.waiting = yielded
+            yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        # a cancelled task no longer waits on what it yielded
+        if future is not self.waiting:
+            return
+        try:
+            value = future.result()
+        except Exception:
+            self.loop.call_soon(self._step, None, exc_info())
+        else:
+            self.loop.call_soon(self._step, value, None)
+
+class VoiZLoop():
+    '''
+    Runs tasks on one thread, waking for timers, packets arriving at the
+    dispatcher and work finishing on other threads
+    '''
+
+    def __init__(self, dispatcher, pool=None):
+        self.logger = getLogger('session')
+        self.dispatcher = dispatcher
+        self.pool = pool
+        self.ready = deque()
+        self.timers = []
+        self.sequence = count()
+        # (pkt_ids, future) for each expect() still waiting
+        self.expecting = []
+        self.main = None
+        # lets other threads interrupt poll()
+        self.wakeup_r, self.wakeup_w = pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+        self.poller = poll()
+        self.poller.register(self.wakeup_r, POLLIN)
+        self.poller.register(dispatcher.fileno(), POLLIN)
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.call_soon(callback, *args)
+        try:
+            write(self.wakeup_w, '\x00')
+        except OSError as e:
+            # a full pipe is already readable
+            if e.errno != EAGAIN:
+                raise
+
+    def call_later(self, delay, callback, *args):
+        heappush(self.timers, (now() + delay, next(self.sequence), callback, args))
+
+    def spawn(self, coro):
+        return VoiZTask(self, coro)
+
+    def sleep(self, delay):
+        future = VoiZFuture()
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def expect(self, pkt_ids, timeout=None):
+        '''
+        Returns a future for the next packet with one of the given IDs,
+        which resolves to None if `timeout` seconds pass first
+        '''
+        if isinstance(pkt_ids, int):
+            pkt_ids = (pkt_ids,)
+        future = VoiZFuture()
+        pkt = self.dispatcher.recv_pkt(pkt_ids, 0)
+        if pkt:
+            future.set_result(pkt)
+            return future
+        self.expecting.append((pkt_ids, future))
+        if timeout is not None:
+            self.call_later(timeout, future.set_result, None)
+        return future
+
+    def run_in_thread(self, fn, *args):
+        '''
+        Runs a blocking call on a thread of its own
+        '''
+        future = VoiZFuture()
+        def work():
+            try:
+                result = fn(*args)
+            except Exception:
+                self.call_soon_threadsafe(future.set_exception, exc_info())
+            else:
+                self.call_soon_threadsafe(future.set_result, result)
+        thread = Thread(target=work, name=getattr(fn, '__name__', 'executor'))
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def run_in_executor(self, fn, *args):
+        '''
+        Runs CPU bound work in the process pool, out of reach of the GIL.
+        fn and args have to pickle, without a pool it runs on a thread
+        '''
+        if self.pool is None:
+            return self.run_in_thread(fn, *args)
+        return self.run_in_thread(self.pool.apply, fn, args)
+
+    def run_until_complete(self, coro):
+        self.main = task = self.spawn(coro)
+        while not task.done():
+            self._run_once()
+        return task.result()
+
+    def stop(self):
+        '''
+        Cancels the task run_until_complete is waiting on, from any thread
+        '''
+        self.call_soon_threadsafe(self._cancel_main)
+
+    def _cancel_main(self):
+        if self.main:
+            self.main.cancel()
+
+    def _deliver(self):
+        expecting = []
+        for pkt_ids, future in self.expecting:
+            if future.done():
+                continue
+            pkt = self.dispatcher.recv_pkt(pkt_ids, 0)
+            if pkt:
+                future.set_result(pkt)
+            else:
+                expecting.append((pkt_ids, future))
+        self.expecting = expecting
+
+    def _run_once(self):
+        timeout = None
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - now()) * 1000
+        for fd, event in self.poller.poll(timeout):
+            if fd == self.wakeup_r:
+                try:
+                    while read(self.wakeup_r, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != EAGAIN:
+                        raise
+            else:
+                self.dispatcher.clear_wakeup()
+                self._deliver()
+        while self.timers and self.timers[0][0] <= now():
+            when, sequence, callback, args = heappop(self.timers)
+            callback(*args)
+        for i in xrange(len(self.ready)):
+            callback, args = self.ready.popleft()
+            callback(*args)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+'''
+Runs the GFSK modem through a simulated channel instead of sound cards
+'''
+
+from logging import getLogger
+from math import sqrt
+from random import Random
+from time import time as now
+
+from gnuradio import blocks
+from gnuradio import channels
+from gnuradio import digital
+from gnuradio import filter
+from gnuradio import gr
+from gnuradio.digital import packet_utils
+
+from .tx import tx_modulator, SAMPLE_RATE, PAYLOAD_LEN
+from .rx import rx_demodulator
+from .fec import UncorrectableFECException
+from .framing import make_packet, ACCESS_CODE_THRESHOLD
+
+HILBERT_TAPS = 65
+TAIL_BYTES = 64             # flushes the filters behind the last packet
+GAP_BYTES = 8               # idle bytes between packets
+
+def frame_pkts(pkts):
+    # framed the way packet_encoder frames packets on air
+    gap = '\x00' * GAP_BYTES
+    return gap.join(
+        make_packet(pkt) for pkt in pkts
+    ) + '\x00' * TAIL_BYTES
+
+def random_pkts(count, length=PAYLOAD_LEN, seed=0):
+    rand = Random(seed)
+    return [''.join(chr(rand.randint(0, 255)) for i in xrange(length)) for n in xrange(count)]
+
+def noise_voltage(snr_db, signal_power):
+    # only the real part of the complex channel noise reaches the receiver
+    return sqrt(2 * signal_power / 10 ** (snr_db / 10.0))
+
+class sim_block(gr.top_block):
+
+    def __init__(   self,
+                    framed,
+                    carrier,
+                    sideband,
+                    transition,
+                    sps,
+                    interpolation,
+                    noise=0.0,
+                    freq_offset=0.0,
+                    clock_drift=0.0,
+                    attenuation=1.0,
+                    seed=0):
+
+        gr.top_block.__init__(self, "Channel simulation")
+
+        ##################################################
+        # Variables
+        ##################################################
+        self.samp_rate = SAMPLE_RATE
+
+        ##################################################
+        # Blocks
+        ##################################################
+        self.vector_source = blocks.vector_source_b(map(ord, framed), False)
+        self.modulator = tx_modulator(carrier, sideband, transition, sps, interpolation)
+        # the channel model wants complex samples
+        self.hilbert = filter.hilbert_fc(HILBERT_TAPS)
+        self.channel_model = channels.channel_model(
+            noise_voltage=noise,
+            frequency_offset=freq_offset / float(SAMPLE_RATE),
+            epsilon=1.0 + clock_drift,
+            taps=(attenuation,),
+            noise_seed=seed,
+        )
+        self.complex_to_real = blocks.complex_to_real(1)
+        self.demodulator = rx_demodulator(carrier, sideband, transition, sps, interpolation)
+        # packet_decoder without its delivery thread, so that every frame
+        # is in the queue by the time the flowgraph finishes
+        self.frame_queue = gr.msg_queue()
+        self.correlator = digital.correlate_access_code_bb(
+            packet_utils.default_access_code,
+            ACCESS_CODE_THRESHOLD
+        )
+        self.framer_sink = digital.framer_sink_1(self.frame_queue)
+
+        ##################################################
+        # Connections
+        ##################################################
+        self.connect((self.vector_source, 0), (self.modulator, 0))
+        self.connect((self.modulator, 0), (self.hilbert, 0))
+        self.connect((self.hilbert, 0), (self.channel_model, 0))
+        self.connect((self.channel_model, 0), (self.complex_to_real, 0))
+        self.connect((self.complex_to_real, 0), (self.demodulator, 0))
+        self.connect((self.demodulator, 0), (self.correlator, 0))
+        self.connect((self.correlator, 0), (self.framer_sink, 0))
+
+    def frames(self):
+        '''
+        Returns (ok, payload) for each frame the receiver picked up
+        '''
+        frames = []
+        while self.frame_queue.count() > 0:
+            msg = self.frame_queue.delete_head()
+            frames.append(packet_utils.unmake_packet(msg.to_string(), int(msg.arg1())))
+        return frames
+
+class power_block(gr.top_block):
+    # runs the modulator alone to find the transmitted signal power
+
+    def __init__(self, framed, carrier, sideband, transition, sps, interpolation):
+        gr.top_block.__init__(self, "Transmit power")
+        self.vector_source = blocks.vector_source_b(map(ord, framed), False)
+        self.modulator = tx_modulator(carrier, sideband, transition, sps, interpolation)
+        self.vector_sink = blocks.vector_sink_f()
+        self.connect((self.vector_source, 0), (self.modulator, 0))
+        self.connect((self.modulator, 0), (self.vector_sink, 0))
+
+    def power(self):
+        samples = self.vector_sink.data()
+        return sum(x * x for x in samples) / max(1, len(samples))
+
+class VoiZChannelSim():
+    '''
+    Sends a batch of packets through the simulated channel as fast as the
+    flowgraph runs and reports how many came out intact
+    '''
+
+    def __init__(self, carrier, sideband, transition, sps, interpolation):
+        self.logger = getLogger('sim')
+        self.modem = (carrier, sideband, transition, sps, interpolation)
+        self.sps = sps
+        self.interpolation = interpolation
+        self.signal_power = None
+
+    def airtime(self, framed):
+        return len(framed) * 8.0 * self.sps * self.interpolation / SAMPLE_RATE
+
+    def measure_power(self, pkts):
+        tb = power_block(frame_pkts(pkts), *self.modem)
+        tb.run()
+        self.signal_power = tb.power()
+        self.logger.debug('Transmit power %.6f', self.signal_power)
+        return self.signal_power
+
+    def run(self, pkts, snr_db=None, freq_offset=0.0, clock_drift=0.0, attenuation=1.0, seed=0, fec=None):
+        sent = set(pkts)
+        if fec:
+            pkts = [fec.encode(pkt) for pkt in pkts]
+        framed = frame_pkts(pkts)
+        noise = 0.0
+        if snr_db is not None:
+            if self.signal_power is None:
+                self.measure_power(pkts)
+            noise = noise_voltage(snr_db, self.signal_power * attenuation ** 2)
+        tb = sim_block(
+            framed,
+            *self.modem,
+            noise=noise,
+            freq_offset=freq_offset,
+            clock_drift=clock_drift,
+            attenuation=attenuation,
+            seed=seed
+        )
+        t0 = now()
+        tb.run()
+        elapsed = now() - t0
+        frames = tb.frames()
+        received = len(frames)
+        bad = sum(1 for crc_ok, payload in frames if not crc_ok)
+        corrected = 0
+        if fec:
+            decoded = []
+            for crc_ok, payload in frames:
+                try:
+                    decoded.append((True, fec.decode(payload, crc_ok)))
+                except UncorrectableFECException:
+                    continue
+                corrected += not crc_ok
+            frames = decoded
+        ok = sum(1 for crc_ok, payload in frames if crc_ok and payload in sent)
+        airtime = self.airtime(framed)
+        return {
+            'sent':         len(pkts),
+            'ok':           ok,
+            'bad_crc':      bad,
+            'corrected':    corrected,
+            'missed':       max(0, len(pkts) - received),
+            'per':          1.0 - ok / float(len(pkts)),
+            'elapsed':      elapsed,
+            'airtime':      airtime,
+            'realtime':     airtime / elapsed,
+        }
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''
+Sweeps modem parameters through the channel simulator and ranks them
+'''
+
+from itertools import product
+from logging import getLogger
+from resource import getrusage, RUSAGE_SELF
+
+from .sim import VoiZChannelSim, random_pkts
+from .tx import SAMPLE_RATE, PAYLOAD_LEN
+
+SWEEP_GRID = {
+    'carrier':          (1800, 2400),
+    'sideband':         (1200, 1800, 2300),
+    'transition':       (120, 240),
+    'sps':              (2, 4),
+    'interpolation':    (4, 6, 8),
+}
+# a smaller grid that runs in a few seconds before a call
+AUTOTUNE_GRID = {
+    'carrier':          (2400,),
+    'sideband':         (1800, 2300),
+    'transition':       (240,),
+    'sps':              (2, 4),
+    'interpolation':    (4, 6, 8),
+}
+MODEM_PARAMS = ('carrier', 'sideband', 'transition', 'sps', 'interpolation')
+
+SWEEP_PACKETS = 100
+AUTOTUNE_PACKETS = 40
+# fraction of a core the modem may use while running in realtime
+CPU_BUDGET = 0.5
+
+def cpu_time():
+    # GNU Radio runs its blocks in threads of this process
+    usage = getrusage(RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def valid_setting(setting):
+    # the passband has to fit between DC and the audio Nyquist frequency
+    return (
+        setting['carrier'] > setting['sideband'] and
+        setting['carrier'] + setting['sideband'] + setting['transition'] <= SAMPLE_RATE / 2
+    )
+
+def settings(grid):
+    for values in product(*(grid[param] for param in MODEM_PARAMS)):
+        setting = dict(zip(MODEM_PARAMS, values))
+        if valid_setting(setting):
+            yield setting
+
+def rank(results):
+    # best goodput first, then least loss, then the setting itself so ties
+    # break the same way everywhere; CPU use varies between machines, so
+    # it only filters the pick in best()
+    return sorted(results, key=lambda r: (
+        -round(r['goodput']),
+        r['per'],
+        tuple(r[param] for param in MODEM_PARAMS)
+    ))
+
+class VoiZModemSweep():
+    '''
+    Runs the same packets through the simulated channel once per modem
+    setting and measures goodput, loss and CPU for each
+    '''
+
+    def __init__(self, grid=SWEEP_GRID, packets=SWEEP_PACKETS, seed=0, **channel):
+        self.logger = getLogger('sweep')
+        self.grid = grid
+        self.pkts = random_pkts(packets, seed=seed)
+        self.seed = seed
+        self.channel = channel
+
+    def measure(self, setting):
+        sim = VoiZChannelSim(*(setting[param] for param in MODEM_PARAMS))
+        c0 = cpu_time()
+        result = sim.run(self.pkts, seed=self.seed, **self.channel)
+        cpu = cpu_time() - c0
+        result.update(setting)
+        # payload bytes delivered per second on air
+        result['goodput'] = result['ok'] * PAYLOAD_LEN / result['airtime']
+        # CPU seconds needed per second of realtime operation
+        result['cpu'] = cpu / result['airtime']
+        return result
+
+    def run(self):
+        results = []
+        for setting in settings(self.grid):
+            self.logger.debug('Simulating %r', setting)
+            results.append(self.measure(setting))
+        return rank(results)
+
+    def best(self):
+        ranked = self.run()
+        if not ranked:
+            return None
+        # a setting this machine cannot run in realtime is no use to it
+        usable = [r for r in ranked if r['cpu'] <= CPU_BUDGET]
+        if not usable:
+            self.logger.warning('Every setting is over the CPU budget, using the top ranked one anyway')
+            usable = ranked
+        elif usable[0] is not ranked[0]:
+            # the budget depends on the machine, so a faster peer may not skip it
+            self.logger.warning('Skipped settings over the CPU budget, the other end may pick a different one')
+        return dict((param, usable[0][param]) for param in MODEM_PARAMS)
+
+def format_report(ranked):
+    lines = ['%4s %8s %8s %10s %4s %13s %10s %7s %6s' % (
+        'rank', 'carrier', 'sideband', 'transition', 'sps', 'interpolation', 'goodput', 'PER', 'cpu'
+    )]
+    for i, r in enumerate(ranked):
+        lines.append('%4d %8d %8d %10d %4d %13d %8.1fB/s %7.3f %5.0f%%%s' % (
+            i + 1,
+            r['carrier'],
+            r['sideband'],
+            r['transition'],
+            r['sps'],
+            r['interpolation'],
+            r['goodput'],
+            r['per'],
+            r['cpu'] * 100,
+            '' if r['cpu'] <= CPU_BUDGET else ' over budget'
+        ))
+    return '\n'.join(lines) + '\n'
+
+def autotune(snr_db, seed=0):
+    '''
+    Picks the best modem setting within the CPU budget for a simulated
+    channel at the given SNR. Nothing is measured on the real line. Both
+    ends have to end up on the same setting, so run it with the same
+    arguments on each
+    '''
+    sweep = VoiZModemSweep(AUTOTUNE_GRID, AUTOTUNE_PACKETS, seed, snr_db=snr_db)
+    return sweep.best()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Binary traces of every frame handed to the modem and every frame the
+demodulator delivered, for replaying a call's channel later
+'''
+
+from logging import getLogger
+from struct import Struct
+from threading import Lock
+from time import time as now
+
+TRACE_MAGIC = 'VZT1'
+TRACE_HEADER = Struct('!4sd')           # magic, start time
+TRACE_RECORD = Struct('!IBH')           # ms since start, flags, frame length
+TRACE_RECEIVED = 0x01                   # otherwise sent
+TRACE_OK = 0x02                         # passed the frame CRC
+
+class VoiZTraceRecorder():
+    '''
+    Appends frames to a trace file as they are sent and received, from
+    the transmit and the demodulator threads alike
+    '''
+
+    def __init__(self, path):
+        self.logger = getLogger('trace')
+        self.logger.info('Recording frames to `%s`', path)
+        self.fp = open(path, 'wb')
+        self.start = now()
+        self.lock = Lock()
+        self.fp.write(TRACE_HEADER.pack(TRACE_MAGIC, self.start))
+
+    def sent(self, frame):
+        self._record(TRACE_OK, frame)
+
+    def received(self, ok, frame):
+        self._record(TRACE_RECEIVED | (TRACE_OK if ok else 0), frame)
+
+    def _record(self, flags, frame):
+        record = TRACE_RECORD.pack(int((now() - self.start) * 1000), flags, len(frame)) + frame
+        with self.lock:
+            if not self.fp.closed:
+                self.fp.write(record)
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+def read_trace(path):
+    '''
+    Yields (seconds since start, received, ok, frame) for every record
+    '''
+    with open(path, 'rb') as fp:
+        magic, start = TRACE_HEADER.unpack(fp.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError('`%s` is not a VoiZ trace' % path)
+        while True:
+            header = fp.read(TRACE_RECORD.size)
+            if len(header) < TRACE_RECORD.size:
+                # a recorder killed mid-write leaves a partial record
+                break
+            ms, flags, length = TRACE_RECORD.unpack(header)
+            frame = fp.read(length)
+            if len(frame) < length:
+                break
+            yield ms / 1000.0, bool(flags & TRACE_RECEIVED), bool(flags & TRACE_OK), frame
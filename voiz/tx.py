@@ -8,31 +8,26 @@ from gnuradio import gr
 from gnuradio.filter import firdes
 from grc_gnuradio import blks2 as grc_blks2
 
-SAMPLE_RATE = 48000
-PAYLOAD_LEN = 81
+from .framing import SAMPLE_RATE, PAYLOAD_LEN, MAX_PAYLOAD_LEN, FRAME_OVERHEAD, ZERO, make_packet
 
-class tx_block(gr.top_block):
+class tx_modulator(gr.hier_block2):
+    '''
+    GFSK modulator taking framed packet bytes to the real audio passband
+    '''
 
     def __init__(   self,
                     carrier,
                     sideband,
                     transition,
                     sps,
-                    interpolation,
-                    looutdev):
-
-        gr.top_block.__init__(self, "Transmit block")
-
-        ##################################################
-        # Variables
-        ##################################################
-        self.samp_rate = SAMPLE_RATE
+                    interpolation):
 
-        self.carrier = carrier
-        self.sideband = sideband
-        self.transition = transition
-        self.sps = sps
-        self.interpolation = interpolation
+        gr.hier_block2.__init__(
+            self,
+            "Transmit modulator",
+            gr.io_signature(1, 1, gr.sizeof_char),
+            gr.io_signature(1, 1, gr.sizeof_float)
+        )
 
         ##################################################
         # Blocks
@@ -52,29 +47,99 @@ class tx_block(gr.top_block):
             log=False,
         )
         self.blocks_complex_to_real_0 = blocks.complex_to_real(1)
-        self.blks2_packet_encoder_0 = grc_blks2.packet_mod_b(grc_blks2.packet_encoder(
-                samples_per_symbol=sps,
-                bits_per_symbol=1,
-                preamble="",
-                access_code="",
-                pad_for_usrp=False,
-            ),
-            payload_length=PAYLOAD_LEN,
-        )
+
+        ##################################################
+        # Connections
+        ##################################################
+        self.connect((self, 0), (self.digital_gfsk_mod_0, 0))
+        self.connect((self.digital_gfsk_mod_0, 0), (self.rational_resampler_xxx_0, 0))
+        self.connect((self.rational_resampler_xxx_0, 0), (self.freq_xlating_fir_filter_xxx_0, 0))
+        self.connect((self.freq_xlating_fir_filter_xxx_0, 0), (self.blocks_complex_to_real_0, 0))
+        self.connect((self.blocks_complex_to_real_0, 0), (self, 0))
+
+class tx_block(gr.top_block):
+
+    def __init__(   self,
+                    carrier,
+                    sideband,
+                    transition,
+                    sps,
+                    interpolation,
+                    looutdev,
+                    varlen=False,
+                    fec=None,
+                    recorder=None):
+
+        gr.top_block.__init__(self, "Transmit block")
+
+        ##################################################
+        # Variables
+        ##################################################
+        self.samp_rate = SAMPLE_RATE
+
+        self.carrier = carrier
+        self.sideband = sideband
+        self.transition = transition
+        self.sps = sps
+        self.interpolation = interpolation
+        self.varlen = varlen
+        # FEC frames are longer than the packets they carry
+        self.fec = fec
+        if fec and not varlen:
+            raise ValueError('FEC needs variable length frames')
+        self.recorder = recorder
+
+        ##################################################
+        # Blocks
+        ##################################################
+        self.modulator = tx_modulator(carrier, sideband, transition, sps, interpolation)
         self.audio_sink_0 = audio.sink(SAMPLE_RATE, looutdev, True)
 
         self.source_queue = gr.msg_queue()
         self.msg_source = blocks.message_source(gr.sizeof_char, self.source_queue)
 
+        if not varlen:
+            # packet_mod_b cuts the byte stream into fixed size frames
+            self.blks2_packet_encoder_0 = grc_blks2.packet_mod_b(grc_blks2.packet_encoder(
+                    samples_per_symbol=sps,
+                    bits_per_symbol=1,
+                    preamble="",
+                    access_code="",
+                    pad_for_usrp=False,
+                ),
+                payload_length=PAYLOAD_LEN,
+            )
+
         ##################################################
         # Connections
         ##################################################
-        self.connect((self.msg_source, 0), (self.blks2_packet_encoder_0, 0))
-        self.connect((self.blks2_packet_encoder_0, 0), (self.digital_gfsk_mod_0, 0))
-        self.connect((self.digital_gfsk_mod_0, 0), (self.rational_resampler_xxx_0, 0))
-        self.connect((self.rational_resampler_xxx_0, 0), (self.freq_xlating_fir_filter_xxx_0, 0))
-        self.connect((self.freq_xlating_fir_filter_xxx_0, 0), (self.blocks_complex_to_real_0, 0))
-        self.connect((self.blocks_complex_to_real_0, 0), (self.audio_sink_0, 0))
+        if varlen:
+            # send_pkt frames each packet itself, at its own length
+            self.connect((self.msg_source, 0), (self.modulator, 0))
+        else:
+            self.connect((self.msg_source, 0), (self.blks2_packet_encoder_0, 0))
+            self.connect((self.blks2_packet_encoder_0, 0), (self.modulator, 0))
+        self.connect((self.modulator, 0), (self.audio_sink_0, 0))
+
+    def airtime(self, length=PAYLOAD_LEN, pkt_id=None):
+        # seconds on air for a frame carrying a `length` byte packet
+        if self.fec:
+            length = self.fec.encoded_len(length, pkt_id)
+        elif not self.varlen:
+            length = PAYLOAD_LEN
+        return (length + FRAME_OVERHEAD) * 8.0 * self.sps * self.interpolation / self.samp_rate
 
     def send_pkt(self, payload):
-        self.source_queue.insert_tail(gr.message_from_string(payload))
+        if self.fec:
+            payload = self.fec.encode(payload)
+        if self.varlen:
+            if len(payload) > MAX_PAYLOAD_LEN:
+                raise ValueError('Packet of %d bytes does not fit in a frame' % len(payload))
+            # the same framing packet_encoder uses, whose header carries
+            # the payload length for the decoder
+            frame = make_packet(payload)
+        else:
+            frame = payload = payload.ljust(PAYLOAD_LEN, ZERO)
+        if self.recorder:
+            self.recorder.sent(payload)
+        self.source_queue.insert_tail(gr.message_from_string(frame))